@@ -49,6 +49,14 @@ hooks.config.Eups.verbose = 0
 # this will not override this on the command-line
 hooks.config.Eups.asAdmin = None
 
+# Eups.downloadCache:  where to keep the files downloaded by eups distrib
+# install so that they needn't be downloaded again; False (the default)
+# disables the cache.  It holds a copy of every distribution file (up to
+# Eups.downloadCacheSize bytes), so choose a disk with space to spare.
+#
+# hooks.config.Eups.downloadCache = "/scratch/eups/downloads"
+# hooks.config.Eups.downloadCacheSize = 10*1024**3
+
 # A few other sets of configuration properties are defined that the top level:
 #
 #    Eups      -- properties that configure the main EUPS operations
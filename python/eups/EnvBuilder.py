@@ -0,0 +1,262 @@
+"""
+the EnvBuilder class -- the environment that a setup builds up.  Path-like
+variables are held as ordered sets of elements while a setup is in progress,
+and only turned back into strings (and written to os.environ) when it's done.
+"""
+from __future__ import absolute_import
+import os
+import re
+from . import utils
+
+class _PathValue(object):
+    """
+    an ordered, duplicate-free set of the elements of a delimited path.  Each
+    element has a rank; prepending gives an element a rank lower than any
+    other, and appending one higher (if it isn't already present), so every
+    edit is O(1) and the string is only assembled when it's needed.
+    """
+    def __init__(self, value, delim):
+        self.delim = delim
+        self.ranks = {}
+        self.lo, self.hi = 0, 0
+        self.prependDelim, self.appendDelim = False, False
+
+        for el in value.split(delim):
+            if el and el not in self.ranks: # strip extra delimiters at start or end, and duplicates
+                self.hi += 1
+                self.ranks[el] = self.hi
+
+    def __str__(self):
+        els = sorted(self.ranks, key=self.ranks.get)
+        value = self.delim.join(els)
+
+        if self.prependDelim and not value.startswith(self.delim):
+            value = self.delim + value
+        if self.appendDelim and not value.endswith(self.delim):
+            value += self.delim
+
+        return value
+
+class EnvBuilder(object):
+    """
+    the environment that a setup builds up.
+
+    Values are read with get() (or "in"), and written with set(), unset()
+    and editPath().  Between begin() and end() the changes that editPath()
+    makes to path-like variables (e.g. PATH or LD_LIBRARY_PATH) are kept in
+    an ordered set per variable rather than in os.environ, so setting up
+    many products that each add to the same paths costs time linear in the
+    number of elements; the final strings are written to os.environ by the
+    last end().  Outside begin()/end() all changes go straight to os.environ.
+
+    The changes made since a checkpoint() may be undone by rollback(), or
+    accepted with release(); unlike a copy of os.environ, a checkpoint costs
+    nothing until something changes.
+    """
+
+    def __init__(self):
+        self._paths = {}                # the path-like variables being built
+        self._depth = 0                 # the number of begin()s without an end()
+        self._undo = []                 # how to undo the changes made since the first checkpoint
+        self._marks = []                # the length of _undo at each checkpoint
+        self._setupVars = None          # the SETUP_* variables in os.environ
+
+    def begin(self):
+        """
+        start a batch of changes; the values of path-like variables are not
+        written to os.environ until the matching call to end()
+        """
+        self._depth += 1
+
+    def end(self):
+        """
+        finish a batch of changes started by begin(), writing the values of
+        path-like variables to os.environ if this is the outermost batch
+        """
+        self._depth -= 1
+        if self._depth <= 0:
+            self._depth = 0
+            self.flush()
+
+    def flush(self):
+        """
+        write the values of all the path-like variables being built to os.environ
+        """
+        for key in list(self._paths.keys()):
+            self._flushPath(key)
+
+    def get(self, key, default=None):
+        """
+        return the current value of a variable, or default if it isn't set
+        """
+        if key in self._paths:
+            return str(self._paths[key])
+        return os.environ.get(key, default)
+
+    def __getitem__(self, key):
+        val = self.get(key)
+        if val is None:
+            raise KeyError(key)
+        return val
+
+    def __contains__(self, key):
+        return key in self._paths or key in os.environ
+
+    def setupVariables(self):
+        """
+        return a dictionary of the SETUP_* variables (which describe the
+        products that are setup) and their values.  os.environ is checked on
+        every call, as it may have been changed other than through this
+        object, but the same dictionary is returned while the variables are
+        unchanged.  Don't modify the returned dictionary.
+        """
+        setupVars = dict([(k, v) for k, v in os.environ.items()
+                          if k.startswith(_setupPrefix) and _setupVarRe.search(k)])
+        if setupVars != self._setupVars:
+            self._setupVars = setupVars
+
+        return self._setupVars
+
+    def set(self, key, val):
+        """
+        set a variable to a value
+        """
+        self._discardPath(key)
+        self._setEnviron(key, val)
+
+    def unset(self, key):
+        """
+        unset a variable (if it's set)
+        """
+        self._discardPath(key)
+        if key in os.environ:
+            self._setEnviron(key, None)
+
+    def editPath(self, key, values, delim=":", append=False, remove=False,
+                 prependDelim=False, appendDelim=False):
+        """
+        add elements to, or remove elements from, a delimited path.
+        Duplicate elements are removed from the path.
+
+        @param key          the name of the variable
+        @param values       the elements to add or remove
+        @param delim        the delimiter between the elements of the path
+        @param append       add the elements at the end of the path, rather
+                              than the start.  Elements that are already
+                              present are left where they are.
+        @param remove       remove the elements from the path
+        @param prependDelim if True, the path should start with a delimiter
+        @param appendDelim  if True, the path should end with a delimiter
+        """
+        path = self._paths.get(key)
+        if path is not None and path.delim != delim:
+            self._flushPath(key)
+            path = None
+
+        if path is None:
+            path = _PathValue(os.environ.get(key, ""), delim)
+            self._paths[key] = path
+            self._record(lambda: self._paths.pop(key, None))
+
+        if self._marks:
+            self._record(self._flagRestorer(path))
+        path.prependDelim, path.appendDelim = prependDelim, appendDelim
+
+        ranks = path.ranks
+        for value in values:
+            if self._marks:
+                self._record(self._rankRestorer(ranks, value))
+
+            if remove:
+                ranks.pop(value, None)
+            elif append:
+                if value not in ranks:
+                    path.hi += 1
+                    ranks[value] = path.hi
+            else:
+                path.lo -= 1
+                ranks[value] = path.lo
+
+        if self._depth == 0:
+            self._flushPath(key)
+
+    def checkpoint(self):
+        """
+        remember the current state, so that the changes made after this
+        call can be undone by rollback() (or accepted by release())
+        """
+        self._marks.append(len(self._undo))
+
+    def rollback(self):
+        """
+        undo all the changes made since the last checkpoint()
+        """
+        mark = self._marks.pop()
+        while len(self._undo) > mark:
+            self._undo.pop()()
+
+        if not self._marks:
+            del self._undo[:]
+
+    def release(self):
+        """
+        accept all the changes made since the last checkpoint()
+        """
+        self._marks.pop()
+
+        if not self._marks:
+            del self._undo[:]
+
+    def _record(self, undo):
+        # record how to undo a change, if we'll ever need to
+        if self._marks:
+            self._undo.append(undo)
+
+    def _flagRestorer(self, path):
+        # return a function to restore whether path starts or ends with a delimiter
+        prependDelim, appendDelim = path.prependDelim, path.appendDelim
+
+        def restore():
+            path.prependDelim, path.appendDelim = prependDelim, appendDelim
+
+        return restore
+
+    def _rankRestorer(self, ranks, value):
+        # return a function to restore the rank of an element of a path (the ranks
+        # of the other elements aren't changed, so there's no need to restore lo/hi)
+        old = ranks.get(value)
+
+        def restore():
+            if old is None:
+                ranks.pop(value, None)
+            else:
+                ranks[value] = old
+
+        return restore
+
+    def _setEnviron(self, key, val):
+        # set (or if val is None unset) a variable in os.environ
+        if self._marks:
+            old = os.environ.get(key)
+            self._undo.append(lambda: self._setEnviron(key, old))
+
+        if val is None:
+            os.environ.pop(key, None)
+        else:
+            os.environ[key] = val
+
+    def _discardPath(self, key):
+        # forget the value of a path-like variable that's being built
+        path = self._paths.pop(key, None)
+        if path is not None:
+            self._record(lambda: self._paths.__setitem__(key, path))
+
+    def _flushPath(self, key):
+        # write the value of a path-like variable that's being built to os.environ
+        path = self._paths[key]
+        self._discardPath(key)
+        self._setEnviron(key, str(path))
+
+# the names of the variables that describe how products were setup
+_setupPrefix = utils.setupEnvPrefix()
+_setupVarRe = re.compile(r"^%s(\w+)$" % _setupPrefix)
@@ -3,6 +3,7 @@ The Eups class
 """
 from __future__ import absolute_import, print_function
 import glob
+import hashlib
 import re
 import os
 import shutil
@@ -10,6 +11,7 @@ import sys
 import filecmp
 import fnmatch
 import tempfile
+import time
 import zlib
 
 from . import utils
@@ -20,6 +22,9 @@ from .exceptions import ProductNotFound, EupsException, TableError, TableFileNot
 from .table      import Table, Action
 from .Product    import Product
 from .Uses       import Uses
+from .VersionCompare import sortVersions
+from .VersionParser import compileVersionExpr
+from .EnvBuilder import EnvBuilder
 from .utils      import cmp_or_key, xrange, cmp
 from . import hooks
 
@@ -112,7 +117,7 @@ class Eups(object):
                  keep=False, max_depth=-1, preferredTags=None,
                  # above is the backward compatible signature
                  userDataDir=None, asAdmin=False, setupType=[], validSetupTypes=None, vro={},
-                 exact_version=None, cmdName=None
+                 exact_version=None, cmdName=None, verifyCache=False, readOnlyCache=False
                  ):
         """
         @param path             the colon-delimited list of product stack
@@ -141,6 +146,12 @@ class Eups(object):
         @param preferredTags      List of tags to process in order; None will be intepreted as the default
         @param exact_version      Where possible, use the exact versions that were previously declared
         @param cmdName            The command being run, if known (used for diagnostics)
+        @param verifyCache        Check the product caches against every file in the
+                                  databases rather than trusting the databases' journals
+        @param readOnlyCache      If readCache is False, use the product caches anyway where they
+                                  can be cheaply brought up to date, but never write to them (so no
+                                  lock on them is needed).  Products in stacks without a usable
+                                  cache are read from the databases.
         """
 
         self.verbose = verbose
@@ -252,6 +263,12 @@ class Eups(object):
         self._msgs = {}                 # used to suppress messages
         self._msgs["setup"] = {}        # used to suppress messages about setups
 
+        self._setupRecord = None        # what a setup did, if it's being recorded; see SetupCache
+        self.environ = EnvBuilder()     # the environment that setup() builds
+        self._setupProducts = {}        # cache for findSetupProduct()
+        self._vroPlan = None            # the compiled VRO used by findProductFromVRO()
+        self._vroLookups = None         # cache for findProductFromVRO()'s lookups during a setup
+
         self._stacks = {}               # used for saving/restoring state
         self._stacks["env"] = []        # environment that we'll setup
         self._stacks["vro"] = []        # the VRO
@@ -305,6 +322,7 @@ class Eups(object):
 
         self.userDataDir = userDataDir
         self.asAdmin = asAdmin
+        self.verifyCache = verifyCache
 
         #
         # Get product information:
@@ -316,6 +334,9 @@ class Eups(object):
         if readCache:
           for p in self.path:
               self._setProductStack_fromCache(p, neededFlavors)
+        elif readOnlyCache:
+          for p in self.path:
+              self._setProductStack_fromCacheReadOnly(p, neededFlavors)
         #
         #
         fallbackList = hooks.config.Eups.fallbackFlavors
@@ -446,7 +467,8 @@ The what argument tells us what sort of state is expected (allowed values are de
             raise RuntimeError("Programming error: attempt to use stack \"%s\"" % what)
 
         if what == "env":
-            current = os.environ.copy()
+            current = None
+            self.environ.checkpoint()
         elif what == "vro":
             current = self.getPreferredTags()
             if value:
@@ -472,7 +494,7 @@ The what argument tells us what sort of state is expected (allowed values are de
             raise RuntimeError("Programming error: stack \"%s\" doesn't have an element to pop" % what)
 
         if what == "env":
-            os.environ = value
+            self.environ.rollback()
         elif what == "vro":
             self.setPreferredTags(value)
         elif what == "verbose":
@@ -493,6 +515,9 @@ The what argument tells us what sort of state is expected (allowed values are de
         except IndexError:
             raise RuntimeError("Programming error: stack \"%s\" doesn't have an element to drop" % what)
 
+        if what == "env":
+            self.environ.release()
+
         self.__showStack("drop", what)
 
     def __showStack(self, op, what):
@@ -692,6 +717,7 @@ The what argument tells us what sort of state is expected (allowed values are de
                 print("Warning: No recognized tags; not updating preferred list", file=utils.stdwarn)
         else:
             self.preferredTags = tags
+            self._vroPlan = None
 
     def getPreferredTags(self):
         """
@@ -821,38 +847,40 @@ The what argument tells us what sort of state is expected (allowed values are de
 
         if not vro:
             vro = self.getPreferredTags()
+        plan = self._compileVRO(vro)
+        dirsKey = tuple(eupsPathDirs)
 
-        for i, vroTag in enumerate(vro):
-            vroTag0 = vroTag            # we may modify vroTag
-
-            preVro =  vro[0    :i]
-            postVro = vro[i + 1:]
+        for entry in plan:
+            vroTag = vroTag0 = entry.tag # we may modify vroTag
+            kind = entry.kind
+            if kind == "keep" and recursionDepth == 0:
+                kind = entry.fallback
 
-            if vroTag in ("path"):
+            if kind == "path":
                 continue
 
-            elif recursionDepth > 0 and vroTag in ("keep",):
+            elif kind == "keep":
                 product = self.alreadySetupProducts.get(name)
                 if product:
                     product = product[0]
                     vroReason = [vroTag, None]
                     break
 
-            elif vroTag == "commandLine":
+            elif kind == "commandLine":
                 if name in self.alreadySetupProducts: # name is already setup
                     oproduct, ovroReason = self.alreadySetupProducts[name]
                     if ovroReason and ovroReason[0] == "commandLine":
                         product, vroReason = oproduct, ovroReason
                         break
 
-            elif vroTag in ("version", "version!", "versionExpr",):
+            elif kind == "version":
 
                 if not version or self.ignore_versions:
                     continue
 
                 if self.isLegalRelativeVersion(version): # version is actually a versionExpr
                     if vroTag in ("version", "version!",):
-                        if "versionExpr" in postVro:
+                        if entry.exprFollows:
                             continue
                         else:
                             print("Failed to find %s %s for flavor %s" % \
@@ -863,8 +891,10 @@ The what argument tells us what sort of state is expected (allowed values are de
 
                 if vroTag == "versionExpr" and versionExpr:
                     if self.isLegalRelativeVersion(versionExpr):  # raises exception if bad syntax used
-                        products = self._findProductsByExpr(name, versionExpr, eupsPathDirs, flavor, noCache)
-                        product = self._selectPreferredProduct(products, ["latest"])
+                        product = self._lookupForVRO(("versionExpr", name, versionExpr, dirsKey, flavor, noCache),
+                                                     lambda: self._selectPreferredProduct(
+                                                         self._findProductsByExpr(name, versionExpr, eupsPathDirs,
+                                                                                  flavor, noCache), ["latest"]))
 
                         if product:
                             vroReason = [vroTag, versionExpr]
@@ -875,30 +905,11 @@ The what argument tells us what sort of state is expected (allowed values are de
                 # Search path for an explicit version
                 #
                 vroTag = "version"
-                for root in eupsPathDirs:
-                    if noCache or root not in self.versions or not self.versions[root]:
-                        # go directly to the EUPS database
-                        if not os.path.exists(self.getUpsDB(root)):
-                            if self.verbose:
-                                print("Skipping missing EUPS stack:", self.getUpsDB(root), file=utils.stdwarn)
-                            continue
-
-                        try:
-                            product = self._databaseFor(root).findProduct(name, version, flavor)
-                            if product:
-                                vroReason = [vroTag, version]
-                                break
-                        except ProductNotFound:
-                            product = None
-                    else:
-                        # consult the cache
-                        try:
-                            self.versions[root].ensureInSync(verbose=self.verbose)
-                            product = self.versions[root].getProduct(name, version, flavor)
-                            vroReason = [vroTag, version]
-                            break
-                        except ProductNotFound:
-                            pass
+                product = self._lookupForVRO(("version", name, version, dirsKey, flavor, noCache),
+                                             lambda: self._findVersionedProduct(name, version, eupsPathDirs,
+                                                                                flavor, noCache))
+                if product:
+                    vroReason = [vroTag, version]
 
                 if not product and \
                        version is not None and version.startswith(Product.LocalVersionPrefix):
@@ -913,14 +924,16 @@ The what argument tells us what sort of state is expected (allowed values are de
                     if recursionDepth == 0:
                         vroReason[0] = "commandLine"
                 else:
-                    if not ("version" in postVro or "version!" in postVro or "versionExpr" in postVro):
+                    if not entry.versionFollows:
                         if self.verbose > self.quiet:
                             print("Failed to find %s %s for flavor %s" % \
                                   (name, version, flavor), file=utils.stdwarn)
                         break
 
-            elif re.search(r"^warn(:\d+)?$", vroTag):
-                debugLevel = int(vroTag.split(":")[1])
+            elif kind == "warn":
+                debugLevel = entry.debugLevel
+                if debugLevel is None:
+                    debugLevel = int(vroTag.split(":")[1])
 
                 if optional:
                     debugLevel += 2
@@ -939,31 +952,38 @@ The what argument tells us what sort of state is expected (allowed values are de
                         indent = ""
 
                     msg = "%sVRO [%s] failed to match for %s version %s" % \
-                          (indent, ", ".join([x for x in preVro if not re.search(r"^warn(:\d+)?$", x)]),
-                           name, vname,)
-                    if postVro:
-                        msg += "; trying [%s]" % \
-                               (", ".join([x for x in postVro if not re.search(r"^warn(:\d+)?$", x)]))
+                          (indent, entry.preVro, name, vname,)
+                    if entry.postVro is not None:
+                        msg += "; trying [%s]" % (entry.postVro)
                     if flavor:
                         msg += " (Flavor: %s)" % flavor
 
                     print(msg, file=sys.stderr)
 
-            elif self.tags.isRecognized(vroTag) or os.path.isfile(vroTag):
+            elif kind == "file":
                 # search for a tagged version
-                if os.path.isfile(vroTag):
-                    product = self._findTaggedProductFromFile(name, vroTag, eupsPathDirs, flavor, noCache)
-                else:
-                    product = self._findTaggedProduct(name, self.tags.getTag(vroTag), eupsPathDirs,
-                                                  flavor, noCache)
+                product = self._lookupForVRO(("file", name, vroTag, dirsKey, flavor, noCache),
+                                             lambda: self._findTaggedProductFromFile(name, vroTag, eupsPathDirs,
+                                                                                     flavor, noCache))
+                if not product:
+                    continue
 
+                vroReason = [vroTag, None]
+
+            elif kind == "tag":
+                # search for a tagged version
+                lookup = lambda: self._findTaggedProduct(name, entry.value, eupsPathDirs, flavor, noCache)
+                if entry.memo:
+                    product = self._lookupForVRO(("tag", name, vroTag, dirsKey, flavor, noCache), lookup)
+                else:
+                    product = lookup()
                 if not product:
                     continue
 
                 vroReason = [vroTag, None]
 
-            elif re.search(r"^type:(.+)$", vroTag):
-                setupType = vroTag.split(":")[1]
+            elif kind == "type":
+                setupType = entry.value
                 self.setupType += [setupType]
 
                 if setupType == "exact":
@@ -972,9 +992,6 @@ The what argument tells us what sort of state is expected (allowed values are de
 
             else:
                 print("Impossible entry on the VRO %s (%s)" % (vroTag, vro), file=utils.stderr)
-                if False:
-                    product = self.findProduct(name, version=Tag(vroTag), eupsPathDirs=eupsPathDirs,
-                                               flavor=flavor, noCache=noCache)
 
             if product:
                 break
@@ -1020,6 +1037,102 @@ The what argument tells us what sort of state is expected (allowed values are de
 
         return [product, vroReason]
 
+    def _compileVRO(self, vro):
+        """
+        Return a list of _VroEntry describing each element of the VRO, so that
+        findProductFromVRO() doesn't have to reinterpret the VRO for every product.
+        The last VRO compiled is remembered.
+        """
+        key = tuple(vro)
+        if self._vroPlan and self._vroPlan[0] == key:
+            return self._vroPlan[1]
+
+        plan = []
+        for i, vroTag in enumerate(vro):
+            entry = _VroEntry(vroTag)
+            preVro = vro[0    :i]
+            postVro = vro[i + 1:]
+
+            if vroTag in ("path"):
+                entry.kind = "path"
+            elif vroTag == "commandLine":
+                entry.kind = vroTag
+            elif vroTag in ("version", "version!", "versionExpr",):
+                entry.kind = "version"
+                entry.exprFollows = "versionExpr" in postVro
+                entry.versionFollows = "version" in postVro or "version!" in postVro or "versionExpr" in postVro
+            elif _warnVroRe.search(vroTag):
+                entry.kind = "warn"
+                if ":" in vroTag:
+                    entry.debugLevel = int(vroTag.split(":")[1])
+                entry.preVro = ", ".join([x for x in preVro if not _warnVroRe.search(x)])
+                if postVro:
+                    entry.postVro = ", ".join([x for x in postVro if not _warnVroRe.search(x)])
+            elif os.path.isfile(vroTag):
+                entry.kind = "file"
+            elif self.tags.isRecognized(vroTag):
+                entry.kind = "tag"
+                entry.value = self.tags.getTag(vroTag)
+                entry.memo = entry.value.name != "setup" # the setup products change during a setup
+            elif re.search(r"^type:(.+)$", vroTag):
+                entry.kind = "type"
+                entry.value = vroTag.split(":")[1]
+
+            if vroTag == "keep":        # only special below the toplevel; otherwise it's a tag
+                entry.kind, entry.fallback = "keep", entry.kind
+
+            plan.append(entry)
+
+        self._vroPlan = (key, plan)
+
+        return plan
+
+    def _lookupForVRO(self, key, lookup):
+        # Return lookup(), reusing the answer for the same key if we're in the middle of a setup
+        if self._vroLookups is None:
+            return lookup()
+
+        try:
+            return self._vroLookups[key]
+        except KeyError:
+            product = lookup()
+            self._vroLookups[key] = product
+            return product
+
+    def _forgetProducts(self):
+        # Forget the products that we've looked up, as they may have been (un)declared or (un)tagged
+        self._setupProducts.clear()
+        if self._vroLookups is not None:
+            self._vroLookups.clear()
+
+    def _findVersionedProduct(self, name, version, eupsPathDirs, flavor, noCache):
+        # Search the eupsPathDirs for an explicit version of a product, returning None if it isn't found
+        for root in eupsPathDirs:
+            if noCache or root not in self.versions or not self.versions[root]:
+                # go directly to the EUPS database
+                if not os.path.exists(self.getUpsDB(root)):
+                    if self.verbose:
+                        print("Skipping missing EUPS stack:", self.getUpsDB(root), file=utils.stdwarn)
+                    continue
+
+                try:
+                    product = self._databaseFor(root).findProduct(name, version, flavor)
+                except ProductNotFound:
+                    product = None
+
+                if product:
+                    return product
+
+            else:
+                # consult the cache
+                try:
+                    self.versions[root].ensureInSync(verbose=self.verbose)
+                    return self.versions[root].getProduct(name, version, flavor)
+                except ProductNotFound:
+                    pass
+
+        return None
+
     def findProduct(self, name, version=None, eupsPathDirs=None, flavor=None,
                     noCache=False):
         """
@@ -1066,31 +1179,7 @@ The what argument tells us what sort of state is expected (allowed values are de
             return self._findTaggedProduct(name, version, eupsPathDirs, flavor, noCache)
 
         # search path for an explicit version
-        for root in eupsPathDirs:
-            if noCache or root not in self.versions or not self.versions[root]:
-                # go directly to the EUPS database
-                if not os.path.exists(self.getUpsDB(root)):
-                    if self.verbose:
-                        print("Skipping missing EUPS stack:", self.getUpsDB(root), file=utils.stdwarn)
-                    continue
-
-                try:
-                    product = self._databaseFor(root).findProduct(name, version, flavor)
-                except ProductNotFound:
-                    product = None
-
-                if product:
-                    return product
-
-            else:
-                # consult the cache
-                try:
-                    self.versions[root].ensureInSync(verbose=self.verbose)
-                    return self.versions[root].getProduct(name, version, flavor)
-                except ProductNotFound:
-                    pass
-
-        return None
+        return self._findVersionedProduct(name, version, eupsPathDirs, flavor, noCache)
 
     def findTaggedProduct(self, name, tag, eupsPathDirs=None, flavor=None,
                           noCache=False):
@@ -1313,7 +1402,7 @@ The what argument tells us what sort of state is expected (allowed values are de
                 # consult the cache
                 try:
                     vers = self.versions[root].getVersions(name, flavor)
-                    vers.sort(**cmp_or_key(self.version_cmp))
+                    sortVersions(vers, self.version_cmp)
                     if len(vers) == 0:
                         continue
 
@@ -1391,7 +1480,7 @@ The what argument tells us what sort of state is expected (allowed values are de
             if tag.name == "latest":
                 # find the latest version; first order the versions
                 vers = [p.version for p in products]
-                vers.sort(**cmp_or_key(self.version_cmp))
+                sortVersions(vers, self.version_cmp)
 
                 # select the product with the latest version
                 if len(vers) > 0:
@@ -1494,18 +1583,35 @@ The what argument tells us what sort of state is expected (allowed values are de
                                                         persistDir=cacheDir,
                                                         userTagDir=userCacheDir,
                                                         updateCache=True, autosave=False,
+                                                        verify=self.verifyCache,
+                                                        cacheFormat=hooks.config.Eups.cacheFormat,
                                                         verbose=self.verbose)
 
+    def _setProductStack_fromCacheReadOnly(self, dataDir, neededFlavors):
+        # the product cache, if there is one that's usable without writing to it.  If not, the
+        # product info will be read from the database as needed
+        dbpath = self.getUpsDB(dataDir)
+        userCacheDir = self._userStackCache(dataDir)
+        cacheDir = userCacheDir
+        if self.asAdmin and utils.isDbWritable(dataDir):
+            cacheDir = dbpath
+
+        stack = ProductStack.fromCacheReadOnly(dbpath, neededFlavors, persistDir=cacheDir,
+                                               userTagDir=userCacheDir, verify=self.verifyCache,
+                                               verbose=self.verbose)
+        if stack:
+            self.versions[dataDir] = stack
+        elif self.verbose > 1:
+            print("No usable product cache for %s; reading the database" % dataDir, file=utils.stdinfo)
+
     def getSetupProducts(self, requestedProductName=None):
         """Return a list of all Products that are currently setup (or just the specified product)"""
 
-        re_setup = re.compile(r"^%s(\w+)$" % utils.setupEnvPrefix())
-
         productList = []
 
-        for key in [k for k in os.environ.keys() if re.search(re_setup, k)]:
+        for key, value in list(self.environ.setupVariables().items()):
             try:
-                productInfo = os.environ[key].split()
+                productInfo = value.split()
                 productName = productInfo[0]
             except IndexError:          # Oh dear;  "$setupEnvPrefix()_productName" must be malformed
                 continue
@@ -1548,33 +1654,81 @@ The what argument tells us what sort of state is expected (allowed values are de
         return a Product instance for a currently setup product.  None is
         returned if a product with the given name is not currently setup.
         """
+        if not environ:
+            # the answer only depends on the product's SETUP_ and _DIR variables, so it
+            # can be reused until they change (or the products are redeclared or retagged)
+            state = (os.environ.get(self._envarSetupName(productName)),
+                     os.environ.get(self._envarDirName(productName)))
+            if state[0] is None:
+                return None
+
+            cached = self._setupProducts.get(productName)
+            if cached and cached[0] == state:
+                return cached[1]
+
         versionName, eupsPathDir, productDir, tablefile, flavor = \
             self.findSetupVersion(productName, environ)
         if versionName is None:
             return None
 
         if versionName.startswith(Product.LocalVersionPrefix): # they setup -r
-            return Product(productName, versionName, flavor, productDir,
-                           tablefile, db=self.getUpsDB(eupsPathDir))
+            product = Product(productName, versionName, flavor, productDir,
+                              tablefile, db=self.getUpsDB(eupsPathDir))
         else:                           # a real product, fully identified by a version (and flavor, -Z)
-            return self.findProduct(productName, versionName, eupsPathDirs=[eupsPathDir],
-                                    flavor=flavor, noCache=False)
+            product = self.findProduct(productName, versionName, eupsPathDirs=[eupsPathDir],
+                                       flavor=flavor, noCache=False)
+
+        if not environ and product:
+            self._setupProducts[productName] = (state, product)
+
+        return product
 
     def setEnv(self, key, val, interpolateEnv=False):
         """Set an environmental variable"""
 
         if interpolateEnv:              # replace ${ENV} by its value if known
-            val = re.sub(r"(\${([^}]*)})", lambda x : os.environ.get(x.group(2), x.group(1)), val)
+            val = self._interpolateEnv(val)
 
         if val == None:
             val = ""
-        os.environ[key] = val
+        self.environ.set(key, val)
+        if self._setupRecord is not None:
+            self._setupRecord["variables"].add(key)
 
     def unsetEnv(self, key):
         """Unset an environmental variable"""
 
-        if key in os.environ:
-            del os.environ[key]
+        if self._setupRecord is not None:
+            self._setupRecord["variables"].add(key)
+        self.environ.unset(key)
+
+    def editPath(self, key, values, delim=":", append=False, remove=False,
+                 prependDelim=False, appendDelim=False):
+        """
+        Add elements to (or remove them from) a delimited environmental
+        variable such as PATH, removing any duplicates.  During a setup the
+        value is only written to os.environ when the setup is complete.
+        @param key          the name of the variable
+        @param values       a list of the elements to add or remove; any ${ENV}
+                              in them is replaced by its value if known
+        @param delim        the delimiter between the elements
+        @param append       add the elements at the end rather than the start
+        @param remove       remove the elements rather than adding them
+        @param prependDelim if True, the value should start with a delimiter
+        @param appendDelim  if True, the value should end with a delimiter
+        """
+        values = [self._interpolateEnv(v) for v in values]
+
+        self.environ.editPath(key, values, delim, append=append, remove=remove,
+                              prependDelim=prependDelim, appendDelim=appendDelim)
+        if self._setupRecord is not None:
+            self._setupRecord["variables"].add(key)
+
+    def _interpolateEnv(self, val):
+        # replace ${ENV} in val by its value if known
+        if val is None or "${" not in val:
+            return val
+        return re.sub(r"(\${([^}]*)})", lambda x : self.environ.get(x.group(2), x.group(1)), val)
 
     def setAlias(self, key, val):
         """Set an alias.  The value is in sh syntax --- we'll mangle it for csh later"""
@@ -1677,58 +1831,7 @@ The what argument tells us what sort of state is expected (allowed values are de
     def version_match(self, vname, expr):
         """Return vname if it matches the logical expression expr"""
 
-        expr0 = expr
-        expr = [x for x in re.split(r"\s*(%s|\|\||\s)\s*" % self._relop_re.pattern, expr0) if not re.search(r"^\s*$", x)]
-
-        logop = None                    # the next logical operation to process
-        value = None                    # the value of the current term (e.g. ">= 2.0.0")
-        i = -1
-        while i < len(expr) - 1:
-            i += 1
-
-            if self._relop_re.search(expr[i]):
-                relop = expr[i]; i += 1
-                v = expr[i]
-            elif re.search(r"^[-+.:/\w]+$", expr[i]) and expr[i] not in ("and", "or"):
-                relop = "=="
-                v = expr[i]
-            elif expr[i] == "||" or expr[i] == "or":
-                logop = "or"
-                continue
-            elif expr[i] == "&&" or expr[i] == "and":
-                if not value:
-                    return False        # short circuit
-
-                logop = "and"
-                continue
-            else:
-                print("Unexpected operator %s in \"%s\"" % (expr[i], expr0), file=utils.stdwarn)
-                break
-
-            if not logop and value is not None:
-                print("Expected logical operator || or && in \"%s\" at %s" % (expr0, v), file=utils.stdwarn)
-            else:
-                try:
-                    rhs = self.version_match_prim(relop, vname, v)
-                    if not logop:
-                        value = rhs
-                    elif logop == "and":
-                        if value and rhs:
-                            value = True
-                        else:
-                            value = False
-                    elif logop == "or":
-                        if value or rhs:
-                            return vname
-
-                        value = False
-                except ValueError:           # no sort order is defined
-                    return None
-
-        if value:
-            return vname
-        else:
-            return None
+        return compileVersionExpr(expr).match(vname, self.version_match_prim)
 
     def version_match_prim(self, op, v1, v2):
         """
@@ -1799,7 +1902,27 @@ The what argument tells us what sort of state is expected (allowed values are de
         @param tablefile        use this table file to setup the product
         @param versionExpr      An expression specifying the desired version
         @param implicitProduct  True iff product is setup due to being specified in implicitProducts
+
+        The values of path-like variables (e.g. PATH) are built up by the
+        whole (recursive) setup, and only written to os.environ when it's
+        complete.
         """
+        outermost = self._vroLookups is None
+        if outermost:                   # remember what findProductFromVRO() finds until we're done
+            self._vroLookups = {}
+
+        self.environ.begin()
+        try:
+            return self._setup(productName, versionName, fwd, recursionDepth, setupToplevel, noRecursion,
+                               productRoot, tablefile, versionExpr, optional, implicitProduct)
+        finally:
+            self.environ.end()
+            if outermost:
+                self._vroLookups = None
+
+    def _setup(self, productName, versionName, fwd, recursionDepth, setupToplevel, noRecursion,
+               productRoot, tablefile, versionExpr, optional, implicitProduct):
+        # The guts of setup()
 
         if utils.is_string(versionName) and versionName.startswith(Product.LocalVersionPrefix):
             productRoot = versionName[len(Product.LocalVersionPrefix):]
@@ -1955,6 +2078,8 @@ The what argument tells us what sort of state is expected (allowed values are de
             print("Warning: %s" % e, file=utils.stdwarn)
 
         if table:
+            if self._setupRecord is not None:
+                self._setupRecord["tables"].append(table.file)
             try:
                 verbose = self.verbose
                 if not fwd:
@@ -2084,6 +2209,8 @@ The what argument tells us what sort of state is expected (allowed values are de
         if localProduct:
             localTable = localProduct.getTable(quiet=True)
             if localTable:
+                if self._setupRecord is not None:
+                    self._setupRecord["tables"].append(localTable.file)
                 localActions = localTable.actions(setupFlavor, setupType=self.setupType, verbose=verbose)
             else:
                 localActions = []
@@ -2097,11 +2224,6 @@ The what argument tells us what sort of state is expected (allowed values are de
         if recursionDepth == 0:            # we can cleanup
             if fwd:
                 del self._msgs["setup"]
-        #
-        # we made a copy of os.environ so the usual magic putenv doesn't happen
-        #
-        for key, val in os.environ.items():
-            os.putenv(key, val)
 
         return True, product.version, None
 
@@ -2122,6 +2244,7 @@ The what argument tells us what sort of state is expected (allowed values are de
         @param productName   the name of the product to tag
         @param versionName   the version of the product
         """
+        self._forgetProducts()          # the products may be (un)declared or (un)tagged
         # convert tag name to a Tag instance; may raise TagNotRecognized
         tag = self.tags.getTag(tag)
 
@@ -2182,6 +2305,7 @@ The what argument tells us what sort of state is expected (allowed values are de
                                  the first product in the stack with that tag
                                  will be chosen.
         """
+        self._forgetProducts()          # the products may be (un)declared or (un)tagged
         # convert tag name to a Tag instance; may raise TagNotRecognized
         tag = self.tags.getTag(tag)
 
@@ -2323,6 +2447,7 @@ The what argument tells us what sort of state is expected (allowed values are de
         @param declareCurrent  DEPRECATED, if True and tag=None, it is
                                equivalent to tag="current".
         """
+        self._forgetProducts()          # the products may be (un)declared or (un)tagged
         if re.search(r"[^a-zA-Z_0-9]", productName):
             raise EupsException("Product names may only include the characters [a-zA-Z_0-9]: saw %s" % productName)
 
@@ -2761,6 +2886,7 @@ The what argument tells us what sort of state is expected (allowed values are de
         @param undeclareCurrent  DEPRECATED; if True, and tag is None, this
                                 is equivalent to tag="current".
         """
+        self._forgetProducts()          # the products may be (un)declared or (un)tagged
         # this is for backward compatibility
         if isinstance(tag, bool) or (tag is None and undeclareCurrent):
             tag = "current"
@@ -2870,6 +2996,24 @@ The what argument tells us what sort of state is expected (allowed values are de
         @param flavors       restrict products to these flavors; if None,
                                the current flavor and all fallback flavors
                                will be searched.
+
+        See also iterProducts()
+        """
+        return list(self.iterProducts(name, version, tags, eupsPathDirs, flavors))
+
+    def iterProducts(self, name=None, version=None, tags=None,
+                     eupsPathDirs=None, flavors=None):
+        """
+        Generate the Product objects for products we know about with
+        given restrictions, one product name at a time in alphabetical
+        order.  The products with a given name are generated in the order
+        of the stacks in eupsPathDirs (and of the flavors), with the
+        versions in each stack in order.  This is the same selection as
+        findProducts(), but the products are only looked up as they're
+        needed, so a long listing can start before the whole stack has
+        been searched.
+
+        The parameters are the same as for findProducts().
         """
         if flavors is None:
             flavors = utils.Flavor().getFallbackFlavors(self.flavor, True)
@@ -2898,8 +3042,6 @@ The what argument tells us what sort of state is expected (allowed values are de
 
         prodkey = lambda p: "%s:%s:%s:%s" % (p.name,p.flavor,p.db,p.version)
         tagset = _TagSet(self, tags)
-        out = []
-        latest = None
 
         # first get all the currently setup products.  We will integrate these
         # into the list
@@ -2930,26 +3072,39 @@ The what argument tells us what sort of state is expected (allowed values are de
         if not isinstance(eupsPathDirs, list):
             eupsPathDirs = [eupsPathDirs]
 
-        # start by iterating through each stack path
+        # the stacks to search, and the names of the products of interest
+        # (including any that are only setup)
+        stacks = []
+        prodnames = set([p.name for p in setup.values()])
         for d in eupsPathDirs:
             if d not in self.versions:
                 continue
             stack = self.versions[d]
             stack.ensureInSync(verbose=self.verbose)
 
-            # iterate through the flavors of interest
             haveflavors = stack.getFlavors()
-            for flavor in flavors:
-                if flavor not in haveflavors:
-                    continue
-
-                # match the product name
-                prodnames = stack.getProductNames(flavor)
+            stackflavors = [f for f in flavors if f in haveflavors]
+            for flavor in stackflavors:
                 if name:
-                    prodnames = list(fnmatch.filter(prodnames, name))
-                prodnames.sort()
+                    prodnames.update(fnmatch.filter(stack.getProductNames(flavor), name))
+                else:
+                    prodnames.update(stack.getProductNames(flavor))
+            stacks.append((d, stack, stackflavors))
+
+        addLocal = not version or \
+                   (isinstance(version,str) and version.startswith(Product.LocalVersionPrefix)) or \
+                   (tags and "setup" in tags)
+
+        for pname in sorted(prodnames):
+            out = []
+            latest = None
+
+            # iterate through each stack path, and the flavors of interest
+            for d, stack, stackflavors in stacks:
+                for flavor in stackflavors:
+                    if not stack.hasProduct(pname, flavor):
+                        continue
 
-                for pname in prodnames:
                     if tags:
                         for t in tags:
                             if t == "latest":
@@ -2966,7 +3121,7 @@ The what argument tells us what sort of state is expected (allowed values are de
                             vers = [v for v in vers if self.version_match(v, version)]
                         else:
                             vers = list(fnmatch.filter(vers, version))
-                    vers.sort(**cmp_or_key(self.version_cmp))
+                    sortVersions(vers, self.version_cmp)
 
                     # only include latest if it passes the version constraint
                     if latest is not None and latest.version not in vers:
@@ -3014,34 +3169,23 @@ The what argument tells us what sort of state is expected (allowed values are de
                         out.append(setup[key])
                         del setup[key]
 
-        if version:
-            if self.isLegalRelativeVersion(version):
-                out = [p for p in out if self.version_match(p.version, version)]
-            else:
-                out = [p for p in out if fnmatch.fnmatch(p.version, version)]
-
-        if not version or \
-           (isinstance(version,str) and version.startswith(Product.LocalVersionPrefix)) or \
-           (tags and "setup" in tags):
+            if version:
+                if self.isLegalRelativeVersion(version):
+                    out = [p for p in out if self.version_match(p.version, version)]
+                else:
+                    out = [p for p in out if fnmatch.fnmatch(p.version, version)]
 
-            # Add in LOCAL: setups
-            #
-            sunames = list(setup.keys())
-            sunames.sort()
-            for pname in sunames:
-                prod = setup[pname]
-                if name and not fnmatch.fnmatch(prod.name, name):
-                    continue
-                if version and not fnmatch.fnmatch(prod.version, version):
-                    continue
-                out.append(prod)
+            if addLocal:
+                # Add in LOCAL: setups
+                #
+                for key in sorted([k for k in setup.keys() if setup[k].name == pname]):
+                    prod = setup.pop(key)
+                    if version and not fnmatch.fnmatch(prod.version, version):
+                        continue
+                    out.append(prod)
 
-        #
-        # Make productList entries uniq
-        #
-        productList = utils.uniq(out)
-
-        return productList
+            for prod in utils.uniq(out):
+                yield prod
 
     def dependencies_from_table(self, tablefile, eupsPathDirs=None):
         """Return self's dependencies as a list of (Product, optional, recursionDepth) tuples
@@ -3363,35 +3507,17 @@ The what argument tells us what sort of state is expected (allowed values are de
         if not productName and versionName:
             raise EupsException("You may not specify a version \"%s\" but not a product" % versionName)
 
-        old_exact_version = self.exact_version
-        self.exact_version = True       # we want to know exactly which versions were specified
-
-        # start with every known product
-        productList = self.findProducts()
-
-        if not productList:
-            return []
-
         if not usesInfo:
-            usesInfo = Uses()
-
-            for pi in productList:          # for every known product
-                try:
-                    deps = self.getDependentProducts(pi, shouldRaise=False, followExact=None, topological=True)
-                except TableError as e:
-                    if not self.quiet:
-                        print(("Warning: %s" % (e)), file=utils.stdwarn)
-                    continue
-
-                for dep_product, dep_optional, dep_depth in deps:
-                    assert not (pi.name == dep_product.name and pi.version == dep_product.version)
-
-                    usesInfo.remember(pi.name, pi.version, (dep_product.name, dep_product.version,
-                                                            dep_optional, dep_depth))
+            old_exact_version = self.exact_version
+            self.exact_version = True   # we want to know exactly which versions were specified
+            try:
+                usesInfo = self._getUsesInfo()
+            finally:
+                self.exact_version = old_exact_version
 
-            usesInfo.invert(depth)
+            if not usesInfo:            # there are no products
+                return []
 
-        self.exact_version = old_exact_version
         #
         # OK, we have the information stored away
         #
@@ -3400,6 +3526,120 @@ The what argument tells us what sort of state is expected (allowed values are de
 
         return usesInfo.users(productName, versionName)
 
+    def _usesInfoFile(self):
+        """
+        Return the file in the user's data directory that the dependencies of all the products
+        (as returned by uses()) are saved in, or None if they shouldn't be saved.  The name depends
+        on everything that affects which versions of products are found.
+        """
+        if not self.userDataDir:
+            return None
+
+        config = [self.flavor, self.path, sorted(set([str(t) for t in self.setupType])),
+                  [str(v) for v in (self._vro or [])], [str(t) for t in self.getPreferredTags()]]
+        return os.path.join(self.userDataDir, Uses.persistDirName,
+                            "%s.uses" % hashlib.md5(repr(config).encode("utf-8")).hexdigest())
+
+    def _getUsesDbState(self):
+        """
+        Return the state of the databases (including the user's tags) that the dependencies of
+        the products depend on, as a dictionary keyed by database directory
+        """
+        state = {}
+        for p in self.path:
+            for dbdir in (self.getUpsDB(p), self._userStackCache(p)):
+                if dbdir and os.path.isdir(dbdir):
+                    state[dbdir] = {"when" : time.time(), "journal" : Database(dbdir).getJournalState()}
+
+        return state
+
+    def _findUsesChanges(self, oldState, state):
+        """
+        Return the names of the products that have been declared, undeclared, or tagged since the
+        databases were in oldState, or None if this cannot be determined
+        """
+        if not oldState or sorted(oldState.keys()) != sorted(state.keys()):
+            return None
+
+        changed = set()
+        for dbdir in state.keys():
+            db = Database(dbdir)
+            names = db.findChangedProductNames(oldState[dbdir]["journal"])
+            if names is None:
+                # No journal to help us; all we can do is see whether anything's changed
+                if oldState[dbdir]["journal"] is not None or state[dbdir]["journal"] is not None or \
+                       db.isNewerThan(oldState[dbdir]["when"]):
+                    return None
+                names = []
+            changed.update(names)
+
+        return changed
+
+    def _getUsesInfo(self):
+        """
+        Return a Uses describing the dependencies of every known product, or None if there are no
+        products.
+
+        The Uses is saved in the user's data directory, and the next time that it's needed only the
+        products that have been declared, undeclared, or tagged since (and the products that depend
+        on them) are reanalysed.
+        """
+        usesFile = self._usesInfoFile()
+        state = self._getUsesDbState()
+
+        usesInfo, changed = None, None
+        if usesFile:
+            usesInfo = Uses.load(usesFile)
+            if usesInfo:
+                changed = self._findUsesChanges(usesInfo.state, state)
+
+        if changed is None:             # start from scratch
+            usesInfo = Uses()
+            productList = self.findProducts()
+            if not productList:
+                return None
+        elif not changed:
+            return usesInfo
+        else:
+            if self.verbose > 1:
+                print("Updating the saved dependencies of %s" % ", ".join(sorted(changed)), file=utils.stdinfo)
+
+            productList = []
+            for name in changed:
+                productList += self.findProducts(name)
+            for name, version in set(usesInfo.forgetUsersOf(changed)):
+                if name not in changed:
+                    productList += self.findProducts(name, version)
+
+        for pi in productList:          # for every product that needs analysing
+            usesInfo.rememberAnalysed(pi.name, pi.version)
+            try:
+                deps = self.getDependentProducts(pi, shouldRaise=False, followExact=None, topological=True)
+            except TableError as e:
+                if not self.quiet:
+                    print(("Warning: %s" % (e)), file=utils.stdwarn)
+                continue
+
+            for dep_product, dep_optional, dep_depth in deps:
+                assert not (pi.name == dep_product.name and pi.version == dep_product.version)
+
+                usesInfo.remember(pi.name, pi.version, (dep_product.name, dep_product.version,
+                                                        dep_optional, dep_depth))
+
+        usesInfo.invert(None)
+        usesInfo.state = state
+
+        if usesFile:
+            try:
+                if not os.path.isdir(os.path.dirname(usesFile)):
+                    os.makedirs(os.path.dirname(usesFile))
+                usesInfo.save(usesFile)
+            except (IOError, OSError) as e:
+                if self.verbose > 0:
+                    print("Unable to save product dependencies to %s: %s" % (usesFile, e), file=utils.stdwarn)
+
+        return usesInfo
+
     def supportServerTags(self, tags, eupsPathDir=None):
         """
         support the list of tags provided by a server.  This function will
@@ -3818,6 +4058,24 @@ such sequences can be generated while rewriting the VRO"""
 
 _ClassEups = Eups                       # so we can say, "isinstance(Eups, _ClassEups)"
 
+class _VroEntry(object):
+    """An element of the VRO, as interpreted by Eups._compileVRO()"""
+
+    def __init__(self, tag):
+        self.tag = tag                  # the element itself
+        self.kind = None                # the sort of element (None if it isn't recognised)
+        self.value = None               # the Tag, or the setup type, for "tag" and "type" entries
+        self.memo = True                # may the product found for a "tag" entry be remembered?
+        self.fallback = None            # the kind of a "keep" entry at the toplevel
+        self.exprFollows = False        # is there a versionExpr later in the VRO?
+        self.versionFollows = False     # is there a version, version! or versionExpr later in the VRO?
+        self.debugLevel = None          # the level of a warn:NN entry
+        self.preVro = None              # the non-warn entries before a warn entry
+        self.postVro = None             # the non-warn entries after a warn entry, if there are any
+
+# Matches warn or warn:NN in a VRO
+_warnVroRe = re.compile(r"^warn(:\d+)?$")
+
 
 class _TagSet(object):
     def __init__(self, eups, tags):
@@ -7,7 +7,7 @@ try:
 except ImportError:
     from ConfigParser import ConfigParser
 from . import table as mod_table
-from . import utils
+from . import utils, hooks
 from .exceptions import ProductNotFound, TableFileNotFound
 
 macrore = { "PROD_ROOT": re.compile(r"^\$PROD_ROOT\b"),
@@ -421,6 +421,7 @@ class Product(object):
                                         self.flavor)
             self._table = mod_table.Table(tablepath, self,
                                           addDefaultProduct=addDefaultProduct, verbose=verbose,
+                                          cacheDir=self._tableCacheDir(),
                                           ).expandEupsVariables(self, quiet)
 
             if self._prodStack and self.name and self.version and self.flavor:
@@ -433,6 +434,24 @@ class Product(object):
 
         return self._table
 
+    def _tableCacheDir(self):
+        """
+        return the directory where compiled table files should be kept:  next
+        to the user's cache of the products in this product's stack.  None
+        is returned if tables shouldn't be cached.
+        """
+        if not hooks.config.Eups.tableCache:
+            return None
+
+        root = self.stackRoot()
+        if not root:
+            return None
+
+        cacheDir = utils.userStackCacheFor(root)
+        if not cacheDir:
+            return None
+        return os.path.join(cacheDir, mod_table.Table.cacheDirName)
+
     def getConfig(self, section="DEFAULT", option=None, getType=None):
         """Return the product's ConfigParser, which will be empty if the file doesn't exist"""
 
@@ -0,0 +1,285 @@
+"""
+the SetupCache class -- a persistent record of the changes that setting up a
+product made to the environment, so that the same request can be replayed
+without resolving its dependencies or reading any table files.
+"""
+from __future__ import absolute_import, print_function
+import os, re, hashlib
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+from . import utils
+from .tags import Tag, tagListFileRe
+from .db.Database import journalFile
+
+class SetupCache(object):
+    """
+    a persistent cache of the results of setup requests.
+
+    An entry records the changes that a request made to the environment
+    variables and shell aliases.  It is keyed by everything that goes into
+    resolving the request: the request itself, the flavor, EUPS_PATH, VRO
+    and setup type, and the state of the databases (and their user tag
+    databases) in EUPS_PATH, so any declaration or tag assignment leads to
+    a new key.  An entry is only replayed if the table files that were
+    read are unchanged, and if the current values of the environment
+    variables that the setup read or wrote (including all the SETUP_* and
+    EUPS_* variables) are the same as when it was recorded.
+
+    Note that messages printed while the original request was resolved are
+    not repeated when an entry is replayed.
+    """
+
+    # static variable: the version of the entries' format.  Change this
+    # if what's recorded changes.
+    formatVersion = 1
+
+    # the maximum number of entries to keep
+    maxEntries = 100
+
+    # the name of the directory in the user's data directory to store entries in
+    persistDirName = "_setups_"
+
+    def __init__(self, eupsenv, persistDir=None):
+        """
+        @param eupsenv     the Eups instance that will carry out the setups
+        @param persistDir  the directory to store the entries in.  If None,
+                             it is persistDirName in the user's data
+                             directory.
+        """
+        self.eups = eupsenv
+        if not persistDir and eupsenv.userDataDir:
+            persistDir = os.path.join(eupsenv.userDataDir, self.persistDirName)
+        self.persistDir = persistDir
+
+    def _dbState(self, dbdir):
+        # return a value that changes whenever the declarations or tag
+        # assignments in the database in dbdir change.  Other files in the
+        # directory (e.g. product caches) are ignored.
+        if not dbdir or not os.path.isdir(dbdir):
+            return None
+
+        out = []
+        try:
+            st = os.stat(os.path.join(dbdir, journalFile))
+            out.append((st.st_ino, st.st_size))
+        except OSError:
+            st = None
+
+        for f in sorted(os.listdir(dbdir)):
+            path = os.path.join(dbdir, f)
+            mat = tagListFileRe.match(f)
+            if mat and mat.group(1) != "user": # the user tags are a cache of what's in the chain files
+                out.append((f, os.stat(path).st_mtime))
+            elif st is None and os.path.isdir(path):
+                # no journal, so we have to look at the files describing each product
+                for dirpath, dirnames, filenames in os.walk(path):
+                    dirnames.sort()
+                    for fn in sorted(filenames):
+                        if _dbFileRe.search(fn):
+                            fn = os.path.join(dirpath, fn)
+                            out.append((fn, os.stat(fn).st_mtime))
+
+        return out
+
+    def getKey(self, productName, versionName=None, productRoot=None, tablefile=None, fwd=True,
+               prefTags=None, postTags=None):
+        """
+        return the key identifying a setup request (with the arguments of
+        app.setup()) in the current state of the product stacks.
+        """
+        if isinstance(versionName, Tag):
+            versionName = "tag:" + str(versionName)
+        if productRoot:
+            productRoot = os.path.abspath(productRoot)
+        if tablefile:
+            tablefile = os.path.abspath(tablefile)
+
+        eupsenv = self.eups
+        request = [self.formatVersion, productName, versionName, productRoot, tablefile, fwd,
+                   [str(t) for t in (prefTags or [])], [str(t) for t in (postTags or [])],
+                   eupsenv.flavor, eupsenv.path, sorted(set([str(t) for t in eupsenv.setupType])),
+                   [str(v) for v in (eupsenv._vro or [])], [str(t) for t in eupsenv.getPreferredTags()],
+                   eupsenv.max_depth, eupsenv.keep, eupsenv.force,
+                   eupsenv.ignore_versions, eupsenv.exact_version, eupsenv.userDataDir]
+
+        for p in eupsenv.path:
+            request.append(self._dbState(eupsenv.getUpsDB(p)))
+            request.append(self._dbState(eupsenv._userStackCache(p)))
+
+        return hashlib.md5(repr(request).encode("utf-8")).hexdigest()
+
+    def _entryFile(self, key):
+        return os.path.join(self.persistDir, "%s.setup" % key)
+
+    def lookup(self, key):
+        """
+        return the entry recorded for a key, or None if there isn't one or
+        it doesn't apply to the current environment.
+        """
+        if not self.persistDir:
+            return None
+
+        try:
+            fd = open(self._entryFile(key), "rb")
+            try:
+                entry = pickle.load(fd)
+            finally:
+                fd.close()
+        except Exception:
+            return None
+
+        if _selectEnviron(os.environ) != entry["selected"]:
+            return None
+        for k, v in entry["environ"].items():
+            if os.environ.get(k) != v:
+                return None
+        for tablefile, state in entry["tables"]:
+            if _fileState(tablefile) != state:
+                return None
+
+        return entry
+
+    def replay(self, entry):
+        """
+        apply the changes to the environment recorded in an entry, and
+        return the version of the product that was setup.
+        """
+        eupsenv = self.eups
+        for k, v in entry["setEnv"]:
+            eupsenv.setEnv(k, v)
+        for k in entry["unsetEnv"]:
+            eupsenv.unsetEnv(k)
+        for k in entry["unsetAliases"]:
+            eupsenv.unsetAlias(k)
+        for k, v in entry["aliases"].items():
+            eupsenv.setAlias(k, v)
+
+        if eupsenv.verbose > 1:
+            print("Replayed the changes made by a previous setup of %s %s" %
+                  (entry["productName"], entry["version"]), file=utils.stdinfo)
+
+        return entry["version"]
+
+    def startRecording(self):
+        """
+        start recording what a setup reads and does.  Call stopRecording()
+        when the setup is complete.
+        """
+        self._initialEnviron = os.environ.copy()
+        self._initialAliases = (dict(self.eups.aliases), dict(self.eups.oldAliases))
+        self.eups._setupRecord = dict(variables=set(), tables=[])
+
+    def stopRecording(self):
+        """
+        stop recording, returning what was recorded
+        """
+        recording, self.eups._setupRecord = self.eups._setupRecord, None
+        return recording
+
+    def record(self, key, productName, version, recording):
+        """
+        save what a successful setup did as the entry for a key.  Entries
+        are not saved if a table file prints anything, as the output wouldn't
+        be repeated.
+        @param key          the request's key, as returned by getKey()
+        @param productName  the name of the product that was setup
+        @param version      the version that was setup
+        @param recording    what was recorded, as returned by stopRecording()
+        """
+        if recording is None or not self.persistDir:
+            return
+
+        initial = self._initialEnviron
+        variables = set(recording["variables"])
+        for k in set(initial.keys()) | set(os.environ.keys()):
+            if k not in _ignoredVariables and initial.get(k) != os.environ.get(k):
+                variables.add(k)
+
+        tables = []
+        for tablefile in recording["tables"]:
+            state = _fileState(tablefile)
+            if state is None:
+                return
+            tables.append((tablefile, state))
+            try:
+                fd = open(tablefile)
+                try:
+                    contents = fd.read()
+                finally:
+                    fd.close()
+            except IOError:
+                return
+            if re.search(r"^\s*print\s*\(", contents, re.MULTILINE | re.IGNORECASE):
+                return
+
+            for var in re.findall(r"\$\??{([^}]*)}", contents):
+                variables.add(var)
+
+        aliases, oldAliases = self._initialAliases
+        if aliases or [v for v in oldAliases.values() if v is not None]:
+            return                      # we only know how to replay changes to an empty set of aliases
+
+        entry = dict(productName=productName, version=version, tables=tables,
+                     selected=_selectEnviron(initial),
+                     environ=dict([(k, initial.get(k)) for k in variables]),
+                     setEnv=[(k, v) for k, v in os.environ.items() if k in variables],
+                     unsetEnv=[k for k in variables if k not in os.environ],
+                     aliases=dict(self.eups.aliases),
+                     unsetAliases=[k for k in self.eups.oldAliases if k not in self.eups.aliases])
+
+        try:
+            if not os.path.isdir(self.persistDir):
+                os.makedirs(self.persistDir)
+            fd = utils.AtomicFile(self._entryFile(key), "wb")
+            pickle.dump(entry, fd, protocol=2)
+            fd.close()
+            self._prune()
+        except (IOError, OSError) as e:
+            if self.eups.verbose > 0:
+                print("Unable to save the results of setting up %s: %s" % (productName, e),
+                      file=utils.stdwarn)
+
+    def _prune(self):
+        # remove the oldest entries if there are too many
+        entries = [os.path.join(self.persistDir, f) for f in os.listdir(self.persistDir)
+                   if f.endswith(".setup")]
+        if len(entries) <= self.maxEntries:
+            return
+
+        entries.sort(key=lambda f: os.stat(f).st_mtime)
+        for f in entries[:len(entries) - self.maxEntries]:
+            try:
+                os.remove(f)
+            except OSError:
+                pass
+
+    def clear(self):
+        """
+        remove all the entries
+        """
+        if not self.persistDir or not os.path.isdir(self.persistDir):
+            return
+        for f in os.listdir(self.persistDir):
+            if f.endswith(".setup"):
+                os.remove(os.path.join(self.persistDir, f))
+
+def _fileState(file):
+    try:
+        st = os.stat(file)
+    except OSError:
+        return None
+    return (st.st_mtime, st.st_size)
+
+# the files in a database that describe products
+_dbFileRe = re.compile(r"\.(version|chain)$")
+
+# variables that differ from process to process, but don't affect a setup
+_ignoredVariables = ("EUPS_LOCK_PID",)
+
+def _selectEnviron(environ):
+    # the variables that describe what's setup and how eups is configured
+    prefix = utils.setupEnvPrefix()
+    return sorted([(k, v) for k, v in environ.items()
+                   if (k.startswith(prefix) or k.startswith("EUPS_")) and k not in _ignoredVariables])
@@ -3,6 +3,11 @@ the Uses class -- a class for tracking product dependencies (used by the remove(
 function).
 """
 import re
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+from . import utils
 from .utils import cmp_or_key, cmp
 
 #
@@ -19,11 +24,26 @@ class Uses(object):
     a class for tracking product dependencies.  Typically an instance of
     this class is created via a call to Eups.uses().  This class is used
     by Eups.remove() to figure out what to remove.
+
+    An instance may be saved to a file, along with the state of the
+    databases that it describes, and updated later by forgetting the
+    products that have changed and remembering them afresh.
     """
 
+    # static variable: the version of the saved format.  Change this if
+    # the instance data changes.
+    formatVersion = 1
+
+    # the name of the directory in the user's data directory to save instances in
+    persistDirName = "_uses_"
+
     def __init__(self):
         self._depends_on = {}           # info about products that depend on key
-        self._setup_by = {}             # info about products that setup key, directly or indirectly
+        self._setup_by = {}             # info about products that setup key, directly or indirectly,
+                                        # keyed by the user's key
+        self._involves = {}             # the names of the products that key's dependencies involve
+        self._inverted = set()          # the keys whose dependencies are included in _setup_by
+        self.state = None               # the state of the databases when the dependencies were found
 
     def _getKey(self, p, v):
         return "%s:%s" % (p, v)
@@ -38,36 +58,96 @@ class Uses(object):
             self._depends_on[key] = []
 
         self._depends_on[key] += [info]
+        self._involves.setdefault(key, set([p])).add(info[0])
+
+    def rememberAnalysed(self, p, v):
+        """
+        note that the dependencies of a product have been remembered (so
+        that a product that has none is known about)
+        """
+        self._involves.setdefault(self._getKey(p, v), set([p]))
+
+    def getAnalysed(self):
+        """
+        return the products whose dependencies have been remembered, as a
+        list of (productName, versionName)
+        """
+        return [tuple(self._splitKey(k)) for k in self._involves.keys()]
+
+    def forget(self, p, v):
+        """
+        forget everything remembered about the dependencies of a product
+        """
+        key = self._getKey(p, v)
+        if key in self._inverted:
+            for dname, dver, doptional, ddepth in self._depends_on.get(key, []):
+                users = self._setup_by.get(self._getKey(dname, dver))
+                if users is not None:
+                    users.pop(key, None)
+                    if not users:
+                        del self._setup_by[self._getKey(dname, dver)]
+            self._inverted.discard(key)
+
+        self._depends_on.pop(key, None)
+        self._involves.pop(key, None)
+
+    def forgetUsersOf(self, productNames):
+        """
+        forget the dependencies of every product that is, or depends on, a
+        product with one of the given names, returning the forgotten products
+        as a list of (productName, versionName)
+        """
+        productNames = set(productNames)
+        forgotten = [k for k, names in self._involves.items() if names & productNames]
+        for k in forgotten:
+            self.forget(*self._splitKey(k))
+
+        return [tuple(self._splitKey(k)) for k in forgotten]
 
     def invert(self, depth):
         """ Invert the dependencies to tell us who uses what, not who depends on what"""
 
-        self._setup_by = {}
         for k in self._depends_on.keys():
+            if k in self._inverted:
+                continue
             productName, versionName = self._splitKey(k)
+            #
+            # Find the minimum depth at which each product is used
+            #
             for dname, dver, doptional, ddepth in self._depends_on[k]:
-                key = self._getKey(dname, dver)
-                if key not in self._setup_by:
-                    self._setup_by[key] = []
-
-                self._setup_by[key].append((productName, versionName, Props(dver, doptional, ddepth)))
-
-        #
-        # Find the minimum depth for each product, and make sure that if a product is labelled required
-        # if it is required at any depth
-        #
-        for k in self._setup_by.keys():
-            vmin = {}
-            dmin = {}
-            for val in self._setup_by[k]:
-                p, pv, props = val
-
-                key = "%s-%s" % (p, pv)
-                if key not in dmin or props.depth < dmin[key]:
-                    dmin[key] = props.depth
-                    vmin[key] = val
-
-            self._setup_by[k] = list(set(vmin.values())) # Use set() to make values unique
+                users = self._setup_by.setdefault(self._getKey(dname, dver), {})
+                if k not in users or ddepth < users[k][2].depth:
+                    users[k] = (productName, versionName, Props(dver, doptional, ddepth))
+
+            self._inverted.add(k)
+
+    def save(self, file):
+        """
+        save this instance to a file
+        """
+        fd = utils.AtomicFile(file, "wb")
+        pickle.dump((self.formatVersion, self), fd, protocol=2)
+        fd.close()
+
+    # @staticmethod   # requires python 2.4
+    def load(file):
+        """
+        return the instance saved to a file by save(), or None if it can't
+        be read
+        """
+        try:
+            fd = open(file, "rb")
+            try:
+                formatVersion, usesInfo = pickle.load(fd)
+            finally:
+                fd.close()
+        except Exception:
+            return None
+
+        if formatVersion != Uses.formatVersion:
+            return None
+        return usesInfo
+    load = staticmethod(load)    # works since python2.2
 
     def users(self, productName, versionName=None):
         """Return a list of the users of productName/productVersion; each element of the list is:
@@ -84,7 +164,7 @@ class Uses(object):
         for k in self._setup_by.keys():
             mat = pattern.match(k)
             if mat:
-                consumerList += (self._setup_by[k])
+                consumerList += list(self._setup_by[k].values())
         #
         # Be nice; sort list
         #
@@ -1,10 +1,14 @@
 import re
 
-from .utils import cmp
+from .utils import cmp, cmp_or_key, LRUCache
 
 class VersionCompare(object):
     """
     A comparison function class that compares two product versions.
+
+    Lists of versions should be sorted with sort(), which uses a
+    precomputed key for each version rather than calling compare() for
+    every pair when it can do so without changing the order.
     """
     def compare(self, v1, v2, mustReturnInt=True):
         """Compare two versions.
@@ -124,6 +128,15 @@ If mustReturnInt is False and you don't want to allow the versions to be sorted,
         if not version:
             return "", "", ""
 
+        cacheKey = (type(self), version) # a subclass may split versions differently
+        out = _splitCache.get(cacheKey)
+        if out is None:
+            out = self._doSplitVersion(version)
+            _splitCache.put(cacheKey, out)
+
+        return out
+
+    def _doSplitVersion(self, version):
         if len(version.split("-")) > 2:
             # a version string such as rel-0-8-2 with more than one hyphen
             return version, "", ""
@@ -139,9 +152,149 @@ If mustReturnInt is False and you don't want to allow the versions to be sorted,
 
         return vvv, eee, fff
 
+    def sort(self, versions, key=None, reverse=False):
+        """
+        Sort a list of versions in place into the order defined by compare().
+
+        If every version can be given a key that orders it the same way
+        as stdCompare() (see sortKey()), the list is sorted using the
+        keys; otherwise (or if compare() has been overridden) it's sorted
+        by calling compare() for pairs of versions.
+        @param versions   the list to sort
+        @param key        if not None, a function returning the version
+                            to sort each element of versions by
+        @param reverse    sort into descending order
+        """
+        if key is None:
+            key = lambda v: v
+
+        keys = self._isStandard() and self._sortKeys([key(el) for el in versions])
+        if keys:
+            versions.sort(key=lambda el: keys[key(el)], reverse=reverse)
+        else:
+            versions.sort(reverse=reverse, **cmp_or_key(lambda a, b: self.compare(key(a), key(b))))
+
+    def _sortKeys(self, versions):
+        # Return a dictionary of the keys for versions, or None if they can't be sorted by key
+        keys, prims = {}, {}
+        for v in versions:
+            if v in keys:
+                continue
+
+            k = self.sortKey(v)
+            if k is None:
+                return None
+
+            keys[v], vprims = k
+            for primKey, prim in vprims:
+                if prims.setdefault(primKey, prim) != prim: # e.g. 1.01 and 1.1, which stdCompare
+                    return None                             # treats as equal whatever follows them
+
+        return keys
+
+    def sortKey(self, version):
+        """
+        Return a tuple (key, prims) where key orders version the same way
+        as stdCompare(), and prims lists the (key, string) of each release
+        name (e.g. 1.2.3) in the version.  The keys are only consistent
+        with stdCompare() if no key in prims corresponds to different
+        strings for different versions.  Return None if version can't be
+        given a key; this happens if a component of a release name (e.g.
+        "5a4" in 8.5a4) is neither a number, letters, or letters followed
+        by a number, as stdCompare() doesn't define a consistent order
+        for such versions.
+        """
+        cacheKey = (type(self), version)
+        out = _keyCache.get(cacheKey)
+        if out is None:
+            prims = []
+            out = (self._sortKey(version, prims), tuple(prims))
+            if out[0] is None:
+                out = False
+            _keyCache.put(cacheKey, out)
+
+        return out or None
+
+    def _sortKey(self, version, prims):
+        # compute the key for sortKey(), appending the release names' (key, string) to prims
+        if not version:
+            return _emptyKey
+
+        try:
+            prim, sec, ter = self._splitVersion(version)
+        except AttributeError:          # e.g. a version starting with -, which stdCompare can't handle
+            return None
+
+        primKey = []
+        for c in _componentSplitRe.split(prim):
+            mat = _componentRe.search(c)
+            if not mat:
+                return None
+            digits, letters, number = mat.groups()
+            if digits is not None:
+                primKey.append((0, int(digits)))
+            elif number:
+                primKey.append((1, letters, int(number)))
+            elif letters:
+                primKey.append((1, letters))
+            else:
+                primKey.append((-1,))
+        primKey = tuple(primKey)
+        prims.append((primKey, prim))
+
+        if sec:
+            secKey = self._sortKey(sec, prims)
+            if secKey is None:
+                return None
+            secKey = (0, secKey)        # a version with a decrementing annotation sorts first
+        else:
+            secKey = (1,)
+
+        terKey = self._sortKey(ter, prims)
+        if terKey is None:
+            return None
+
+        return (primKey, secKey, terKey)
+
+    def _isStandard(self):
+        # is our ordering that of stdCompare()?
+        cls = type(self)
+        for name in ("compare", "stdCompare", "_splitVersion", "_doSplitVersion"):
+            if _func(getattr(cls, name)) is not _func(getattr(VersionCompare, name)):
+                return False
+        return True
+
     def __call__(self, v1, v2, mustReturnInt=True):
         """
         make an instance behave like a callable function
         """
         return self.compare(v1, v2, mustReturnInt)
 
+
+def sortVersions(versions, versionCmp, key=None, reverse=False):
+    """
+    Sort a list of versions in place using versionCmp, a VersionCompare or
+    any other function to compare two versions; see VersionCompare.sort()
+    """
+    if isinstance(versionCmp, VersionCompare):
+        versionCmp.sort(versions, key=key, reverse=reverse)
+    elif key is None:
+        versions.sort(reverse=reverse, **cmp_or_key(versionCmp))
+    else:
+        versions.sort(reverse=reverse, **cmp_or_key(lambda a, b: versionCmp(key(a), key(b))))
+
+def _func(method):
+    # the function implementing a method
+    return getattr(method, "__func__", method)
+
+# Caches of _splitVersion() and sortKey(), indexed by (class, version)
+_splitCache = LRUCache(maxsize=10000)
+_keyCache = LRUCache(maxsize=10000)
+
+# the components of a release name, and those that sortKey() can handle: a number,
+# letters, letters followed by a number, or nothing
+_componentSplitRe = re.compile(r"[._]")
+_componentRe = re.compile(r"^(?:([0-9]+)|([A-Za-z]*)([0-9]*))$")
+
+# the key for an empty version
+_emptyKey = (((-1,),), (1,), ())
@@ -1,7 +1,9 @@
 """A simple recursive descent parser for logical expressions"""
-
+from __future__ import absolute_import, print_function
 import os
 import re
+from . import utils
+from .utils import LRUCache
 
 class VersionParser(object):
     """Evaluate a logical expression, returning a Bool.  The grammar is:
@@ -27,9 +29,13 @@ class VersionParser(object):
 names are declared using VersionParser.define()
         """
     def __init__(self, exprStr):
-        exprStr = re.sub(r"['\"]([^'\"]+)['\"]", r"\1", exprStr)
-        self._tokens = re.split(r"(\$\??{[^}]+}|[\w.+]+|\s+|==|!=|<=|>=|[()<>])", exprStr)
-        self._tokens = [p for p in self._tokens if p and not re.search(r"^\s*$", p)]
+        tokens = _tokenCache.get(exprStr)
+        if tokens is None:
+            tokens = re.sub(r"['\"]([^'\"]+)['\"]", r"\1", exprStr)
+            tokens = re.split(r"(\$\??{[^}]+}|[\w.+]+|\s+|==|!=|<=|>=|[()<>])", tokens)
+            tokens = tuple([p for p in tokens if p and not re.search(r"^\s*$", p)])
+            _tokenCache.put(exprStr, tokens)
+        self._tokens = list(tokens)     # we consume the tokens as we parse them
 
         self._symbols = {}
         self._caseSensitive = False
@@ -181,3 +187,106 @@ names are declared using VersionParser.define()
             return term
 
         return self._next()
+
+class VersionExpr(object):
+    """
+    A version expression such as ">= 3.2 || == 2.7", as used by
+    Eups.version_match(), compiled so that it can be evaluated for many
+    versions.  Use compileVersionExpr() to get an instance.
+    """
+
+    # the relational operators
+    relopRe = re.compile(r"<=?|>=?|==")
+
+    def __init__(self, expr):
+        self.expr = expr
+        self._program = []              # the terms and logical operators, in order
+
+        tokens = [x for x in re.split(r"\s*(%s|\|\||\s)\s*" % self.relopRe.pattern, expr)
+                  if not re.search(r"^\s*$", x)]
+
+        logop, seenTerm = None, False
+        i = -1
+        while i < len(tokens) - 1:
+            i += 1
+
+            if self.relopRe.search(tokens[i]):
+                relop = tokens[i]; i += 1
+                if i == len(tokens):    # no version; fail when (and if) we get here
+                    self._program.append(("error", relop, None))
+                    break
+                v = tokens[i]
+            elif re.search(r"^[-+.:/\w]+$", tokens[i]) and tokens[i] not in ("and", "or"):
+                relop = "=="
+                v = tokens[i]
+            elif tokens[i] == "||" or tokens[i] == "or":
+                logop = "or"
+                self._program.append((logop, None, None))
+                continue
+            elif tokens[i] == "&&" or tokens[i] == "and":
+                logop = "and"
+                self._program.append((logop, None, None))
+                continue
+            else:
+                print("Unexpected operator %s in \"%s\"" % (tokens[i], expr), file=utils.stdwarn)
+                break
+
+            if not logop and seenTerm:
+                print("Expected logical operator || or && in \"%s\" at %s" % (expr, v), file=utils.stdwarn)
+            else:
+                self._program.append(("term", relop, v))
+                seenTerm = True
+
+    def match(self, vname, matchPrim):
+        """
+        Return vname if it satisfies the expression, otherwise None (or False).
+        @param vname      the version to test
+        @param matchPrim  a function matchPrim(relop, vname, version) that returns
+                            True if vname relop version (e.g. 1.2 >= 1.0) is true, and
+                            raises ValueError if the versions can't be compared
+        """
+        logop = None                    # the next logical operation to process
+        value = None                    # the value of the current term (e.g. ">= 2.0.0")
+        for what, relop, v in self._program:
+            if what == "or":
+                logop = what
+            elif what == "and":
+                if not value:
+                    return False        # short circuit
+                logop = what
+            elif what == "error":
+                raise IndexError("No version follows %s in \"%s\"" % (relop, self.expr))
+            else:
+                try:
+                    rhs = matchPrim(relop, vname, v)
+                except ValueError:      # no sort order is defined
+                    return None
+
+                if not logop:
+                    value = rhs
+                elif logop == "and":
+                    value = bool(value and rhs)
+                elif logop == "or":
+                    if value or rhs:
+                        return vname
+
+                    value = False
+
+        if value:
+            return vname
+        else:
+            return None
+
+def compileVersionExpr(expr):
+    """Return a VersionExpr for expr, reusing the one made for a previous call if possible"""
+
+    versionExpr = _exprCache.get(expr)
+    if versionExpr is None:
+        versionExpr = VersionExpr(expr)
+        _exprCache.put(expr, versionExpr)
+
+    return versionExpr
+
+# caches of VersionParser's tokens and VersionExprs, indexed by the expression
+_tokenCache = LRUCache(maxsize=1000)
+_exprCache = LRUCache(maxsize=1000)
@@ -3,6 +3,7 @@ from .exceptions import *
 from .tags       import Tags, Tag, TagNotRecognized
 from .Product    import Product
 from .Eups       import Eups
+from .SetupCache import SetupCache
 from .cmd        import commandCallbacks
 
 from . import utils
@@ -4,8 +4,10 @@ common high-level EUPS functions appropriate for calling from an application.
 
 from __future__ import absolute_import, print_function
 import fnmatch
+import itertools
 import re
 import os
+import shutil
 try:
     import cPickle as pickle
 except ImportError:
@@ -15,11 +17,14 @@ from .Eups           import Eups
 from .exceptions     import ProductNotFound
 from .tags           import Tag, checkTagsList
 from .Product import Product
+from .SetupCache     import SetupCache
+from .Uses           import Uses
 from .VersionParser  import VersionParser
+from .VersionCompare import sortVersions
 from .stack          import ProductStack, persistVersionName as cacheVersion
 from . import utils, table, hooks
 from .exceptions import EupsException
-from .utils import cmp_or_key, cmp
+from .utils import cmp
 
 def printProducts(ostrm, productName=None, versionName=None, eupsenv=None,
                   tags=None, setup=False, tablefile=False, directory=False,
@@ -88,19 +93,22 @@ def printProducts(ostrm, productName=None, versionName=None, eupsenv=None,
         eupsenv.setup(productName, versionName, productRoot=os.path.abspath(productDir))
         setup = True                    # only list this version
 
-    productList = eupsenv.findProducts(productName, versionName, tags)
-    if not productList:
-        if productName:
-            msg = productName
-            if versionName:
-                msg += " %s" % versionName
-            if tags:
-                msg += " tagged \"%s\"" % ", ".join([Tag(t).name for t in tags])
+    def productNotFound():
+        msg = productName
+        if versionName:
+            msg += " %s" % versionName
+        if tags:
+            msg += " tagged \"%s\"" % ", ".join([Tag(t).name for t in tags])
 
-            raise ProductNotFound(productName, versionName, msg="Unable to find product %s" % msg)
+        return ProductNotFound(productName, versionName, msg="Unable to find product %s" % msg)
 
-    productList.sort(key=lambda p: (p.name, p.version))
     if dependencies:
+        productList = eupsenv.findProducts(productName, versionName, tags)
+        if not productList and productName:
+            raise productNotFound()
+
+        productList.sort(key=lambda p: (p.name, p.version))
+
         _msgs = {}               # maintain list of printed dependencies
         recursionDepth, indent = 0, ""
 
@@ -167,27 +175,47 @@ def printProducts(ostrm, productName=None, versionName=None, eupsenv=None,
 
         return 1
     #
-    # See if some tag appears more than once;  if so, they are from different stacks
-    #
-    tagsSeen = {}
-    for pi in productList:
-        for t in pi.tags:
-            if t not in tagsSeen:
-                tagsSeen[t] = {}
-            if pi.name not in tagsSeen[t]:
-                tagsSeen[t][pi.name] = 0
-
-            tagsSeen[t][pi.name] += 1
-
-    if showTagsGlob:
-        tagsSeen0 = list(tagsSeen.keys())
-        for t in tagsSeen0:
-            if not fnmatch.fnmatch(Tag(t).name, showTagsGlob):
-                del tagsSeen[t]
-    #
-    # Actually list the products
+    # Actually list the products.  They come from iterProducts() one name at a time, so we can
+    # list each product's versions as soon as they've been found
     #
-    nprod = len(productList)
+    nprod = 0
+    for pname, group in itertools.groupby(eupsenv.iterProducts(productName, versionName, tags),
+                                          lambda p: p.name):
+        productList = sorted(group, key=lambda p: p.version)
+        nprod += len(productList)
+        #
+        # See if some tag appears more than once;  if so, they are from different stacks
+        #
+        tagsSeen = {}
+        for pi in productList:
+            for t in pi.tags:
+                if t not in tagsSeen:
+                    tagsSeen[t] = {}
+                if pi.name not in tagsSeen[t]:
+                    tagsSeen[t][pi.name] = 0
+
+                tagsSeen[t][pi.name] += 1
+
+        if showTagsGlob:
+            tagsSeen0 = list(tagsSeen.keys())
+            for t in tagsSeen0:
+                if not fnmatch.fnmatch(Tag(t).name, showTagsGlob):
+                    del tagsSeen[t]
+
+        oinfo = _printProductList(productList, eupsenv, productName, setup, tablefile, directory,
+                                  showVersion, showName, showTagsGlob, raw, tagsSeen, oinfo)
+
+    if nprod == 0 and productName:
+        raise productNotFound()
+
+    return nprod
+
+def _printProductList(productList, eupsenv, productName, setup, tablefile, directory,
+                      showVersion, showName, showTagsGlob, raw, tagsSeen, oinfo):
+    """
+    print the lines of printProducts()'s listing for a list of products, returning the last line
+    printed (or oinfo, if none are).  See printProducts() for the meaning of the arguments.
+    """
     for pi in productList:
         name, version, root = pi.name, pi.version, pi.stackRoot() # for convenience
         if root == "none":  root = " (none)"
@@ -266,7 +294,6 @@ def printProducts(ostrm, productName=None, versionName=None, eupsenv=None,
                 else:
                     info += "%-20s %-55s" % (root, pi.dir)
 
-                del tags
                 tags = pi.tags
                 if showTagsGlob:
                     tags = [t for t in tags if not fnmatch.fnmatch(Tag(t).name, showTagsGlob)]
@@ -303,7 +330,7 @@ def printProducts(ostrm, productName=None, versionName=None, eupsenv=None,
                 print(info)
                 oinfo = info
 
-    return nprod
+    return oinfo
 
 def printUses(outstrm, productName, versionName=None, eupsenv=None,
               depth=9999, showOptional=False, tags=None, pickleFile=None):
@@ -577,6 +604,13 @@ def clearCache(path=None, flavors=None, inUserDir=False, verbose=0):
     if utils.is_string(flavors):
         flavors = flavors.split()
 
+    if userDataDir:
+        SetupCache(None, os.path.join(userDataDir, SetupCache.persistDirName)).clear()
+
+        usesDir = os.path.join(userDataDir, Uses.persistDirName)
+        if os.path.isdir(usesDir):
+            shutil.rmtree(usesDir)
+
     for p in path:
         dbpath = os.path.join(p, Eups.ups_db)
 
@@ -588,6 +622,10 @@ def clearCache(path=None, flavors=None, inUserDir=False, verbose=0):
             print("No cache yet for %s; skipping..." % p, file=utils.stdwarn)
             continue
 
+        tableCacheDir = os.path.join(persistDir, table.Table.cacheDirName)
+        if os.path.isdir(tableCacheDir):
+            shutil.rmtree(tableCacheDir)
+
         flavs = flavors
         if flavs is None:
             flavs = ProductStack.findCachedFlavors(persistDir)
@@ -630,7 +668,7 @@ def listCache(path=None, verbose=0, flavor=None):
 
         for productName in productNames:
             versionNames = cache.getVersions(productName)
-            versionNames.sort(**cmp_or_key(hooks.version_cmp))
+            sortVersions(versionNames, hooks.version_cmp)
 
             print("  %-20s %s" % (productName, " ".join(versionNames)))
 
@@ -684,7 +722,7 @@ def setup(productName, version=None, prefTags=None, productRoot=None,
         return osetup(productName, version, prefTags, productRoot, productName.setupType)
 
     if not eupsenv:
-        eupsenv = Eups(readCache=False, exact_version=exact_version)
+        eupsenv = Eups(readCache=False, readOnlyCache=True, exact_version=exact_version)
         if version:
             eupsenv.selectVRO(versionName=version)
 
@@ -704,8 +742,29 @@ def setup(productName, version=None, prefTags=None, productRoot=None,
         checkTagsList(eupsenv, postTags)
 
     versionRequested = version
-    ok, version, reason = eupsenv.setup(productName, version, fwd,
-                                        productRoot=productRoot, tablefile=tablefile)
+    #
+    # See if we've already done this setup in the current state of the stacks and environment
+    #
+    setupCache, entry = None, None
+    if hooks.config.Eups.setupCache and not eupsenv.noaction:
+        setupCache = SetupCache(eupsenv)
+        cacheKey = setupCache.getKey(productName, version, productRoot, tablefile, fwd, prefTags, postTags)
+        entry = setupCache.lookup(cacheKey)
+
+    if entry:
+        ok, version, reason = True, setupCache.replay(entry), None
+    else:
+        if setupCache:
+            setupCache.startRecording()
+        try:
+            ok, version, reason = eupsenv.setup(productName, version, fwd,
+                                                productRoot=productRoot, tablefile=tablefile)
+        finally:
+            if setupCache:
+                recording = setupCache.stopRecording()
+
+        if ok and setupCache:
+            setupCache.record(cacheKey, productName, version, recording)
 
     cmds = []
     if ok:
@@ -1581,6 +1581,8 @@ class AdminBuildCacheCmd(EupsCmd):
 
         self.clo.add_option("-A", "--admin-mode", dest="asAdmin", action="store_true", default=False,
                             help="apply cache operations to caches under EUPS_PATH")
+        self.clo.add_option("--verify", dest="verify", action="store_true", default=False,
+                            help="update the caches after checking every file in the databases, rather than rebuilding them")
 
     def execute(self):
         self.args.pop(0)                # remove the "admin"
@@ -1589,8 +1591,16 @@ class AdminBuildCacheCmd(EupsCmd):
             self.err("Unexpected arguments: %s" % " ".join(self.args))
             return 1
 
-        eups.clearCache(inUserDir=not self.opts.asAdmin, verbose=self.opts.verbose)
-        eups.Eups(readCache=True, asAdmin=self.opts.asAdmin)
+        if not self.opts.verify:
+            eups.clearCache(inUserDir=not self.opts.asAdmin, verbose=self.opts.verbose)
+        myeups = eups.Eups(readCache=True, asAdmin=self.opts.asAdmin, verifyCache=self.opts.verify)
+        #
+        # Write the caches in all the supported formats, not just the one we read
+        #
+        for stack in myeups.versions.values():
+            for format in stack.persistFormats:
+                if format != stack.cacheFormat:
+                    stack.save(stack.getFlavors(), format=format)
 
         return 0
 
@@ -2204,6 +2214,8 @@ tag will be installed.
                             const=distrib.Repositories.DEPS_ONLY,
                             help="Just install product dependencies, not the product itself")
         self.clo.set_defaults(depends=distrib.Repositories.DEPS_ALL)
+        self.clo.add_option("--jobs", dest="jobs", action="store", type="int", default=1, metavar="N",
+                            help="Build up to N products that don't depend on each other at once")
         self.clo.add_option("-N", "--noeups", dest="noeups", action="store_true", default=False,
                             help="Don't attempt to lookup product in eups (always install)")
         self.clo.add_option("-r", "--repository", "--server-dir",
@@ -2364,7 +2376,7 @@ tag will be installed.
             repos.install(productName, versionName, updateTags,
                           self.opts.alsoTag, self.opts.depends,
                           self.opts.noclean, self.opts.noeups, dopts,
-                          self.opts.manifest, self.opts.searchDep)
+                          self.opts.manifest, self.opts.searchDep, self.opts.jobs)
         except eups.EupsException as e:
             e.status = 1
             if log:
@@ -2,12 +2,13 @@ from __future__ import absolute_import
 
 import os
 import re
+import time
 from .VersionFile import VersionFile
 from .ChainFile import ChainFile
 import eups.tags
 from eups.Product import Product
 from eups.exceptions import UnderSpecifiedProduct, ProductNotFound, TableFileNotFound
-from eups.utils import xrange, cmp_or_key, is_string
+from eups.utils import xrange, cmp_or_key, is_string, LRUCache
 
 versionFileExt = "version"
 versionFileTmpl = "%s." + versionFileExt
@@ -15,6 +16,64 @@ versionFileRe = re.compile(r'^(\w.*)\.%s$' % versionFileExt)
 tagFileExt = "chain"
 tagFileTmpl = "%s." + tagFileExt
 tagFileRe = re.compile(r'^(\w.*)\.%s$' % tagFileExt)
+journalFile = "changes.journal"
+
+#
+# The parsed contents of version and chain files, shared by all databases.  Entries are keyed by the
+# file's path, modification time and size, so a file that's been changed is reread.  The hits and
+# misses attributes count how often a parse was saved.
+#
+parseCache = LRUCache(maxsize=2000)
+
+def _fileState(file):
+    try:
+        st = os.stat(file)
+    except OSError:
+        return None
+    return (os.path.normpath(file), getattr(st, "st_mtime_ns", st.st_mtime), st.st_size)
+
+def _readFile(cls, file, productName=None, name=None):
+    """
+    Return cls(file, productName, name), where cls is VersionFile or ChainFile, reusing the
+    instance made earlier if the file hasn't changed since.  The instance may be shared, so
+    the caller mustn't modify it.
+    """
+    state = _fileState(file)
+    if state is None:                   # no such file
+        return cls(file, productName, name)
+
+    key = state + (cls.__name__, productName, name)
+    out = parseCache.get(key)
+    if out is None:
+        out = cls(file, productName, name)
+        parseCache.put(key, out)
+
+    return out
+
+def _scanDir(dir):
+    """Return a dictionary of the (non-hidden) entries in dir; the values are True for directories"""
+    out = {}
+    if hasattr(os, "scandir"):
+        for entry in os.scandir(dir):
+            if not entry.name.startswith('.'):
+                out[entry.name] = entry.is_dir()
+    else:
+        for name in os.listdir(dir):
+            if not name.startswith('.'):
+                out[name] = os.path.isdir(os.path.join(dir, name))
+
+    return out
+
+#
+# A directory listing is only reused if the directory was last modified at least this many seconds ago,
+# as a file created within the resolution of the filesystem's timestamps wouldn't change its mtime
+#
+listingMinAge = 2
+
+def _forgetFile(file):
+    """Forget the parsed contents of a file that we've just written or removed"""
+    file = os.path.normpath(file)
+    parseCache.remove(lambda key: key[0] == file)
 
 try:
     _databases
@@ -79,6 +138,12 @@ class _Database(object):
     may be assigned to one flavor of the version but not all.  The chain
     file, thus, indicates which flavors are assigned the tag.
 
+    Every change made to the database through this class is also recorded
+    by appending a line to a journal file in the root directory (see
+    getJournalState()).  This allows caches of the database's contents to
+    check whether they are up to date without examining every file in the
+    database.
+
     The Database class understands a notion of "user" tags defined from its
     perspective as tag assignments that are recorded under a separate
     directory (provided by the constructor).  Methods that take a tag name as
@@ -98,6 +163,8 @@ class _Database(object):
         self.dbpath = dbpath
         self.defStackRoot = defStackRoot
 
+        self._listings = {}             # the contents of directories in the database; see _listDir()
+
         self.addUserTagDb(None, defStackRoot)
 
     def addUserTagDb(self, userTagRoot, upsdb, userId=None):
@@ -126,6 +193,42 @@ class _Database(object):
         else:
             return self._userTagDbs[upsdb][userId]
 
+    def _listDir(self, dir):
+        """
+        Return a dictionary of the entries in a directory in the database
+        (the values are True for subdirectories), or None if there's no
+        such directory.  The listing is reused until the directory's
+        modification time changes, so checking whether a product, version
+        or tag file exists costs a stat of the directory rather than a
+        listing.  The caller mustn't modify the dictionary.
+        """
+        try:
+            st = os.stat(dir)
+        except OSError:
+            self._listings.pop(dir, None)
+            return None
+
+        mtime = getattr(st, "st_mtime_ns", st.st_mtime)
+        listing = self._listings.get(dir)
+        if listing and listing[0] == mtime:
+            return listing[1]
+
+        try:
+            entries = _scanDir(dir)
+        except OSError:                 # not a directory
+            return None
+
+        if time.time() - st.st_mtime >= listingMinAge:
+            self._listings[dir] = (mtime, entries)
+        else:
+            self._listings.pop(dir, None)
+
+        return entries
+
+    def _productListing(self, productName, dbdir=None):
+        # the entries in a product's directory, or None if it isn't in the database
+        return self._listDir(self._productDir(productName, dbdir))
+
     def _productDir(self, productName, dbdir=None):
         if not dbdir:  dbdir = self.dbpath
         return os.path.join(dbdir, productName)
@@ -147,9 +250,9 @@ class _Database(object):
         find a product's version file or null product is not declared.
         """
         if version:
-            out = self._versionFile(productName, version)
-            if os.path.exists(out):
-                return out
+            listing = self._productListing(productName)
+            if listing and (versionFileTmpl % version) in listing:
+                return self._versionFile(productName, version)
 
         return None
 
@@ -173,7 +276,7 @@ class _Database(object):
         if vfile is None:
             return None
 
-        verdata = VersionFile(vfile, name, version)
+        verdata = _readFile(VersionFile, vfile, name, version)
         product = None
         try:
             product = verdata.makeProduct(flavor, self.defStackRoot,
@@ -194,13 +297,13 @@ class _Database(object):
         @param flavor :      the desired platform flavor
         """
         pdir = self._productDir(productName)
-        if not os.path.exists(pdir):
+        if self._listDir(pdir) is None:
             raise ProductNotFound(productName, version, flavor, self.dbpath)
 
         tags = self._findTagsInDir(pdir, productName, version, flavor)
         if self._getUserTagDb():
             udir = self._productDir(productName, self._getUserTagDb())
-            if os.path.isdir(udir):
+            if self._listDir(udir) is not None:
                 tags.extend("user:"+t for t in self._findTagsInDir(udir, productName,
                                                     version, flavor))
 
@@ -209,16 +312,14 @@ class _Database(object):
     def _findTagsInDir(self, dir, productName, version, flavor):
         # look tag assignments via chain files in a given directory
 
-        tagFiles = [x for x in os.listdir(dir) if not x.startswith('.')]
-
         tags = []
-        for file in tagFiles:
+        for file in sorted(self._listDir(dir) or []):
             mat = tagFileRe.match(file)
             if not mat:
                 continue
 
             tag = mat.group(1)
-            cf = ChainFile(os.path.join(dir,file), productName, tag)
+            cf = _readFile(ChainFile, os.path.join(dir,file), productName, tag)
             if cf.getVersion(flavor) == version:
                 tags.append(tag)
 
@@ -228,16 +329,51 @@ class _Database(object):
         """
         return a list of the names of all products declared in this database
         """
-        dirs = [z for z in os.listdir(self.dbpath) if os.path.isdir(os.path.join(self.dbpath,z))]
+        listing = self._listDir(self.dbpath) or {}
+        dirs = sorted([z for z in listing if listing[z]])
 
         out = []
         for dir in dirs:
-            for file in os.listdir(os.path.join(self.dbpath,dir)):
+            for file in self._productListing(dir) or []:
                 if versionFileRe.match(file):
                     out.append(dir)
                     break
         return out
 
+    def getProductTimes(self, productNames=None):
+        """
+        return a dictionary giving the modification time of each product
+        declared in this database.  The time for a product is the latest
+        modification time of its product directory and of the version and
+        chain files within it, so any change to the product's declaration
+        (including tag assignments) will change this time.
+        @param productNames   restrict the results to these products.  If
+                                None, return times for all products.
+        """
+        if productNames is None:
+            productNames = list((self._listDir(self.dbpath) or {}).keys())
+
+        out = {}
+        for dir in productNames:
+            pdir = os.path.join(self.dbpath, dir)
+            listing = self._listDir(pdir)
+            if listing is None:
+                continue
+
+            # the directory mod-time will catch recent removal of files
+            mtime = os.stat(pdir).st_mtime
+            declared = False
+            for file in listing:
+                if versionFileRe.match(file):
+                    declared = True
+                elif not tagFileRe.match(file):
+                    continue
+                mtime = max(mtime, os.stat(os.path.join(pdir, file)).st_mtime)
+
+            if declared:
+                out[dir] = mtime
+
+        return out
 
     def findVersions(self, productName):
         """
@@ -248,11 +384,11 @@ class _Database(object):
         @return string[] :
         """
         versions = []
-        pdir = self._productDir(productName)
-        if not os.path.exists(pdir):
+        listing = self._productListing(productName)
+        if listing is None:
             return versions
 
-        for file in os.listdir(pdir):
+        for file in sorted(listing):
             mat = versionFileRe.match(file)
             if mat: versions.append(mat.group(1))
 
@@ -278,7 +414,7 @@ class _Database(object):
         out = []
         for version in versions:
             vfile = self._versionFile(productName, version)
-            vfile = VersionFile(vfile, productName, version)
+            vfile = _readFile(VersionFile, vfile, productName, version)
             flavors = vfile.getFlavors()
             for f in flavors:
                 if f not in out:  out.append(f)
@@ -306,12 +442,13 @@ class _Database(object):
         if flavors is not None and not isinstance(flavors, list):
             flavors = [flavors]
 
+        listing = self._productListing(name) or {}
+
         out = {}
         for vers in versions:
-            vfile = self._versionFile(name, vers)
-            if not os.path.exists(vfile):
+            if (versionFileTmpl % vers) not in listing:
                 continue
-            vfile = VersionFile(vfile, name, vers)
+            vfile = _readFile(VersionFile, self._versionFile(name, vers), name, vers)
 
             flavs = flavors
             declared = vfile.getFlavors()
@@ -325,8 +462,7 @@ class _Database(object):
         if len(out.keys()) == 0:
             return []
 
-        pdir = self._productDir(name)
-        if not os.path.exists(pdir):
+        if self._productListing(name) is None:
           raise RuntimeError("programmer error: product directory disappeared")
 
         # add in the tags
@@ -368,14 +504,17 @@ class _Database(object):
             if not loc[i]: continue
             if i > 0:
                 tgroup = "user:"
-                if not os.path.exists(loc[i]):
+            listing = self._listDir(loc[i])
+            if listing is None:
+                if i > 0:
                     continue
+                raise OSError("No such directory: %s" % loc[i])
 
-            for file in os.listdir(loc[i]):
+            for file in sorted(listing):
                 mat = tagFileRe.match(file)
                 if mat:
                     tag = mat.group(1)
-                    file = ChainFile(os.path.join(loc[i],file), productName,tag)
+                    file = _readFile(ChainFile, os.path.join(loc[i],file), productName, tag)
                     for flavor in file.getFlavors():
                         vers = file.getVersion(flavor)
                         out.append( (tgroup+tag, vers, flavor) )
@@ -395,28 +534,28 @@ class _Database(object):
                                by the product.
         """
         pdir = self._productDir(productName)
-        if not os.path.exists(pdir):
+        listing = self._listDir(pdir)
+        if listing is None:
             return False
 
         if version is None:
             if flavor is None:
                 return True
 
-            vfiles = os.listdir(pdir)
-            for file in vfiles:
+            for file in sorted(listing):
                 if (versionFileRe.match(file)):
-                    file = VersionFile(os.path.join(pdir,file))
+                    file = _readFile(VersionFile, os.path.join(pdir,file))
                     if file.hasFlavor(flavor):
                         return True
 
             return False
         else:
-            file = self._versionFileInDir(pdir, version)
-            if not os.path.exists(file):
+            if (versionFileTmpl % version) not in listing:
                 return False
+            file = self._versionFileInDir(pdir, version)
             if flavor is None:
                 return True
-            file = VersionFile(file)
+            file = _readFile(VersionFile, file)
             return file.hasFlavor(flavor)
 
 
@@ -465,6 +604,8 @@ class _Database(object):
                 trimDir = None
 
         versionFile.write(trimDir)
+        _forgetFile(vfile)
+        self._recordChange("declare", prod.name)
 
         # now assign any tags
         for tag in prod.tags:
@@ -504,7 +645,10 @@ class _Database(object):
                 self.unassignTag(tag, product.name, product.flavor)
 
         changed = versionFile.removeFlavor(product.flavor)
-        if changed:  versionFile.write()
+        if changed:
+            versionFile.write()
+            _forgetFile(vfile)
+            self._recordChange("undeclare", product.name)
 
         # do a little clean up: if we got rid of the version file, try
         # deleting the directory
@@ -525,6 +669,16 @@ class _Database(object):
                               prepended by a "user:" label to be found
         @param productName  the name of the product
         """
+        tfile = self._findChainFile(tag, productName, searchUserDB)
+        if tfile:
+            return ChainFile(tfile)
+
+        return None
+
+    def _findChainFile(self, tag, productName, searchUserDB=False):
+        """
+        return the name of the chain file for the given tag and product (see getChainFile()), or None
+        """
         pdir = self._productDir(productName)
         if not os.path.exists(pdir):
             raise ProductNotFound(productName, stack=self.dbpath);
@@ -543,7 +697,7 @@ class _Database(object):
         for pdir in pdirs:
             tfile = self._tagFileInDir(pdir, tag.name)
             if os.path.exists(tfile):
-                return ChainFile(tfile)
+                return tfile
 
         return None
 
@@ -558,8 +712,9 @@ class _Database(object):
         @param flavor       the flavor for the product
         """
 
-        tf = self.getChainFile(tag, productName, searchUserDB=searchUserDB)
-        if tf:
+        tfile = self._findChainFile(tag, productName, searchUserDB=searchUserDB)
+        if tfile:
+            tf = _readFile(ChainFile, tfile)
             return tf.name, tf.getVersion(flavor)
         else:
             return productName, None
@@ -581,7 +736,7 @@ class _Database(object):
         if is_string(tag):
             tag = eups.tags.Tag(tag)
 
-        vf = VersionFile(self._versionFile(productName, version))
+        vf = _readFile(VersionFile, self._versionFile(productName, version))
         declaredFlavors = vf.getFlavors()
         if len(declaredFlavors) == 0:
             raise ProductNotFound(productName, version)
@@ -624,6 +779,8 @@ class _Database(object):
 
         tagFile.setVersion(version, flavors)
         tagFile.write()
+        _forgetFile(tfile)
+        self._recordChange("assignTag", productName, writeableDB)
 
 
     def unassignTag(self, tag, productNames, flavors=None):
@@ -664,6 +821,8 @@ class _Database(object):
             if flavors is None:
                 # remove all flavors
                 os.remove(tfile)
+                _forgetFile(tfile)
+                self._recordChange("unassignTag", prod, dbroot)
                 unassigned = True
                 continue
 
@@ -675,26 +834,95 @@ class _Database(object):
 
             if changed:
                 tf.write()
+                _forgetFile(tfile)
+                self._recordChange("unassignTag", prod, dbroot)
                 unassigned = True
 
         return unassigned
 
-    def isNewerThan(self, timestamp, dbrootdir=None):
+    def _journalFile(self, dbdir=None):
+        if not dbdir:  dbdir = self.dbpath
+        return os.path.join(dbdir, journalFile)
+
+    def _recordChange(self, operation, productName, dbdir=None):
+        # append a record of a change to a product to the journal.  If we
+        # can't, remove the journal so that anyone relying on it will notice
+        # and fall back to examining the database files themselves.
+        journal = self._journalFile(dbdir)
+        try:
+            fd = open(journal, "a")
+            try:
+                fd.write("%d %s %s\n" % (time.time(), operation, productName))
+            finally:
+                fd.close()
+        except (IOError, OSError):
+            try:
+                os.remove(journal)
+            except OSError:
+                pass
+
+    def getJournalState(self):
+        """
+        return a value identifying the current state of this database's
+        journal of changes, or None if there is no journal.  The value will
+        change whenever a change is recorded, and can be passed to
+        findChangedProductNames() to find the products changed since then.
+        """
+        try:
+            st = os.stat(self._journalFile())
+        except OSError:
+            return None
+        return (st.st_ino, st.st_size)
+
+    def findChangedProductNames(self, journalState):
+        """
+        return the names of the products that the journal records as having
+        been changed since it was in the given state (as returned by
+        getJournalState()).  None is returned if this cannot be determined,
+        e.g. because the journal has since been removed or replaced.
+        """
+        current = self.getJournalState()
+        if not journalState or not current or \
+           current[0] != journalState[0] or current[1] < journalState[1]:
+            return None
+        if current == tuple(journalState):
+            return []
+
+        fd = open(self._journalFile(), "r")
+        try:
+            fd.seek(journalState[1])
+            lines = fd.readlines()
+        finally:
+            fd.close()
+
+        out = []
+        for line in lines:
+            fields = line.split()
+            if len(fields) != 3:
+                return None             # journal is corrupt
+            if fields[2] not in out:
+                out.append(fields[2])
+
+        return out
+
+    def isNewerThan(self, timestamp, dbrootdir=None, verify=False):
         """
         return true if the state of this database is newer than a given time
         NOTE: file timestamps only have a resolution of 1 second!
         @param timestamp    the epoch time, as given by os.stat()
         @param dbrootdir    directory where to look for file times.  If None,
                                defaults to database root.
+        @param verify       if True, check the times of all the files in the
+                               database rather than relying on the journal
         """
-        # HACK: If the user is _certain_ that the caches are up-to-date,
-        #       allow them to say so. This is a hack to speed up builds
-        #       on systems with thousands of products installed
-        if os.environ.get("_EUPS_ASSUME_CACHES_UP_TO_DATE", "0") == "1":
-            return False
-
         if not dbrootdir:
             dbrootdir = self.dbpath
+        #
+        # If we have a journal, every change made through eups updated it
+        #
+        if not verify and self.getJournalState() is not None:
+            return os.stat(self._journalFile()).st_mtime > timestamp
+
         proddirs = [os.path.join(self.dbpath, d) for d in self.findProductNames()]
 
         for prod in proddirs:
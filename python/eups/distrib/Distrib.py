@@ -242,6 +242,25 @@ class Distrib(object):
         """
         self.unimplemented("installPackage");
 
+    def prefetchPackage(self, location, product, version, buildDir):
+        """Download the file that installPackage() will need to install a
+        package ahead of time, so that the DistribServer can provide it from
+        its cache when the package is installed.  This may be called in a
+        different thread from the other methods.  Return the name of the
+        downloaded file, or None if there was nothing to download.
+
+        This implementation downloads nothing.  Subclasses that fetch a
+        single file from the server in installPackage() should override it.
+
+        @param location     the location of the package on the server, as
+                               passed to installPackage()
+        @param product      the name of the product installed by the package.
+        @param version      the name of the product version.
+        @param buildDir     the directory that will be passed to
+                               installPackage() as a building space
+        """
+        return None
+
     def cleanPackage(self, product, version, productRoot, location):
         """remove any distribution-specific remnants of a package installation.
         Some distrib mechanisms (namely, Pacman) maintain some of their own
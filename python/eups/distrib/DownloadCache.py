@@ -0,0 +1,253 @@
+"""
+the DownloadCache class -- a persistent cache of the files retrieved from
+distribution servers, so that they needn't be downloaded again by later
+installs.
+"""
+from __future__ import absolute_import, print_function
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import eups.hooks as hooks
+import eups.utils as utils
+
+class DownloadCache(object):
+    """
+    A cache of files retrieved from distribution servers, which may be shared between processes
+    (and users).
+
+    The files are stored under the hash of their contents in <dir>/objects, so a file that's
+    available from several URLs (or servers) is only stored once.  For each source URL, a small
+    file in <dir>/sources (named by a hash of the URL) records the hash of the file last
+    retrieved from it and a validator that identifies the version of the source that was
+    retrieved (e.g. an HTTP ETag, or a local file's modification time and size; see
+    Transporter.cacheToFileIfChanged).  The source is only retrieved again if the validator shows
+    that it has changed.
+
+    Everything is written to a temporary file and renamed into place, so processes may use a cache
+    at the same time without locking.  When the files take more than maxBytes, the least recently
+    used are deleted.
+    """
+
+    def __init__(self, dir, maxBytes=None, verbosity=0, log=sys.stderr):
+        """
+        @param dir        the directory to keep the cache in; it's created if needed
+        @param maxBytes   the maximum size of the cached files (default: no limit)
+        @param verbosity  if > 0, print status messages
+        @param log        the destination for status messages
+        """
+        self.dir = dir
+        self.maxBytes = maxBytes
+        self.verbose = verbosity
+        self.log = log
+
+        self._objects = os.path.join(self.dir, "objects")
+        self._sources = os.path.join(self.dir, "sources")
+        for d in (self._objects, self._sources):
+            if not os.path.isdir(d):
+                try:
+                    os.makedirs(d)
+                except OSError:
+                    if not os.path.isdir(d): # another process may have made it
+                        raise
+
+        self._lock = threading.Lock()
+        self._nbytes = None             # the size of the cached files, if known
+
+    def _sourceFile(self, source):
+        return os.path.join(self._sources, hashlib.sha1(source.encode("utf-8")).hexdigest())
+
+    def _objectFile(self, digest):
+        return os.path.join(self._objects, digest[:2], digest)
+
+    def lookup(self, source):
+        """
+        Return (validator, filename) for the cached copy of source, or None if there isn't one
+        @param source    the URL of the file
+        """
+        try:
+            with open(self._sourceFile(source)) as fd:
+                lines = fd.read().split("\n")
+        except (IOError, OSError):
+            return None
+
+        if len(lines) < 3 or lines[0] != source:
+            return None
+
+        digest, validator = lines[1], lines[2]
+        filename = self._objectFile(digest)
+        if not os.path.exists(filename):
+            return None
+
+        return validator, filename
+
+    def retrieve(self, transporter, filename):
+        """
+        Copy the file that transporter retrieves to filename, using the cached copy if it's
+        still valid, and adding the file to the cache otherwise.
+        @param transporter   the Transporter for the source file
+        @param filename      the name of the file to write
+        """
+        source = transporter.loc
+        cached = self.lookup(source)
+
+        changed, validator = transporter.cacheToFileIfChanged(filename, cached and cached[0])
+        if not changed:
+            try:
+                shutil.copyfile(cached[1], filename)
+                os.utime(cached[1], None) # note that it's been used
+            except (IOError, OSError):  # it's just been evicted
+                transporter.cacheToFile(filename)
+                return filename
+
+            if self.verbose > 1:
+                print("Using cached copy of %s" % source, file=self.log)
+
+            return filename
+
+        if validator:
+            try:
+                self.store(source, validator, filename)
+            except (IOError, OSError) as e:
+                if self.verbose > 0:
+                    print("Unable to cache %s: %s" % (source, e), file=self.log)
+
+        return filename
+
+    def store(self, source, validator, filename):
+        """
+        Add a copy of filename to the cache as the version of source identified by validator
+        """
+        digest = utils.fileChecksum(filename)
+
+        objectFile = self._objectFile(digest)
+        if os.path.exists(objectFile):
+            os.utime(objectFile, None)
+            size = 0
+        else:
+            size = os.stat(filename).st_size
+            def copy(ofd):
+                with open(filename, "rb") as ifd:
+                    shutil.copyfileobj(ifd, ofd)
+            self._writeFile(objectFile, copy)
+
+        self._writeFile(self._sourceFile(source),
+                        lambda fd: fd.write(("%s\n%s\n%s\n" % (source, digest, validator)).encode("utf-8")))
+
+        with self._lock:
+            if self._nbytes is not None:
+                self._nbytes += size
+
+        if self.maxBytes is not None and self.size() > self.maxBytes:
+            self.evict()
+
+    def _writeFile(self, filename, write):
+        """Write a file by calling write(fd) on a temporary file, which is then renamed to filename"""
+        dir = os.path.dirname(filename)
+        if not os.path.isdir(dir):
+            try:
+                os.makedirs(dir)
+            except OSError:
+                if not os.path.isdir(dir):
+                    raise
+
+        fd, tmpFile = tempfile.mkstemp(dir=dir, prefix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as fp:
+                write(fp)
+            os.chmod(tmpFile, 0o644)
+            os.rename(tmpFile, filename)
+        except:
+            os.unlink(tmpFile)
+            raise
+
+    def _listObjects(self):
+        """Return a list of (mtime, size, filename) for the cached files"""
+        objects = []
+        for d in os.listdir(self._objects):
+            d = os.path.join(self._objects, d)
+            if not os.path.isdir(d):
+                continue
+            for f in os.listdir(d):
+                if f.startswith(".tmp"):
+                    continue
+                f = os.path.join(d, f)
+                try:
+                    st = os.stat(f)
+                except OSError:         # evicted by another process
+                    continue
+                objects.append((st.st_mtime, st.st_size, f))
+
+        return objects
+
+    def size(self):
+        """Return the size of the cached files"""
+        with self._lock:
+            if self._nbytes is None:
+                self._nbytes = sum([size for mtime, size, f in self._listObjects()])
+
+            return self._nbytes
+
+    def evict(self, maxBytes=None):
+        """
+        Delete the least recently used files until the cache takes no more than maxBytes
+        (default: the cache's maxBytes), along with the records of the sources that they came from
+        """
+        if maxBytes is None:
+            maxBytes = self.maxBytes
+
+        with self._lock:
+            objects = sorted(self._listObjects())
+            nbytes = sum([size for mtime, size, f in objects])
+            for mtime, size, f in objects:
+                if nbytes <= maxBytes:
+                    break
+                try:
+                    os.unlink(f)
+                except OSError:
+                    pass
+                nbytes -= size
+
+            self._nbytes = nbytes
+
+        for f in os.listdir(self._sources):
+            if not f.startswith(".tmp"):
+                try:
+                    with open(os.path.join(self._sources, f)) as fd:
+                        source = fd.readline().rstrip("\n")
+                except (IOError, OSError):
+                    continue
+                if self.lookup(source) is None:
+                    try:
+                        os.unlink(os.path.join(self._sources, f))
+                    except OSError:
+                        pass
+
+_downloadCaches = {}
+
+def getDownloadCache(verbosity=0, log=sys.stderr):
+    """
+    Return the DownloadCache configured by hooks.config.Eups.downloadCache and downloadCacheSize,
+    or None if downloads aren't to be cached
+    """
+    dir = hooks.config.Eups.downloadCache
+    if not dir:
+        return None
+    if dir is True:
+        userDataDir = utils.defaultUserDataDir()
+        if not userDataDir:
+            return None
+        dir = os.path.join(userDataDir, "_downloads_")
+
+    key = (dir, hooks.config.Eups.downloadCacheSize)
+    if key not in _downloadCaches:
+        try:
+            _downloadCaches[key] = DownloadCache(dir, hooks.config.Eups.downloadCacheSize, verbosity, log)
+        except (IOError, OSError) as e:
+            if verbosity >= 0:
+                print("Unable to use %s to cache downloads: %s" % (dir, e), file=utils.stdwarn)
+            _downloadCaches[key] = None
+
+    return _downloadCaches[key]
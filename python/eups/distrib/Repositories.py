@@ -6,6 +6,8 @@ from __future__ import absolute_import, print_function
 import sys
 import os
 import re
+import shutil
+import threading
 import traceback
 
 import eups.utils as utils
@@ -19,6 +21,226 @@ from .DistribFactory import DistribFactory
 from .server         import Manifest, ServerError, RemoteFileInvalid
 import eups.hooks as hooks
 
+def _runInParallel(tasks, predecessors, nthread, start, run, finish):
+    """
+    Run a set of tasks, some of which must wait for others to finish, in a pool of nthread threads.
+
+    start(task) and finish(task) are called in this thread, just before the task is passed to
+    run(task) in the pool and after run has returned; a task is started once finish() has been
+    called for all of its predecessors.  Tasks that are ready are started in the order they
+    appear in tasks.
+
+    If a task fails no more are started, but those already running are allowed to finish; the
+    first exception is then raised.
+
+    @param tasks         the tasks to run (they must be hashable)
+    @param predecessors  a dictionary mapping a task to the set of tasks that must finish first
+    @param nthread       the number of tasks to run at once
+    @param start         the function to call to start a task
+    @param run           the function to call to do the task's work
+    @param finish        the function to call when the task's work is done
+    """
+    from multiprocessing.pool import ThreadPool
+    try:
+        import queue
+    except ImportError:
+        import Queue as queue
+
+    done = queue.Queue()
+
+    def runTask(task):
+        try:
+            run(task)
+        except Exception as e:
+            done.put((task, e))
+        else:
+            done.put((task, None))
+
+    waiting = list(tasks)
+    finished = set()
+    nrunning = 0
+    failure = None
+
+    pool = ThreadPool(max(1, nthread))
+    try:
+        while True:
+            if failure is None:
+                for task in [t for t in waiting if predecessors.get(t, set()) <= finished]:
+                    if nrunning >= nthread:
+                        break
+                    waiting.remove(task)
+                    try:
+                        start(task)
+                    except Exception as e:
+                        failure = e
+                        break
+                    pool.apply_async(runTask, (task,))
+                    nrunning += 1
+
+            if nrunning == 0:
+                break
+
+            task, e = done.get()
+            nrunning -= 1
+            if e is None:
+                try:
+                    finish(task)
+                except Exception as e:
+                    if failure is None:
+                        failure = e
+                else:
+                    finished.add(task)
+            elif failure is None:
+                failure = e
+    finally:
+        pool.close()
+        pool.join()
+
+    if failure is not None:
+        raise failure
+
+    if waiting:
+        raise RuntimeError("Unable to satisfy the dependencies of %s" % ", ".join([str(t) for t in waiting]))
+
+class _Prefetcher(object):
+    """
+    Download the manifests and distribution files that an install will need in a pool of threads,
+    ahead of the products' builds.
+
+    Downloads of distribution files are started in the order they were requested, but only while
+    less than maxBytes of the files already downloaded are waiting to be used (see release()), so
+    the budget may be exceeded by the files that are being downloaded at the time.  If a file is
+    needed before its download has started, the download is cancelled and the file is fetched by
+    the thread that needs it in the usual way.
+
+    Errors are not reported; the files are simply downloaded again when they are needed, and any
+    error is then raised as usual.
+
+    When the prefetcher is closed, the files of products that weren't built (see waitForPackage())
+    are deleted, along with any directories made for them.
+    """
+
+    def __init__(self, nthread, maxBytes):
+        """
+        @param nthread    the number of downloads to run at once
+        @param maxBytes   the maximum number of bytes of downloaded but unused files
+        """
+        from multiprocessing.pool import ThreadPool
+
+        self.maxBytes = maxBytes
+        self._pool = ThreadPool(nthread)
+        self._cond = threading.Condition()
+        self._closed = False
+
+        self._manifests = {}            # AsyncResults for manifests, indexed by package
+        self._packages = {}             # AsyncResults for distribution files, indexed by key
+        self._pending = set()           # keys of the distribution files that we're waiting to start
+        self._sizes = {}                # the sizes of the downloaded files that haven't been released
+        self._dirs = {}                 # directories made for the distribution files, indexed by key
+        self._files = {}                # the downloaded files, indexed by key
+        self._used = set()              # keys of the distribution files that have been used
+        self.nbytes = 0                 # the sum of _sizes
+
+    def prefetchManifest(self, distServer, pkg):
+        """
+        Start downloading the manifest for pkg (as returned by Repositories.findPackage).  The file
+        is left in the DistribServer's cache; it's read by getManifest() (in the calling thread,
+        as reading a manifest may need to consult the Eups environment)
+        """
+        pkg = tuple(pkg)
+        if pkg not in self._manifests:
+            self._manifests[pkg] = self._pool.apply_async(distServer.getFileForProduct,
+                                                          ("", pkg[0], pkg[1], pkg[2], "manifest"))
+
+    def getManifest(self, repos, pkg):
+        """Return the manifest for pkg from repos, waiting for it if it's being downloaded"""
+        result = self._manifests.get(tuple(pkg))
+        if result is not None:
+            result.wait()
+
+        return repos.getManifest(pkg[0], pkg[1], pkg[2])
+
+    def prefetchPackage(self, key, dir, fetch, *args):
+        """
+        Start downloading a product's distribution file
+
+        @param key     the key to identify the product (e.g. (product, version))
+        @param dir     a directory that was made to hold the file, which is removed if the product
+                         isn't built; or None
+        @param fetch   the function to download the file, returning its name (or None);
+                         it's called with the remaining arguments
+        """
+        if key in self._packages:
+            return
+
+        with self._cond:
+            self._pending.add(key)
+            if dir:
+                self._dirs[key] = dir
+        self._packages[key] = self._pool.apply_async(self._fetch, (key, fetch, args))
+
+    def _fetch(self, key, fetch, args):
+        with self._cond:
+            while key in self._pending and not self._closed and self.nbytes >= self.maxBytes:
+                self._cond.wait()
+
+            if key not in self._pending or self._closed: # cancelled
+                return None
+            self._pending.remove(key)
+
+        filename = fetch(*args)
+
+        if filename and os.path.exists(filename):
+            with self._cond:
+                self._files[key] = filename
+                self._sizes[key] = os.stat(filename).st_size
+                self.nbytes += self._sizes[key]
+
+        return filename
+
+    def waitForPackage(self, key):
+        """Wait for a product's distribution file to be downloaded, or cancel its download if it
+        hasn't started.  Call this before the product is built; its files are then left alone by close()"""
+        with self._cond:
+            self._used.add(key)
+            if key in self._pending:
+                self._pending.remove(key)
+                self._cond.notify_all()
+                return
+
+        result = self._packages.get(key)
+        if result is not None:
+            result.wait()
+
+    def release(self, key):
+        """Note that a product's distribution file has been used, so its bytes no longer count"""
+        with self._cond:
+            self.nbytes -= self._sizes.pop(key, 0)
+            self._cond.notify_all()
+
+    def close(self):
+        """
+        Stop starting downloads, wait for those that are running to finish, and delete the files
+        (and directories) of the products that weren't built
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._pool.close()
+        self._pool.join()
+
+        for key in self._packages:
+            if key in self._used:
+                continue
+
+            if key in self._dirs:
+                shutil.rmtree(self._dirs[key], ignore_errors=True)
+            elif key in self._files and os.path.exists(self._files[key]):
+                try:
+                    os.remove(self._files[key])
+                except OSError:
+                    pass
+
 class Repositories(object):
 
     DEPS_NONE = 0
@@ -132,6 +354,9 @@ class Repositories(object):
         # a cache of the union of tag names supported by the repositories
         self._supportedTags = None
 
+        # the _Prefetcher downloading files for the current install (if any)
+        self._prefetcher = None
+
         # used by install() to control repeated error messages
         self._msgs = {}
 
@@ -274,7 +499,7 @@ class Repositories(object):
 
     def install(self, product, version=None, updateTags=None, alsoTag=None,
                 depends=DEPS_ALL, noclean=False, noeups=False, options=None,
-                manifest=None, searchDep=None):
+                manifest=None, searchDep=None, jobs=1):
         """
         Install a product and all its dependencies.
         @param product     the name of the product to install
@@ -325,6 +550,13 @@ class Repositories(object):
                             the choice to recurse is left up to the server
                             where the manifest comes from (which usually
                             defaults to False).
+        @param jobs        the number of products to build at once.  If
+                            greater than 1, products in the manifest that
+                            don't depend on each other are built concurrently
+                            (the declarations are still made one at a time).
+                            Manifests whose dependencies must be recursively
+                            searched for are always installed one product at
+                            a time.
         """
         if alsoTag is not None:
             if utils.is_string(alsoTag):
@@ -357,9 +589,262 @@ class Repositories(object):
             raise EupsException("You asked to install %s %s but it is not in the manifest\nCheck manifest.remap (see \"eups startup\") and/or increase the verbosity" % (product, version))
 
         self._msgs = {}
-        self._recursiveInstall(0, man, product, version, flavor, pkgroot,
-                               productRoot, updateTags, alsoTag, options,
-                               depends, noclean, noeups)
+        if hooks.config.Eups.prefetchThreads > 0 and not self.eups.noaction:
+            self._prefetcher = _Prefetcher(hooks.config.Eups.prefetchThreads, hooks.config.Eups.prefetchBytes)
+            self._prefetch(man, product, version, flavor, productRoot, options, depends, noeups)
+        try:
+            if jobs > 1:
+                if self._parallelInstall(man, product, version, flavor, pkgroot,
+                                         productRoot, updateTags, alsoTag, options,
+                                         depends, noclean, noeups, jobs):
+                    return
+                if self.verbose > 0:
+                    print("Dependencies of %s %s must be searched for; installing one product at a time" %
+                          (product, version), file=self.log)
+
+            self._recursiveInstall(0, man, product, version, flavor, pkgroot,
+                                   productRoot, updateTags, alsoTag, options,
+                                   depends, noclean, noeups)
+        finally:
+            if self._prefetcher:
+                self._prefetcher.close()
+                self._prefetcher = None
+
+    def _prefetch(self, manifest, product, version, flavor, productRoot, opts=None,
+                  depends=DEPS_ALL, noeups=False, tag=None):
+        """
+        Start downloading the manifests and distribution files of the products in a manifest that
+        aren't already installed.  The files are written to the products' build directories, where
+        the DistribServer will find them when the products are built (those of products that aren't
+        built are deleted when the prefetcher's closed).
+        """
+        instflavor = flavor
+        if instflavor == "generic":
+            instflavor = self.eups.flavor
+
+        defaultProduct = hooks.config.Eups.defaultProduct["name"]
+
+        wanted = []
+        for prod in manifest.getProducts():
+            is_product = (prod.product == product and prod.version == version)
+            if depends == self.DEPS_NONE and not is_product:
+                continue
+            elif depends == self.DEPS_ONLY and is_product:
+                continue
+
+            if prod.product == defaultProduct or prod.version == "dummy":
+                continue
+            if not noeups and not self.eups.force and \
+                   self.eups.findProduct(prod.product, prod.version, flavor=instflavor):
+                continue
+
+            pkg = self.findPackage(prod.product, prod.version, prod.flavor)
+            if pkg:
+                wanted.append((prod, pkg))
+        #
+        # Queue all the manifests first as they are small, and are needed before a product can be built
+        #
+        for prod, pkg in wanted:
+            self._prefetcher.prefetchManifest(self.repos[pkg[3]].distServer, pkg)
+
+        for prod, pkg in wanted:
+            if not prod.distId:
+                continue
+
+            try:
+                distrib = self.repos[pkg[3]].getDistribFor(prod.distId, opts, instflavor, tag)
+            except RuntimeError:
+                continue                # we'll complain when we get to the product
+
+            builddir = self.getBuildDirFor(productRoot, prod.product, prod.version, opts, instflavor)
+            madeDir = not os.path.exists(builddir) # so remove it if the product isn't built
+            self.makeBuildDirFor(productRoot, prod.product, prod.version, opts, instflavor)
+
+            self._prefetcher.prefetchPackage((prod.product, prod.version), builddir if madeDir else None,
+                                             distrib.prefetchPackage,
+                                             distrib.parseDistID(prod.distId),
+                                             prod.product, prod.version, builddir)
+
+    def _getManifest(self, pkg):
+        """Return the manifest for pkg, a (product, version, flavor, pkgroot) tuple as returned by findPackage"""
+        if self._prefetcher:
+            return self._prefetcher.getManifest(self.repos[pkg[3]], pkg)
+
+        return self.repos[pkg[3]].getManifest(pkg[0], pkg[1], pkg[2])
+
+    def _parallelInstall(self, manifest, product, version, flavor, pkgroot,
+                         productRoot, updateTags=None, alsoTag=None, opts=None,
+                         depends=DEPS_ALL, noclean=False, noeups=False, jobs=1, tag=None):
+        """
+        Install the products in a manifest, building up to jobs of them at once.
+
+        Each product's own manifest lists the products it depends upon, so a product is built
+        as soon as those that precede it in the manifest are installed; the builds run in a
+        pool of threads, while everything that touches the ups_db (declaring products and
+        assigning tags) is done in this thread, in the order that the builds finish.
+
+        Return False, having installed nothing, if some of the products' dependencies must be
+        searched for recursively; _recursiveInstall must be used in that case.
+        """
+        instflavor = flavor
+        if instflavor == "generic":
+            instflavor = self.eups.flavor
+
+        if alsoTag is None:
+            alsoTag = []
+
+        products = manifest.getProducts()
+        #
+        # Can we trust the manifest to list all the dependencies?
+        #
+        searchDep = None
+        prod = manifest.getDependency(product, version, flavor)
+        if prod and self.repos[pkgroot].getDistribFor(prod.distId, opts, flavor, tag).PRUNE:
+            searchDep = False
+
+        for prod in products:
+            recurse = searchDep
+            if recurse is None:
+                recurse = not prod.distId or prod.shouldRecurse
+
+            if recurse and (prod.distId is None or (prod.product != product or prod.version != version)):
+                return False
+
+        if self.verbose > 0:
+            msg = None
+            if depends == self.DEPS_NONE:
+                msg = "Skipping dependencies for {0} {1}".format(product, version)
+            elif depends == self.DEPS_ONLY:
+                msg = ("Installing dependencies for {0} {1}, but not {0} itself"
+                       .format(product, version))
+            if msg is not None:
+                print(msg, file=self.log)
+
+        if self.verbose >= 0 and len(products) == 0:
+            print("Warning: no installable packages associated with %s %s for %s" %
+                  (manifest.product, manifest.version, flavor), file=self.log)
+        #
+        # Decide which products need building, and what each of them needs to be built
+        #
+        defaultProduct = hooks.config.Eups.defaultProduct["name"]
+        nprods = "/%-2s" % len(products)
+
+        entries = []                    # [at, prod, productRoot, pkgroot, needs]; pkgroot is None if installed
+        seen = set()
+        for at, prod in enumerate(products):
+            is_product = (prod.product == product and prod.version == version)
+            if depends == self.DEPS_NONE and not is_product:
+                continue
+            elif depends == self.DEPS_ONLY and is_product:
+                continue
+
+            if (prod.product, prod.version) in seen:
+                continue
+            seen.add((prod.product, prod.version))
+
+            thisinstalled = None
+            if not noeups:
+                thisinstalled = self.eups.findProduct(prod.product, prod.version, flavor=instflavor)
+
+            prodRoot = productRoot
+            if thisinstalled:
+                prodRoot = thisinstalled.stackRoot() # now we know which root it's installed in
+
+                if prod.product == defaultProduct:
+                    continue            # we don't want to install the implicit products
+                if prod.version == "dummy":
+                    continue            # we can't reinstall dummy versions and don't want to install toolchain
+
+                msg = "  [ %2d%s ]  %s %s" % (at+1, nprods, prod.product, prod.version)
+                if manifest.mapping and manifest.mapping.noReinstall(prod.product, prod.version, flavor):
+                    msg += "; manifest.remap specified no reinstall"
+                    if self.eups.force:
+                        msg += " (ignoring --force)"
+                    if self.verbose >= 0:
+                        print(msg, file=self.log)
+                    continue
+
+                if not self.eups.force:
+                    if self.verbose >= 0:
+                        print(msg, "(already installed) done.", file=self.log)
+
+                    entries.append([at, prod, prodRoot, None, None])
+                    continue
+
+            pkg = self.findPackage(prod.product, prod.version, prod.flavor)
+            if not pkg:
+                msg = "Can't find a package for %s %s" % (prod.product, prod.version)
+                if prod.flavor:
+                    msg += " (%s)" % prod.flavor
+                raise ServerError(msg)
+
+            dman = self._getManifest(pkg)
+            nprod = dman.getDependency(prod.product)
+            if nprod:
+                prod = nprod
+
+            needs = set([p.product for p in dman.getProducts()])
+            needs.discard(prod.product)
+            entries.append([at, prod, prodRoot, pkg[3], needs])
+        #
+        # Only products earlier in the manifest can be needed, so the graph is acyclic (and the
+        # products are still built in an order that would work for a serial install)
+        #
+        builds = [i for i, e in enumerate(entries) if e[3] is not None]
+        predecessors = {}
+        closure = {}
+        for i in builds:
+            needs = entries[i][4]
+            predecessors[i] = set([j for j in builds if j < i and entries[j][1].product in needs])
+            closure[i] = set(predecessors[i])
+            for j in predecessors[i]:
+                closure[i].update(closure[j])
+
+        setups = {}
+        for i, (at, prod, prodRoot, root, needs) in enumerate(entries):
+            setups[i] = ["setup --just --type=build %s %s" % (entries[j][1].product, entries[j][1].version)
+                         for j in range(i) if entries[j][3] is None or j in closure.get(i, ())]
+            if root is None:            # already installed
+                self._tagInstalled(prod, prodRoot, instflavor, opts, updateTags, alsoTag)
+
+        if self.verbose > 0:
+            print("Building %d products, up to %d at a time" % (len(builds), jobs), file=self.log)
+        #
+        # Build them
+        #
+        distribs = {}
+
+        def progress(i):
+            at, prod = entries[i][:2]
+            msg = "  [ %2d%s ]  %s %s" % (at+1, nprods, prod.product, prod.version)
+            if prod.flavor != "generic":
+                msg += " (%s)" % prod.flavor
+            return msg
+
+        def start(i):
+            at, prod, prodRoot, root, needs = entries[i]
+            if self.verbose >= 0:
+                print(progress(i), "...", file=self.log)
+                self.log.flush()
+
+            distribs[i] = self._prepareInstall(root, prod, prodRoot, instflavor, opts, tag)
+
+        def build(i):
+            at, prod, prodRoot, root, needs = entries[i]
+            distrib, builddir = distribs[i]
+            self._buildPackage(distrib, prod, prodRoot, setups[i], builddir)
+
+        def finish(i):
+            at, prod, prodRoot, root, needs = entries[i]
+            distrib, builddir = distribs.pop(i)
+            self._finishInstall(root, prod, prodRoot, instflavor, opts, noclean, setups[i], tag, distrib)
+            self._tagInstalled(prod, prodRoot, instflavor, opts, updateTags, alsoTag)
+            if self.verbose >= 0:
+                print(progress(i), "done.", file=self.log)
+
+        _runInParallel(builds, predecessors, jobs, start, build, finish)
+
+        return True
 
     def _recursiveInstall(self, recursionLevel, manifest, product, version,
                           flavor, pkgroot, productRoot, updateTags=None,
@@ -541,7 +1026,7 @@ class Repositories(object):
                     # Look up the product, which may be found on a different pkgroot
                     pkgroot = pkg[3]
 
-                    dman = self.repos[pkgroot].getManifest(pkg[0], pkg[1], pkg[2])
+                    dman = self._getManifest(pkg)
                     nprod = dman.getDependency(prod.product)
                     if nprod:
                         prod = nprod
@@ -557,34 +1042,49 @@ class Repositories(object):
                 else:
                     print("done.", file=self.log)
 
-            # Whether or not we just installed the product, we need to...
-            # ...add the product to the setups
-            setups.append("setup --just --type=build %s %s" % (prod.product, prod.version))
-
-            # ...update the tags
-            self._updateServerTags(prod, productRoot, instflavor, installCurrent=opts["installCurrent"],
-                                   desiredTag=updateTags)
-            if alsoTag:
-                if self.verbose > 1:
-                    print("Assigning Tags to %s %s: %s" % \
-                          (prod.product, prod.version, ", ".join([str(t) for t in alsoTag])), file=self.log)
-                for tag in alsoTag:
-                    try:
-                        self.eups.assignTag(tag, prod.product, prod.version, productRoot)
-                    except Exception as e:
-                        msg = str(e)
-                        if msg not in self._msgs:
-                            print(msg, file=self.log)
-                        self._msgs[msg] = 1
+            # Whether or not we just installed the product, we need to add it to the setups
+            # and update its tags
+            setups.append(self._tagInstalled(prod, productRoot, instflavor, opts, updateTags, alsoTag))
 
             # ...note that this package is now installed
             installed.append(pver)
 
         return True
 
+    def _tagInstalled(self, prod, productRoot, instflavor, opts, updateTags, alsoTag):
+        """
+        Update the server tags of an installed product and assign it the alsoTag tags;
+        return the command to add to the setups of the products that depend on it
+        """
+        self._updateServerTags(prod, productRoot, instflavor, installCurrent=opts["installCurrent"],
+                               desiredTag=updateTags)
+        if alsoTag:
+            if self.verbose > 1:
+                print("Assigning Tags to %s %s: %s" % \
+                      (prod.product, prod.version, ", ".join([str(t) for t in alsoTag])), file=self.log)
+            for tag in alsoTag:
+                try:
+                    self.eups.assignTag(tag, prod.product, prod.version, productRoot)
+                except Exception as e:
+                    msg = str(e)
+                    if msg not in self._msgs:
+                        print(msg, file=self.log)
+                    self._msgs[msg] = 1
+
+        return "setup --just --type=build %s %s" % (prod.product, prod.version)
+
     def _doInstall(self, pkgroot, prod, productRoot, instflavor, opts,
                    noclean, setups, tag):
 
+        distrib, builddir = self._prepareInstall(pkgroot, prod, productRoot, instflavor, opts, tag)
+        self._buildPackage(distrib, prod, productRoot, setups, builddir)
+        self._finishInstall(pkgroot, prod, productRoot, instflavor, opts, noclean, setups, tag, distrib)
+
+    def _prepareInstall(self, pkgroot, prod, productRoot, instflavor, opts, tag):
+        """
+        Make the build directory for a product and find the Distrib that installs it;
+        return (distrib, builddir)
+        """
         if prod.instDir:
             installdir = prod.instDir
             if not os.path.isabs(installdir):
@@ -611,6 +1111,16 @@ class Repositories(object):
         if self.verbose > 1 and hasattr(distrib, 'NAME'):
             print("Using Distrib type:", distrib.NAME, file=self.log)
 
+        return distrib, builddir
+
+    def _buildPackage(self, distrib, prod, productRoot, setups, builddir):
+        """
+        Build and install a product in builddir.  This doesn't touch the ups_db, so builds of
+        products that don't depend on each other may run at the same time
+        """
+        prefetcher = self._prefetcher
+        if prefetcher:
+            prefetcher.waitForPackage((prod.product, prod.version))
         try:
             distrib.installPackage(distrib.parseDistID(prod.distId),
                                    prod.product, prod.version,
@@ -623,7 +1133,14 @@ class Repositories(object):
             raise e
         except RuntimeError as e:
             raise e
+        finally:
+            if prefetcher:
+                prefetcher.release((prod.product, prod.version))
 
+    def _finishInstall(self, pkgroot, prod, productRoot, instflavor, opts, noclean, setups, tag, distrib):
+        """
+        Declare a newly built product, run the distribInstallPostHook, and clean up
+        """
         # declare the newly installed package, if necessary
         if not instflavor:
             instflavor = opts["flavor"]
@@ -890,6 +890,18 @@ TAGLIST_DIR = tags
         location = self.parseDistID(self.getDistIdForPackage(product, version, flavor))
         return os.path.exists(os.path.join(serverDir, "products", location))
 
+    def prefetchPackage(self, location, product, version, buildDir):
+        """Download the eupspkg tarball that installPackage() will build,
+        into buildDir.
+        @param location     the location of the package on the server
+        @param product      the name of the product installed by the package.
+        @param version      the name of the product version.
+        @param buildDir     the directory that the product will be built in
+        """
+        return self.distServer.getFileForProduct(location, product, version,
+                                                 self.Eups.flavor, ftype="eupspkg",
+                                                 filename=os.path.join(buildDir, os.path.basename(location)))
+
     def installPackage(self, location, product, version, productRoot,
                        installDir, setups=None, buildDir=None):
         """Install a package with a given server location into a given
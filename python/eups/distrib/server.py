@@ -10,17 +10,25 @@ import re
 import atexit
 import fnmatch
 import shutil
+import socket
 import tempfile
+import threading
 try:
-    from urllib2 import urlopen, HTTPError, URLError
+    from urllib2 import urlopen, Request, HTTPError, URLError
+    from urllib import getproxies, proxy_bypass
+    from urlparse import urlsplit, urljoin
+    import httplib
 except ImportError:
-    from urllib.request import urlopen
+    from urllib.request import urlopen, Request, getproxies, proxy_bypass
     from urllib.error import HTTPError, URLError
+    from urllib.parse import urlsplit, urljoin
+    import http.client as httplib
 import eups
 import eups.hooks as hooks
 import eups.utils as utils
 
 from eups.exceptions import EupsException
+from .DownloadCache import getDownloadCache
 
 serverConfigFilename = "config.txt"
 BASH = "/bin/bash"    # see end of this module where we look for bash
@@ -368,7 +376,8 @@ class DistribServer(object):
         @param source      the name of the remote file to obtain a copy of
         @param noaction    if True, simulate the retrieval
         """
-        if not self.NOCACHE and source in self._fileCache:
+        cached = None if self.NOCACHE else self._fileCache.get(source)
+        if cached and os.path.exists(cached): # it may have been in a build directory that's been cleaned
             if self.verbose > 1:
                 msg = "%s has already been retrieved" % source
                 if self.verbose > 2:
@@ -376,7 +385,12 @@ class DistribServer(object):
 
                 print(msg, file=utils.stdinfo)
 
-            shutil.copy(self._fileCache[source], filename)
+            if os.path.realpath(cached) != os.path.realpath(filename):
+                parent = os.path.dirname(filename)
+                if parent and not os.path.isdir(parent):
+                    os.makedirs(parent)
+
+                shutil.copy(cached, filename)
 
             return filename
 
@@ -387,7 +401,14 @@ class DistribServer(object):
         if parent and not os.path.isdir(parent):
             os.makedirs(parent)
 
-        trx.cacheToFile(filename, noaction=noaction) # this is not a cache! It's "copy to local file"
+        downloadCache = None
+        if not self.NOCACHE and not noaction:
+            downloadCache = getDownloadCache(self.verbose, self.log)
+
+        if downloadCache:
+            downloadCache.retrieve(trx, filename)
+        else:
+            trx.cacheToFile(filename, noaction=noaction) # this is not a cache! It's "copy to local file"
 
         self._fileCache[source] = filename
 
@@ -981,6 +1002,23 @@ class Transporter(object):
         """
         self.unimplemented("cacheToFile");
 
+    def cacheToFileIfChanged(self, filename, validator=None):
+        """cache the source to a local file, unless it is unchanged since
+        it was last retrieved.  Return (changed, validator) where changed is
+        False if the source is the version identified by the input validator
+        (in which case the file is not written), and validator is a string
+        identifying the version of the source, or None if this Transporter
+        can't tell.
+
+        This implementation always retrieves the file, and returns a None
+        validator.
+        @param filename      the name of the file to cache to
+        @param validator     the validator returned when the source was
+                               last retrieved, or None
+        """
+        self.cacheToFile(filename)
+        return True, None
+
     def listDir(self, noaction=False):
         """interpret the source as a directory and return a list of files
         it contains
@@ -991,6 +1029,148 @@ class Transporter(object):
     def unimplemented(self, name):
         raise Exception("%s: unimplemented (abstract) method" % name)
 
+class HTTPConnectionPool(object):
+    """a pool of persistent (keep-alive) HTTP and HTTPS connections, so
+    that retrieving many files from a server doesn't need a new connection
+    (and, for https, a new TLS handshake) for each of them.  A connection
+    is used by one request at a time, so concurrent requests to a server
+    use several connections; up to maxPerHost idle connections to each
+    server are kept for later requests.  The pool may be shared between
+    threads.
+    """
+
+    def __init__(self, maxPerHost=4):
+        self.maxPerHost = maxPerHost
+        self._idle = {}                 # idle connections, indexed by (scheme, host:port)
+        self._lock = threading.Lock()
+
+    def urlopen(self, url, headers=None, maxRedirects=5):
+        """open an http or https URL, returning a response that behaves
+        like the one returned by urllib's urlopen (and raising HTTPError or
+        URLError in the same circumstances).  The response must be closed
+        to return its connection to the pool.
+        @param url           the URL to retrieve
+        @param headers       a dictionary of extra headers to send
+        @param maxRedirects  the number of redirections to follow
+        """
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+
+        reqHeaders = {"Accept-Encoding": "identity"}
+        if headers:
+            reqHeaders.update(headers)
+
+        while True:
+            conn, reused = self._getConnection(key)
+            try:
+                conn.request("GET", path, headers=reqHeaders)
+                response = conn.getresponse()
+                break
+            except (socket.error, httplib.HTTPException) as e:
+                conn.close()
+                if not reused:
+                    raise URLError(e)
+                                        # the server may have closed an idle connection; try a new one
+
+        if response.status in (301, 302, 303, 307, 308) and maxRedirects > 0 and \
+               response.getheader("Location"):
+            location = urljoin(url, response.getheader("Location"))
+            response.read()
+            self._release(key, conn, response)
+            return self.urlopen(location, headers, maxRedirects - 1)
+
+        if response.status >= 300:
+            response.read()
+            self._release(key, conn, response)
+            raise HTTPError(url, response.status, response.reason, response.msg, None)
+
+        return _PooledResponse(self, key, conn, response)
+
+    def _getConnection(self, key):
+        """return (connection, reused) for a server"""
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+
+        scheme, netloc = key
+        if scheme == "https":
+            return httplib.HTTPSConnection(netloc), False
+        else:
+            return httplib.HTTPConnection(netloc), False
+
+    def _release(self, key, conn, response):
+        """return a connection to the pool once its response has been read"""
+        if response.will_close or not response.isclosed() or response.length:
+            conn.close()                # (a non-zero length means that the body was cut short)
+            return
+
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.maxPerHost:
+                idle.append(conn)
+                return
+
+        conn.close()
+
+    def close(self):
+        """close all the idle connections"""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+class _PooledResponse(object):
+    """the response to a request made via an HTTPConnectionPool"""
+
+    def __init__(self, pool, key, conn, response):
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._response = response
+        self.headers = response.msg
+        self.code = response.status
+
+    def info(self):
+        return self.headers
+
+    def getcode(self):
+        return self.code
+
+    def read(self, amt=None):
+        if amt is None:
+            return self._response.read()
+        return self._response.read(amt)
+
+    def __iter__(self):
+        return iter(self.read().splitlines(True))
+
+    def close(self):
+        if self._conn is not None:
+            self._pool._release(self._key, self._conn, self._response)
+            self._conn = None
+
+connectionPool = HTTPConnectionPool()
+
+def openURL(url, headers=None):
+    """open a URL, as urllib's urlopen would, but reusing one of the
+    connectionPool's connections for http and https URLs unless they are to
+    be retrieved through a proxy
+    @param url       the URL to open
+    @param headers   a dictionary of extra headers to send
+    """
+    scheme, netloc = urlsplit(url)[:2]
+    if scheme in ("http", "https") and \
+           (scheme not in getproxies() or proxy_bypass(netloc.split(":")[0])):
+        return connectionPool.urlopen(url, headers)
+
+    return urlopen(Request(url, headers=headers or {}))
+
 class WebTransporter(Transporter):
     """a class that can return files via an HTTP or FTP URL"""
 
@@ -1017,27 +1197,158 @@ class WebTransporter(Transporter):
                 system("touch " + filename)
                 print("Simulated web retrieval from", self.loc, file=self.log)
         else:
+            self.cacheToFileIfChanged(filename)
+
+    checksumMinBytes = 1024*1024        # look for a published checksum for files at least this large
+
+    def cacheToFileIfChanged(self, filename, validator=None):
+        """cache the source to a local file, unless it is unchanged since
+        it was last retrieved (as told by the server, given the ETag or
+        Last-Modified header that's returned as the validator).
+
+        The file is written to filename.partial and renamed once it's
+        complete.  If the transfer is interrupted it's resumed where it
+        stopped (with an HTTP Range request), up to
+        hooks.config.Eups.downloadRetries times; a partial file left by an
+        earlier, interrupted, attempt is resumed too, if the server's copy
+        hasn't changed since.  If the server publishes a SHA-256 checksum
+        for the file (as <url>.sha256), large or resumed files are checked
+        against it.
+        @param filename      the name of the file to cache to
+        @param validator     the validator returned when the source was
+                               last retrieved, or None
+        """
+        partial = filename + ".partial"
+        partialValidator = partial + ".validator" # identifies the version of the source in partial
+        retries = hooks.config.Eups.downloadRetries
+        resumed = False
+        started = False                 # have we written to partial?
+
+        while True:
+            offset, ifRange = 0, None
+            if os.path.exists(partial) and os.path.exists(partialValidator):
+                with open(partialValidator) as fd:
+                    ifRange = fd.read().strip()
+                if ifRange or started: # we can only trust an earlier attempt's file if we know its version
+                    offset = os.stat(partial).st_size
+
+            headers = {}
+            if offset > 0:
+                headers["Range"] = "bytes=%d-" % offset
+                if ifRange:
+                    headers["If-Range"] = ifRange
+            elif validator:
+                what, value = validator.split(":", 1)
+                if what == "etag":
+                    headers["If-None-Match"] = value
+                elif what == "modified":
+                    headers["If-Modified-Since"] = value
+
             url = None
             out = None
             try:
                 try:                               # for python 2.4 compat
-                    url = urlopen(self.loc)
-                    out = open(filename, 'wb')
-                    while True:
-                        chunk = url.read(1024 * 1024)   # read 1MB at a time for small-memory machines
-                        if not chunk:
-                            break
-                        out.write(chunk)
+                    url = openURL(self.loc, headers)
                 except HTTPError as e:
+                    if e.code == 304:                   # Not Modified
+                        return False, validator
+                    if e.code == 416 and offset > 0:    # Range Not Satisfiable; start again
+                        self._removePartial(partial)
+                        continue
                     raise RemoteFileNotFound("Failed to open URL %s (%s)" % (self.loc, e.reason))
                 except URLError as e:
                     raise ServerNotResponding("Failed to contact URL %s (%s)" % (self.loc, e.reason))
-                except KeyboardInterrupt:
-                    raise EupsException("^C")
+
+                info = url.info()
+                if offset > 0 and url.getcode() == 206 and \
+                       re.search(r"^bytes\s+%d-" % offset, info.get("Content-Range", "")):
+                    out = open(partial, 'ab')
+                    resumed = True
+                    if self.verbose > 0:
+                        print("Resuming retrieval of %s after %d bytes" % (self.loc, offset), file=self.log)
+                else:                   # the whole file
+                    offset = 0
+                    out = open(partial, 'wb')
+                    with open(partialValidator, 'w') as fd:
+                        fd.write("%s\n" % (info.get("ETag") or info.get("Last-Modified") or ""))
+
+                started = True
+                length = info.get("Content-Length")
+                length = int(length) if length else None
+                nread = 0
+                complete, why = False, None
+                while True:
+                    try:                # only network errors mean that the transfer was interrupted
+                        chunk = url.read(1024 * 1024)   # read 1MB at a time for small-memory machines
+                    except (socket.error, httplib.HTTPException) as e:
+                        why = str(e)
+                        break
+                    if not chunk:
+                        complete = (length is None or nread == length)
+                        why = "got %d of %d bytes" % (nread, length or 0)
+                        break
+                    out.write(chunk)
+                    nread += len(chunk)
+            except KeyboardInterrupt:
+                raise EupsException("^C")
             finally:
                 if url is not None: url.close()
                 if out is not None: out.close()
 
+            if not complete:
+                if retries <= 0:
+                    raise ServerNotResponding("Retrieval of %s was interrupted (%s)" % (self.loc, why))
+                retries -= 1
+                if self.verbose >= 0:
+                    print("Retrieval of %s was interrupted (%s); resuming" % (self.loc, why), file=self.log)
+                continue
+
+            if resumed or offset + nread >= self.checksumMinBytes:
+                checksum = self._publishedChecksum()
+                if checksum and checksum != utils.fileChecksum(partial):
+                    self._removePartial(partial)
+                    if resumed and retries > 0: # the pieces may not match; try again from the start
+                        retries -= 1
+                        resumed = False
+                        if self.verbose >= 0:
+                            print("Checksum of %s doesn't match; retrieving it again" % self.loc,
+                                  file=self.log)
+                        continue
+                    raise RemoteFileInvalid("Checksum of %s doesn't match %s.sha256" % (self.loc, self.loc))
+
+            os.rename(partial, filename)
+            os.remove(partialValidator)
+
+            if info.get("ETag"):
+                return True, "etag:%s" % info.get("ETag")
+            elif info.get("Last-Modified"):
+                return True, "modified:%s" % info.get("Last-Modified")
+            else:
+                return True, None
+
+    def _removePartial(self, partial):
+        """remove a partially retrieved file (and the record of its version)"""
+        for f in (partial, partial + ".validator"):
+            if os.path.exists(f):
+                os.remove(f)
+
+    def _publishedChecksum(self):
+        """return the SHA-256 checksum that the server publishes for the
+        source (in <url>.sha256, as written by sha256sum), or None"""
+        url = None
+        try:
+            try:
+                url = openURL(self.loc + ".sha256")
+                words = url.read().decode("utf-8", "replace").split()
+            except (HTTPError, URLError, socket.error, httplib.HTTPException):
+                return None
+        finally:
+            if url is not None: url.close()
+
+        if words and re.search(r"^[0-9a-fA-F]{64}$", words[0]):
+            return words[0].lower()
+        return None
+
     def listDir(self, noaction=False):
         """interpret the source as a directory and return a list of files
         it contains
@@ -1095,7 +1406,7 @@ class WebTransporter(Transporter):
         p = LinksParser()
         try:
           try:                               # for python 2.4 compat
-            url = urlopen(self.loc)
+            url = openURL(self.loc)
             encoding = utils.get_content_charset(url)
             for line in url:
                 p.feed(utils.decode(line, encoding))
@@ -1166,6 +1477,35 @@ class SshTransporter(Transporter):
             else:
                 print("scp from", self.remfile, file=self.log)
 
+    def cacheToFileIfChanged(self, filename, validator=None):
+        """cache the source to a local file, unless its modification time
+        and size are unchanged since it was last retrieved
+        @param filename      the name of the file to cache to
+        @param validator     the validator returned when the source was
+                               last retrieved, or None
+        """
+        if re.search(r'[;,&\|"\']', self.remfile):
+            raise OSError("remote file has dangerous location name: " + self.loc)
+
+        (remmach, remfile) = self.remfile.split(':', 1)
+        # GNU stat, then BSD stat
+        cmd = r"ssh %s 'stat -L -c \"%%Y %%s\" %s 2>/dev/null || stat -L -f \"%%m %%z\" %s' 2>/dev/null" % \
+              (remmach, remfile, remfile)
+        pd = os.popen(cmd)
+        try:
+            stat = pd.read().split()
+        finally:
+            pd.close()
+
+        current = None
+        if len(stat) == 2:
+            current = "mtime=%s size=%s" % tuple(stat)
+            if current == validator:
+                return False, validator
+
+        self.cacheToFile(filename)
+        return True, current
+
     def listDir(self, noaction=False):
         """interpret the source as a directory and return a list of files
         it contains
@@ -1243,6 +1583,25 @@ class LocalTransporter(Transporter):
                 raise TransporterError("Failed to retrieve %s: %s" %
                                        (self.loc, str(e)))
 
+    def cacheToFileIfChanged(self, filename, validator=None):
+        """cache the source to a local file, unless its modification time
+        and size are unchanged since it was last retrieved
+        @param filename      the name of the file to cache to
+        @param validator     the validator returned when the source was
+                               last retrieved, or None
+        """
+        try:
+            st = os.stat(self.loc)
+        except OSError:
+            raise RemoteFileNotFound("%s: file not found" % self.loc)
+
+        current = "mtime=%r size=%d" % (st.st_mtime, st.st_size)
+        if current == validator:
+            return False, validator
+
+        self.cacheToFile(filename)
+        return True, current
+
     def listDir(self, noaction=False):
         """interpret the source as a directory and return a list of files
         it contains
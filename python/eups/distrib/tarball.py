@@ -170,6 +170,21 @@ DIST_URL = %s
         location = self.parseDistID(self.getDistIdForPackage(product, version, flavor))
         return os.path.exists(os.path.join(serverDir, location))
 
+    def prefetchPackage(self, location, product, version, buildDir):
+        """Download the tarball that installPackage() will unpack into
+        buildDir, where installPackage() would put it.
+        @param location     the location of the package on the server
+        @param product      the name of the product installed by the package.
+        @param version      the name of the product version.
+        @param buildDir     the directory that the product will be built in
+        """
+        if not location:
+            return None
+
+        return self.distServer.getFileForProduct(location, product, version,
+                                                 self.Eups.flavor, ftype="dist",
+                                                 filename=os.path.join(buildDir, location))
+
     def installPackage(self, location, product, version, productRoot,
                        installDir=None, setups=None, buildDir=None):
         """Install a package with a given server location into a given
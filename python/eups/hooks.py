@@ -34,7 +34,7 @@ def defineProperties(names, parentName=None):
 
 # various configuration properties settable by the user
 config = defineProperties("Eups distrib site user")
-config.Eups = defineProperties("userTags preferredTags globalTags reservedTags defaultTags verbose asAdmin setupTypes setupCmdName VRO fallbackFlavors defaultProduct startupFileName repoVersioner versionIncrementer colorize", "Eups")
+config.Eups = defineProperties("userTags preferredTags globalTags reservedTags defaultTags verbose asAdmin setupTypes setupCmdName VRO fallbackFlavors defaultProduct startupFileName repoVersioner versionIncrementer colorize cacheFormat setupCache tableCache dependencyThreads prefetchThreads prefetchBytes downloadCache downloadCacheSize downloadRetries", "Eups")
 config.Eups.setType("verbose", int)
 
 config.Eups.userTags = []
@@ -71,6 +71,47 @@ config.Eups.defaultProduct = {"name" : "implicitProducts", "version" : None, "ta
 
 config.Eups.colorize = False
 #
+# The format of the product caches: "pickle" or "inventory" (a binary format that is read via mmap,
+# so that only the data for the products that are used need be read).  'eups admin buildCache' always
+# writes caches in both formats.
+#
+config.Eups.cacheFormat = "pickle"
+#
+# Remember the changes that setup makes to the environment, and replay them when the same setup is
+# requested again in the same environment and with the product stacks unchanged.  Messages printed
+# by the original setup are not repeated.
+#
+config.Eups.setupCache = False
+#
+# Keep the parsed form of table files in the user's product caches, and reuse it while the table file
+# is unchanged.
+#
+config.Eups.tableCache = True
+#
+# The number of threads used to read the table files of a product's dependencies when listing them
+# (e.g. eups list -D, eups uses).  0 or 1 reads them one at a time.
+#
+config.Eups.dependencyThreads = 4
+#
+# The number of threads used by eups distrib install to download the manifests and distribution files of
+# the products to be installed while earlier products are being built (0 downloads each file when it's
+# needed), and the number of bytes of downloaded files that may be waiting to be used.
+#
+config.Eups.prefetchThreads = 4
+config.Eups.prefetchBytes = 2*1024**3
+#
+# Where to keep the files downloaded from distribution servers so that they needn't be downloaded again:
+# False (the default) disables the cache, True means the _downloads_ directory in the user data directory,
+# and a string is the name of a directory (which may be shared by several users).  The least recently used
+# files are deleted when the cache is larger than downloadCacheSize bytes.
+#
+config.Eups.downloadCache = False
+config.Eups.downloadCacheSize = 10*1024**3
+#
+# The number of times that an interrupted download from an http server is resumed before giving up
+#
+config.Eups.downloadRetries = 3
+#
 # Configure things that apply to the entire site
 #
 config.site = defineProperties("lockDirectoryBase", "site")
@@ -231,7 +231,7 @@ product and all its dependencies into the environment so that it can be used.
             try:
                 Eups = eups.Eups(flavor=self.opts.flavor, path=self.opts.path,
                                  dbz=self.opts.dbz, # root=self.opts.productDir,
-                                 readCache=False, force=self.opts.force,
+                                 readCache=False, readOnlyCache=True, force=self.opts.force,
                                  quiet=self.opts.quiet, verbose=self.opts.verbose,
                                  noaction=self.opts.noaction, keep=self.opts.keep,
                                  ignore_versions=self.opts.ignoreVer, setupType=self.opts.setupType,
@@ -0,0 +1,312 @@
+"""
+a compact, binary format for persisting the products in a ProductStack.
+
+An inventory file holds the product data for a single flavor.  It is read
+via mmap, so looking up a product only touches the parts of the file that
+describe it; this is much cheaper than unpickling the data for every
+product in the stack when a command only needs a few of them.
+
+The file is laid out as follows (all integers are little-endian):
+   header           magic string, format version, the number of product,
+                      version and tag records, and the offsets to each of
+                      the sections below
+   product records  one fixed-width record per product, sorted by name,
+                      giving the name and the ranges of its version and
+                      tag records
+   version records  one fixed-width record per version, giving the
+                      version name, install directory and table file
+   tag records      one fixed-width record per tag assignment, giving the
+                      tag and version names
+   string table     the UTF-8 encoded strings referred to by the records
+   metadata         a pickle of when the product modification times were
+                      collected and the state of the database at the time
+                      (see ProductStack.productTimes)
+   product times    a pickle of the modification times of the products in
+                      the database; this is only read when needed
+
+Strings are referred to by (offset, length) pairs into the string table; a
+length of 0xffffffff denotes None.
+"""
+from __future__ import absolute_import
+import mmap, struct
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+from eups import utils
+from .ProductFamily import ProductFamily
+
+magic = b"EUPSINV\n"
+
+_header = struct.Struct("<8sIIIIIIIIIIII")
+_product = struct.Struct("<IIIIII")
+_version = struct.Struct("<IIIIII")
+_tag = struct.Struct("<IIII")
+
+_none = 0xffffffff
+
+def _encode(s):
+    if isinstance(s, bytes):
+        return s
+    return s.encode("utf-8")
+
+def _decode(b):
+    if str is bytes:                    # python 2
+        return b
+    return b.decode("utf-8")
+
+class Inventory(object):
+    """
+    read-only access to the product data in an inventory file.
+    """
+    # static variable: the version of the format implemented here.  This is
+    # part of the name of the files written by ProductStack, so change it if
+    # the layout changes.
+    formatVersion = 2
+
+    def __init__(self, file):
+        """
+        open an inventory file
+        @param file    the path to the file
+        """
+        self.file = file
+
+        fd = open(file, "rb")
+        try:
+            self._map = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            fd.close()
+
+        try:
+            (mag, vers, self._nproducts, self._nversions, self._ntags,
+             self._productOff, self._versionOff, self._tagOff,
+             self._stringOff, self._metaOff, self._metaLen,
+             self._timesOff, self._timesLen) = \
+                 _header.unpack_from(self._map, 0)
+        except struct.error:
+            mag, vers = None, None
+        if mag != magic or vers != self.formatVersion:
+            self.close()
+            raise RuntimeError("%s: not an EUPS inventory file (format %d)" %
+                               (file, self.formatVersion))
+
+    def close(self):
+        """
+        release the memory mapping of the file
+        """
+        self._map.close()
+
+    def __len__(self):
+        return self._nproducts
+
+    def _bytes(self, off, length):
+        if length == _none:
+            return None
+        off += self._stringOff
+        return self._map[off:off+length]
+
+    def _string(self, off, length):
+        b = self._bytes(off, length)
+        if b is None:
+            return None
+        return _decode(b)
+
+    def _productRecord(self, i):
+        return _product.unpack_from(self._map, self._productOff + i*_product.size)
+
+    def _find(self, name):
+        # return the index of the named product's record, or -1
+        name = _encode(name)
+        lo, hi = 0, self._nproducts
+        while lo < hi:
+            mid = (lo + hi) // 2
+            rec = self._productRecord(mid)
+            found = self._bytes(rec[0], rec[1])
+            if found < name:
+                lo = mid + 1
+            elif found > name:
+                hi = mid
+            else:
+                return mid
+        return -1
+
+    def getProductNames(self):
+        """
+        return the names of all the products in the inventory, in sorted
+        order
+        """
+        out = []
+        for i in range(self._nproducts):
+            rec = self._productRecord(i)
+            out.append(self._string(rec[0], rec[1]))
+        return out
+
+    def hasProduct(self, name):
+        """
+        return True if the named product is in the inventory
+        """
+        return self._find(name) >= 0
+
+    def getFamily(self, name, root=None):
+        """
+        return the versions of the named product as a ProductFamily.
+        A KeyError is raised if the product is not in the inventory.
+        @param root    the root directory of the product stack (see
+                         ProductFamily)
+        """
+        i = self._find(name)
+        if i < 0:
+            raise KeyError(name)
+
+        rec = self._productRecord(i)
+        out = ProductFamily(self._string(rec[0], rec[1]), root)
+
+        for j in range(rec[2], rec[2] + rec[3]):
+            vrec = _version.unpack_from(self._map, self._versionOff + j*_version.size)
+            out.addVersion(self._string(vrec[0], vrec[1]),
+                           self._string(vrec[2], vrec[3]),
+                           self._string(vrec[4], vrec[5]))
+
+        for j in range(rec[4], rec[4] + rec[5]):
+            trec = _tag.unpack_from(self._map, self._tagOff + j*_tag.size)
+            out.assignTag(self._string(trec[0], trec[1]), self._string(trec[2], trec[3]))
+
+        return out
+
+    def getProductTimes(self, withProducts=True):
+        """
+        return the product modification times stored with the inventory
+        (see ProductStack.productTimes), or None if none were stored.
+        @param withProducts  if False, don't read the times of the
+                               individual products (which requires
+                               reading every product record); the
+                               "products" entry will be None.
+        """
+        data = self._map[self._metaOff:self._metaOff+self._metaLen]
+        out = pickle.loads(data)
+        if out is None:
+            return None
+
+        out["products"] = None
+        if withProducts:
+            data = self._map[self._timesOff:self._timesOff+self._timesLen]
+            out["products"] = pickle.loads(data)
+
+        return out
+
+    # @staticmethod   # requires python 2.4
+    def write(file, families, productTimes=None):
+        """
+        write product data to an inventory file.  The file is written
+        atomically, so readers will see either the old or the new contents.
+        @param file          the path to the file to write
+        @param families      a lookup of ProductFamily instances keyed by
+                                product name
+        @param productTimes  the product modification times to store with the
+                                data
+        """
+        strings = []
+        stringRefs = {}
+        size = [0]
+        def ref(s):
+            if s is None:
+                return (0, _none)
+            s = _encode(s)
+            if s not in stringRefs:
+                stringRefs[s] = (size[0], len(s))
+                strings.append(s)
+                size[0] += len(s)
+            return stringRefs[s]
+
+        meta, mtimes = None, None
+        if productTimes:
+            meta = dict((k, v) for k, v in productTimes.items() if k != "products")
+            mtimes = productTimes["products"]
+
+        products, versions, tags = [], [], []
+        for name in sorted(families.keys(), key=_encode):
+            fam = families[name]
+            firstVersion, firstTag = len(versions), len(tags)
+            for vers in sorted(fam.versions.keys()):
+                installdir, tablefile = fam.getVersionData(vers)[:2]
+                versions.append(_version.pack(*(ref(vers) + ref(installdir) + ref(tablefile))))
+            for tag in sorted(fam.tags.keys()):
+                tags.append(_tag.pack(*(ref(tag) + ref(fam.tags[tag]))))
+            products.append(_product.pack(*(ref(name) +
+                                            (firstVersion, len(versions) - firstVersion,
+                                             firstTag, len(tags) - firstTag))))
+
+        meta = pickle.dumps(meta, protocol=2)
+        mtimes = pickle.dumps(mtimes, protocol=2)
+
+        productOff = _header.size
+        versionOff = productOff + len(products)*_product.size
+        tagOff = versionOff + len(versions)*_version.size
+        stringOff = tagOff + len(tags)*_tag.size
+        metaOff = stringOff + size[0]
+        timesOff = metaOff + len(meta)
+
+        fd = utils.AtomicFile(file, "wb")
+        fd.write(_header.pack(magic, Inventory.formatVersion, len(products), len(versions), len(tags),
+                              productOff, versionOff, tagOff, stringOff, metaOff, len(meta),
+                              timesOff, len(mtimes)))
+        for section in (products, versions, tags, strings):
+            fd.write(b"".join(section))
+        fd.write(meta)
+        fd.write(mtimes)
+        fd.close()
+    write = staticmethod(write)    # works since python2.2
+
+class InventoryLookup(MutableMapping):
+    """
+    a lookup of ProductFamily instances keyed by product name which is
+    backed by an Inventory.  Families are read from the inventory the first
+    time they are accessed; updates are held in memory.
+    """
+
+    def __init__(self, inventory, root=None):
+        self.inventory = inventory
+        self.root = root                # the root directory of the product stack
+        self._loaded = {}               # families read or set, by name
+        self._removed = set()           # names deleted from the inventory
+
+    def __getitem__(self, name):
+        try:
+            return self._loaded[name]
+        except KeyError:
+            pass
+        if name in self._removed:
+            raise KeyError(name)
+
+        fam = self.inventory.getFamily(name, self.root)
+        self._loaded[name] = fam
+        return fam
+
+    def __setitem__(self, name, family):
+        self._loaded[name] = family
+        self._removed.discard(name)
+
+    def __delitem__(self, name):
+        if name not in self:
+            raise KeyError(name)
+        self._loaded.pop(name, None)
+        self._removed.add(name)
+
+    def __contains__(self, name):
+        if name in self._loaded:
+            return True
+        return name not in self._removed and self.inventory.hasProduct(name)
+
+    def __iter__(self):
+        for name in self.inventory.getProductNames():
+            if name not in self._loaded and name not in self._removed:
+                yield name
+        for name in list(self._loaded.keys()):
+            yield name
+
+    def __len__(self):
+        return len(list(iter(self)))
@@ -5,30 +5,140 @@ import eups.tags
 from eups.exceptions import ProductNotFound, TableFileNotFound
 from eups.table import Table
 
+_intern = utils.internString
+
+class VersionRecord(object):
+    """
+    the cached description of a single version of a product: its
+    installation directory, the path to its table file and the parsed Table
+    (or None if it hasn't been loaded).
+
+    A stack may hold tens of thousands of these, so they're kept small:
+    there's no per-instance dictionary, the strings are interned, and the
+    paths are stored relative to the stack root (the directory) and to the
+    installation directory (the table file) where possible; the flags
+    attribute records which.  Use getDir() and getTablefile() to get the
+    full paths.
+    """
+    __slots__ = ("dir", "tablefile", "table", "flags")
+
+    # bits in flags
+    DIR_IN_ROOT = 0x1                   # dir is relative to the stack root
+    TABLE_IN_DIR = 0x2                  # tablefile is relative to the installation directory
+
+    def __init__(self, installdir, tablefile=None, table=None, root=None):
+        """
+        @param installdir   the installation directory
+        @param tablefile    the path to the table file, or None
+        @param table        the parsed Table, or None
+        @param root         the root of the product stack.  If None, the
+                              paths will be stored as given.
+        """
+        flags = 0
+        sl = os.path.sep
+        if tablefile and installdir and tablefile.startswith(installdir + sl):
+            tablefile = tablefile[len(installdir) + 1:]
+            flags |= self.TABLE_IN_DIR
+        if root and installdir and installdir.startswith(root + sl):
+            installdir = installdir[len(root) + 1:]
+            flags |= self.DIR_IN_ROOT
+
+        self.__setstate__((installdir, tablefile, table, flags))
+
+    def getDir(self, root=None):
+        """
+        return the installation directory
+        @param root   the root of the product stack that the record was
+                        created with
+        """
+        if self.flags & self.DIR_IN_ROOT:
+            return os.path.join(root, self.dir)
+        return self.dir
+
+    def getTablefile(self, root=None):
+        """
+        return the path to the table file
+        @param root   the root of the product stack that the record was
+                        created with
+        """
+        if self.flags & self.TABLE_IN_DIR:
+            return os.path.join(self.getDir(root), self.tablefile)
+        return self.tablefile
+
+    def withTable(self, table):
+        """
+        return a copy of this record with a different parsed Table
+        """
+        out = VersionRecord.__new__(VersionRecord)
+        out.__setstate__((self.dir, self.tablefile, table, self.flags))
+        return out
+
+    def __getstate__(self):
+        return (self.dir, self.tablefile, self.table, self.flags)
+
+    def __setstate__(self, state):
+        dir, tablefile, self.table, self.flags = state
+        self.dir = _intern(dir)
+        self.tablefile = _intern(tablefile)
+
 class ProductFamily(object):
     """
     a set of different versions of a named product.  When this refers to
     installed products, it is assumed that all versions are of the same flavor.
     """
+    __slots__ = ("name", "versions", "tags", "root")
 
-    def __init__(self, name):
+    def __init__(self, name, root=None):
         """
         create a product family with a given product name
+        @param name    the product name
+        @param root    the root directory of the product stack; the paths
+                         of the versions that are installed below it are
+                         stored relative to it
         """
 
         # the product name
-        self.name = name
+        self.name = _intern(name)
 
         # a lookup for version-specific information where the keys are the
-        # version names and the values are tuples containing the installation
-        # directory, the dependencies table, and a corresponding instance of
-        # Table (which may be None).
+        # version names and the values are VersionRecords giving the
+        # installation directory, the dependencies table, and a
+        # corresponding instance of Table (which may be None).
         self.versions = {}
 
         # a lookup of tag assignments where each key is a tag name and its
         # value is the version name assigned to the tag.
         self.tags = {}
 
+        # the root directory of the product stack
+        self.root = _intern(root)
+
+    def __getstate__(self):
+        return (self.name, self.versions, self.tags, self.root)
+
+    def __setstate__(self, state):
+        if isinstance(state, dict):     # pickled before we had __slots__
+            state = (state["name"], state["versions"], state["tags"], None)
+
+        name, versions, tags, root = state
+        self.name = _intern(name)
+        self.root = _intern(root)
+        self.versions = {}
+        for vers, versdata in versions.items():
+            if isinstance(versdata, tuple):
+                versdata = VersionRecord(*versdata)
+            self.versions[_intern(vers)] = versdata
+        self.tags = dict([(_intern(t), _intern(v)) for t, v in tags.items()])
+
+    def getVersionData(self, version):
+        """
+        return a tuple giving the installation directory and table file of
+        a version, and the parsed Table (which may be None).  A KeyError is
+        raised if the version isn't registered.
+        """
+        versdata = self.versions[version]
+        return (versdata.getDir(self.root), versdata.getTablefile(self.root), versdata.table)
+
     def getVersions(self):
         """
         return a list containing the verison names in this product family
@@ -46,14 +156,13 @@ class ProductFamily(object):
         @return    the product description as a Product instance
         """
         try:
-            versdata = self.versions[version]
+            installdir, tablefile, table = self.getVersionData(version)
             tags = [item[0] for item in [x for x in self.tags.items() if x[1] == version]]
             out = Product(self.name, version, flavor,
-                          versdata[0],    # the install directory
-                          versdata[1],    # the table file
+                          installdir, tablefile,
                           tags, dbpath)
-            if versdata[2]:
-                out._table = versdata[2]
+            if table:
+                out._table = table
             return out
 
         except KeyError:
@@ -137,7 +246,7 @@ class ProductFamily(object):
             msg = "Missing version name while registering new version " + \
                 "for product %s: %s"
             raise RuntimeError(msg % (self.name, version))
-        self.versions[version] = (installdir, tablefile, table)
+        self.versions[_intern(version)] = VersionRecord(installdir, tablefile, table, self.root)
 
     def hasVersion(self, version):
         """
@@ -177,7 +286,7 @@ class ProductFamily(object):
             raise ProductNotFound(self.name, version)
 
         tag = str(tag)
-        self.tags[tag] = version
+        self.tags[_intern(tag)] = _intern(version)
 
     def unassignTag(self, tag, file=None):
         """
@@ -208,13 +317,14 @@ class ProductFamily(object):
         try:
             verdata = self.versions[version]
             if not table:
-                if not utils.isRealFilename(verdata[1]):
+                tablefile = verdata.getTablefile(self.root)
+                if not utils.isRealFilename(tablefile):
                     return
-                if not os.path.exists(verdata[1]):
-                    raise TableFileNotFound(verdata[1], self.name, version)
+                if not os.path.exists(tablefile):
+                    raise TableFileNotFound(tablefile, self.name, version)
                 prod = self.getProduct(version)
-                table = Table(verdata[1]).expandEupsVariables(prod)
-            self.versions[version] = (verdata[0], verdata[1], table)
+                table = Table(tablefile).expandEupsVariables(prod)
+            self.versions[version] = verdata.withTable(table)
         except KeyError:
             raise ProductNotFound(self.name, version)
 
@@ -1,5 +1,5 @@
 from __future__ import absolute_import, print_function
-import re, os, sys
+import re, os, sys, time, hashlib
 try:
     import cPickle as pickle
 except ImportError:
@@ -7,6 +7,7 @@ except ImportError:
 from eups import utils
 from eups import Product
 from .ProductFamily import ProductFamily
+from .Inventory import Inventory, InventoryLookup
 from eups.exceptions import EupsException,ProductNotFound, UnderSpecifiedProduct
 from eups.db import Database
 from ..utils import xrange
@@ -16,7 +17,7 @@ from ..utils import xrange
 
 # the version name for the persistence format used by this implementation.
 # It is intended to match the version of EUPS when this format was introduced
-persistVersionName = "1.3.0"
+persistVersionName = "2.2.0"
 
 # the prefix to a tag name that labels it as a user tag.  Anything left over is
 # considered a global tag.
@@ -56,10 +57,20 @@ class ProductStack(object):
     # static variable: regexp for cache file names
     persistFileRe = re.compile(r'^(\w\S*)\.%s$' % persistFileExt)
 
+    # static variable: name of file extension to use to persist data in the
+    # binary inventory format
+    inventoryFileExt = "inventory%d" % Inventory.formatVersion
+
+    # static variable: regexp for inventory file names
+    inventoryFileRe = re.compile(r'^(\w\S*)\.%s$' % inventoryFileExt)
+
+    # static variable: the formats that product data can be persisted in
+    persistFormats = ["pickle", "inventory"]
+
     # static variable: name of file extension to use to persist data
     userTagFileExt = "pickleTag%s" % dotre.sub('_', persistVersionName)
 
-    def __init__(self, dbpath, persistDir=None, autosave=True):
+    def __init__(self, dbpath, persistDir=None, autosave=True, cacheFormat=None):
         """
         create the stack with a given database
         @param dbpath             the path to the ups_db directory
@@ -68,6 +79,9 @@ class ProductStack(object):
                                      directory.
         @param autosave           if true (default), all updates will be
                                      saved to disk.
+        @param cacheFormat        the format to persist data in; one of
+                                     persistFormats.  If None, "pickle"
+                                     will be used.
         """
         # the path to the ups_db directory
         self.dbpath = dbpath
@@ -77,6 +91,13 @@ class ProductStack(object):
         if not os.path.exists(self.dbpath):
             raise IOError(dbpath + ": EUPS database directory not found")
 
+        # the root of the stack (as in Product.stackRoot()); the
+        # ProductFamilies store the paths of products installed below it
+        # relative to it
+        self.root = self.dbpath
+        if os.path.basename(self.dbpath) == "ups_db":
+            self.root = os.path.dirname(self.dbpath)
+
         # a hierarchical dictionary for looking up products.  The dimensions
         # of the hierarchy (from left to right, general to specific) are:
         #   * flavor
@@ -99,6 +120,14 @@ class ProductStack(object):
         # not save any new changes to it.
         self.modtimes = {}
 
+        # the format to persist this data in (one of persistFormats)
+        if cacheFormat is None:
+            cacheFormat = "pickle"
+        if cacheFormat not in self.persistFormats:
+            raise RuntimeError("Unknown product cache format \"%s\"; expected one of %s" %
+                               (cacheFormat, ", ".join(self.persistFormats)))
+        self.cacheFormat = cacheFormat
+
         # the directory to persist this data to when save is called.  If None,
         # a default path will be dbpath.
         self.persistDir = persistDir
@@ -116,6 +145,25 @@ class ProductStack(object):
         # the values at the bottom are version names
         self.usertags = {}
 
+        # the modification times of the products in the database, as
+        # recorded when the product data for each flavor was last read from
+        # the database.  The keys are flavor names and each value is a
+        # dictionary with the keys "when" (the time the modification times
+        # were collected), "journal" (the state of the database's journal of
+        # changes at that time), "dbmtime" (the modification time of the
+        # database directory at that time) and "products" (a lookup of
+        # modification times by product name).  When the data are persisted
+        # the key "digest" (a digest of the names of the products in the
+        # stack) is added.  These are persisted along with the product data
+        # so that a cache can be updated product by product.
+        self.productTimes = {}
+
+        # the Inventory instances that product data were loaded from, by
+        # flavor.  The modification times of the individual products are
+        # only read from an inventory when they are needed (see
+        # _recordedTimes()).
+        self._inventories = {}
+
         # True if python is new enough to pickle the cache data
         self.canCache = utils.canPickle()
 
@@ -213,11 +261,13 @@ class ProductStack(object):
             raise ProductNotFound(name, version, flavor)
 
     # @staticmethod   # requires python 2.4
-    def persistFilename(flavor):
+    def persistFilename(flavor, format="pickle"):
+        if format == "inventory":
+            return "%s.%s" % (flavor, ProductStack.inventoryFileExt)
         return "%s.%s" % (flavor, ProductStack.persistFileExt)
     persistFilename = staticmethod(persistFilename)  # works since python 2.2
 
-    def save(self, flavors=None, dir=None):
+    def save(self, flavors=None, dir=None, format=None):
         """
         persist the product information to disk.  If a cache file for a
         flavor is newer than when we loaded from it last, that flavor
@@ -226,7 +276,10 @@ class ProductStack(object):
         @param flavors  the flavors to persist.  This can be a single string
                            (for a single flavor) or a list of flavors.  If
                            None, save all flavors that appear to need updating
-        @param file     the file to save it to.
+        @param dir      the directory to save it to.
+        @param format   the format to save it in (one of persistFormats).
+                           If None, the format set at construction time
+                           will be used.
         """
         if flavors is None:
             if not self.updated: return
@@ -236,14 +289,14 @@ class ProductStack(object):
 
         outofsync = []
         for flavor in flavors:
-            file = self._persistPath(flavor, dir)
+            file = self._persistPath(flavor, dir, format)
             if not self._cacheFileIsInSync(file):
                 # file was updated since we loaded from it last!
                 outofsync.append(file)
                 continue
 
-            self.persist(flavor, file)
-            if dir is None:
+            self.persist(flavor, file, format)
+            if dir is None and format in (None, self.cacheFormat):
                 self.updated = [x for x in self.updated if x != flavor]
 
         if len(outofsync) > 0:
@@ -277,30 +330,53 @@ class ProductStack(object):
                 dir = self.dbpath
         return dir
 
-    def _persistPath(self, flavor, dir=None):
-        return os.path.join(self._persistDir(dir), self.persistFilename(flavor))
+    def _persistPath(self, flavor, dir=None, format=None):
+        if format is None:
+            format = self.cacheFormat
+        return os.path.join(self._persistDir(dir), self.persistFilename(flavor, format))
 
-    def persist(self, flavor, file=None):
+    def persist(self, flavor, file=None, format=None):
         """
         persist the product information for a particular flavor to a file
         @param flavor   the flavor to persist.
         @param file     the name of the file to persist to.  If it already
                           exists, it will be overwritten.  If value is None,
                           a location will be be used.
+        @param format   the format to persist it in (one of persistFormats).
+                          If None, the format set at construction time will
+                          be used.
         """
+        if format is None:
+            format = self.cacheFormat
         if file is None:
-            dir = self.persistDir
-            if not dir:
-                dir = self.dbpath
-            file = os.path.join(dir, persistFilename(flavor))
+            file = self._persistPath(flavor, format=format)
 
         if flavor not in self.lookup:
             self.lookup[flavor] = {}
         flavorData = self.lookup[flavor]
 
-        fd = utils.AtomicFile(file, "wb")
-        pickle.dump(flavorData, fd, protocol=2)
-        fd.close()
+        # record a digest of the names of the products in the cache.  If they
+        # aren't the products that were in the database when its
+        # modification time was recorded, forget that time so that the names
+        # will be checked when the cache is next read.
+        times = self._recordedTimes(flavor)
+        if times:
+            times["digest"] = _namesDigest(self.getProductNames())
+            if times["digest"] != _namesDigest(times["products"].keys()):
+                times["dbmtime"] = None
+
+        if format == "inventory":
+            Inventory.write(file, flavorData, times)
+        else:
+            if not isinstance(flavorData, dict):
+                flavorData = dict(flavorData)   # e.g. loaded from an inventory
+
+            # the product modification times are written as a second object so
+            # that readers of the original format can still read the file
+            fd = utils.AtomicFile(file, "wb")
+            pickle.dump(flavorData, fd, protocol=2)
+            pickle.dump(times, fd, protocol=2)
+            fd.close()
         self.modtimes[file] = os.stat(file).st_mtime
 
     def export(self):
@@ -378,7 +454,7 @@ class ProductStack(object):
         if flavor not in self.lookup:
             self.lookup[flavor] = {}
         if prod.name not in self.lookup[flavor]:
-            self.lookup[flavor][prod.name] = ProductFamily(prod.name)
+            self.lookup[flavor][prod.name] = ProductFamily(prod.name, self.root)
         self.lookup[flavor][prod.name].addVersion(prod.version,
                                                      prod.dir,
                                                      prod.tablefile,
@@ -386,6 +462,7 @@ class ProductStack(object):
         for tag in prod.tags:
             self.lookup[flavor][prod.name].assignTag(tag, prod.version)
 
+        self._productUpdated(prod.name)
         self._flavorsUpdated(flavor)
         if self.autosave: self.save(flavor)
 
@@ -400,6 +477,25 @@ class ProductStack(object):
         elif flavors not in self.updated:
             self.updated.append(flavors)
 
+    def _productUpdated(self, productName):
+        # this function is called whenever a product's information is
+        # updated in memory.  We forget the product's recorded modification
+        # time so that its data will be reread from the database when the
+        # cache is next loaded.
+        for flavor in self.productTimes.keys():
+            times = self._recordedTimes(flavor)
+            if times and productName in times["products"]:
+                times["products"][productName] = None
+
+    def _recordedTimes(self, flavor):
+        # return the product modification times recorded for a flavor,
+        # first reading the times of the individual products from the
+        # inventory that the data were loaded from, if need be.
+        times = self.productTimes.get(flavor)
+        if times and times["products"] is None:
+            times["products"] = self._inventories[flavor].getProductTimes()["products"]
+        return times
+
     def saveNeeded(self, flavors=None):
         """
         return true if there are unsaved updates to this product stack.
@@ -440,7 +536,7 @@ class ProductStack(object):
                 self.lookup[flavor] = {}
             for product in products[flavor].keys():
                 if product not in self.lookup[flavor]:
-                    self.lookup[flavor][product] = ProductFamily(product)
+                    self.lookup[flavor][product] = ProductFamily(product, self.root)
                 self.lookup[flavor][product].import_(products[flavor][product])
                 updated = True
                 self._flavorsUpdated(flavor)
@@ -461,6 +557,7 @@ class ProductStack(object):
             if updated:
                 if len(self.lookup[flavor][name].getVersions()) == 0:
                     del self.lookup[flavor][name]
+                self._productUpdated(name)
                 self._flavorsUpdated(flavor)
                 if self.autosave: self.save(flavor)
         except KeyError:
@@ -520,6 +617,7 @@ class ProductStack(object):
         if notfound:
             raise ProductNotFound(product, version, flavors, self.dbpath)
 
+        self._productUpdated(product)
         self._flavorsUpdated(flavors)
         if self.autosave:
             self.save(flavors)
@@ -546,6 +644,7 @@ class ProductStack(object):
             try:
                 if (self.lookup[flavor][product].unassignTag(tag)):
                     updated = True
+                    self._productUpdated(product)
                     self._flavorsUpdated(flavor)
             except KeyError:
                 pass
@@ -609,7 +708,7 @@ class ProductStack(object):
                 except KeyError:
                     pass
 
-    def cacheIsUpToDate(self, flavor, cacheDir=None):
+    def cacheIsUpToDate(self, flavor, cacheDir=None, verify=False):
         """
         return True if there is a cache file on disk with product information
         for a given flavor which is newer than the information in the
@@ -617,6 +716,8 @@ class ProductStack(object):
         or otherwise appears out-of-date.
 
         Note that this is different from cacheIsInSync()
+        @param verify    if True, check the modification times of all of the
+                           database files rather than trusting the journal
         """
         if not cacheDir:
             cacheDir = self.dbpath
@@ -629,12 +730,12 @@ class ProductStack(object):
 
         # check for user tag updates
         if cacheDir != self.dbpath and \
-           Database(cacheDir).isNewerThan(cache_mtime):
+           Database(cacheDir).isNewerThan(cache_mtime, verify=verify):
             return False
 
         # this is slightly inaccurate: if data for any flavor in the database
         # is newer than this time, this isNewerThan() returns True
-        return not Database(self.dbpath).isNewerThan(cache_mtime)
+        return not Database(self.dbpath).isNewerThan(cache_mtime, verify=verify)
 
     def clearCache(self, flavors=None, cachedir=None, verbose=0):
         """
@@ -654,11 +755,12 @@ class ProductStack(object):
             flavors = [flavors]
 
         for flavor in flavors:
-            fileName = self._persistPath(flavor, cachedir)
-            if os.path.exists(fileName):
-                if verbose > 0:
-                    print("Deleting %s" % (fileName), file=sys.stderr)
-                os.remove(fileName)
+            for format in self.persistFormats:
+                fileName = self._persistPath(flavor, cachedir, format)
+                if os.path.exists(fileName):
+                    if verbose > 0:
+                        print("Deleting %s" % (fileName), file=sys.stderr)
+                    os.remove(fileName)
 
     def reload(self, flavors=None, persistDir=None, verbose=0):
         """
@@ -681,41 +783,74 @@ class ProductStack(object):
             raise RuntimeError(persistDir + ": not an existing directory")
 
         if flavors is None:
-            flavors = self.findCachedFlavors(persistDir)
+            flavors = self.findCachedFlavors(persistDir, self.cacheFormat)
         if not isinstance(flavors, list):
             flavors = [flavors]
 
         for flavor in flavors:
             fileName = self._persistPath(flavor,persistDir)
             self.modtimes[fileName] = os.stat(fileName).st_mtime
+            if self.cacheFormat == "inventory":
+                inventory = Inventory(fileName)
+                self._inventories[flavor] = inventory
+                self.lookup[flavor] = InventoryLookup(inventory, self.root)
+                self.productTimes[flavor] = inventory.getProductTimes(withProducts=False)
+                continue
+
             fd = open(fileName, "rb")
-            lookup = pickle.load(fd)
-            fd.close()
+            try:
+                lookup = pickle.load(fd)
+                try:
+                    times = pickle.load(fd)
+                except EOFError:
+                    times = None        # written by an older version of eups
+            finally:
+                fd.close()
 
             self.lookup[flavor] = lookup
+            self.productTimes[flavor] = times
 
     @staticmethod
-    def findCachedFlavors(dir):
+    def findCachedFlavors(dir, format=None):
+        """
+        return the flavors that have product data cached in a directory
+        @param dir      the directory to look in
+        @param format   only consider caches in this format (one of
+                          persistFormats).  If None, consider all formats.
+        """
+        patterns = []
+        if format in (None, "pickle"):
+            patterns.append(ProductStack.persistFileRe)
+        if format in (None, "inventory"):
+            patterns.append(ProductStack.inventoryFileRe)
 
         flavors = []
         # list contents of directory
         for c in os.listdir(dir):
-            # match file against cache file pattern
-            b = ProductStack.persistFileRe.match(c)
-            if b:
-                # grab only cache files
-                flavors.append(b.group(1))
+            # match file against cache file patterns
+            for pat in patterns:
+                b = pat.match(c)
+                if b and b.group(1) not in flavors:
+                    # grab only cache files
+                    flavors.append(b.group(1))
         return flavors
 
-    def refreshFromDatabase(self, userTagDir=None):
+    def refreshFromDatabase(self, userTagDir=None, flavors=None):
         """
         load product information directly from the database files on disk,
         overwriting any previous information.  If userTagDir is provided,
         user tag assignments will be explicitly loaded into the stack
-        (otherwise, the stack may not have user tags in it).
+        (otherwise, the stack may not have user tags in it).  The state of
+        the database is recorded for the flavors of the products found and
+        for any other flavors given (which may have no products), so that
+        their caches can later be checked cheaply.
         """
         db = Database(self.dbpath, userTagDir)
 
+        # note the state of the database before we read it, so that any
+        # changes made while we're reading will be caught next time
+        times = self._getProductTimes(db)
+
         # forget!
         self.lookup = {}
 
@@ -723,15 +858,144 @@ class ProductStack(object):
             for product in db.findProducts(prodname):
                 self.addProduct(product)
 
+        for flavor in set(self.getFlavors()) | set(flavors or []):
+            self.productTimes[flavor] = times
+
+    def _getDbState(self, db):
+        # return the parts of productTimes that describe the state of the
+        # database as a whole
+        return {"when" : time.time(), "journal" : db.getJournalState(),
+                "dbmtime" : os.stat(self.dbpath).st_mtime}
+
+    def _getProductTimes(self, db):
+        times = self._getDbState(db)
+        times["products"] = db.getProductTimes()
+        return times
+
+    def findChangedProducts(self, flavors=None, verify=False):
+        """
+        return the names of the products whose information in the database
+        has changed since the product data for the given flavors was read
+        from it.  This includes products that have been newly declared or
+        completely undeclared.  None is returned if this cannot be
+        determined (e.g. because the data were loaded from a cache written
+        by an older version of eups).
+
+        If the database has a journal of changes, it will be used to find
+        the changed products; otherwise the modification times of all of
+        the products in the database will be checked.
+        @param flavors   the flavors of interest.  This can be a single
+                           string (for a single flavor) or a list of flavors.
+                           If None, consider all flavors.
+        @param verify    if True, always check the modification times of all
+                           products, even if a journal is available.
+        """
+        if flavors is None:
+            flavors = self.getFlavors()
+        if not isinstance(flavors, list):
+            flavors = [flavors]
+
+        for flavor in flavors:
+            if not self.productTimes.get(flavor):
+                return None
+
+        db = Database(self.dbpath)
+
+        if not verify:
+            changed = set()
+            for flavor in flavors:
+                names = db.findChangedProductNames(self.productTimes[flavor].get("journal"))
+                if names is None:
+                    break
+                changed.update(names)
+            else:
+                return sorted(changed)
+        #
+        # The journal can't help us; check all the products
+        #
+        current = db.getProductTimes()
+
+        changed = set()
+        for flavor in flavors:
+            times = self._recordedTimes(flavor)
+            recorded = times["products"]
+            changed.update(set(recorded.keys()) ^ set(current.keys()))
+            for name, mtime in current.items():
+                # file timestamps may only have a resolution of 1 second
+                # (in which case they're integral), so be suspicious of
+                # anything updated around the time that the modification
+                # times were collected.
+                if name in recorded and \
+                   (recorded[name] != mtime or
+                    (mtime == int(mtime) and mtime >= times["when"] - 1)):
+                    changed.add(name)
+
+        return sorted(changed)
+
+    def refreshProducts(self, productNames, flavors=None, userTagDir=None, dbState=None):
+        """
+        reload the information for the given products directly from the
+        database files on disk, leaving the information for all other
+        products unchanged.
+        @param productNames  the names of the products to reload
+        @param flavors       the flavors to reload the products for.  This
+                               can be a single string (for a single flavor)
+                               or a list of flavors.  If None, reload for all
+                               flavors.
+        @param userTagDir    the directory where user tag data is persisted.
+                               If None, the reloaded products will not have
+                               user tags.
+        @param dbState       the state of the database before productNames
+                               were found to have changed (as returned by
+                               _getDbState()).  If None, the state is
+                               recorded now.
+        """
+        if flavors is None:
+            flavors = self.getFlavors()
+        if not isinstance(flavors, list):
+            flavors = [flavors]
+
+        db = Database(self.dbpath, userTagDir)
+        if dbState is None:
+            dbState = self._getDbState(db)
+        newTimes = db.getProductTimes(productNames)
+
+        for name in productNames:
+            for flavor in flavors:
+                if flavor in self.lookup and name in self.lookup[flavor]:
+                    del self.lookup[flavor][name]
+
+            for product in db.findProducts(name, flavors=flavors):
+                self.addProduct(product)
+
+        for flavor in flavors:
+            self.addFlavor(flavor)
+
+            times = self._recordedTimes(flavor)
+            if times:
+                products = times["products"].copy()
+                for name in productNames:
+                    products.pop(name, None)
+                products.update(newTimes)
+                times = dict(dbState, products=products)
+            else:
+                times = self._getProductTimes(db)
+            self.productTimes[flavor] = times
+
+        self._flavorsUpdated(flavors)
+
     def _loadUserTags(self, userTagDir=None):
         if not userTagDir:
             userTagDir = self.persistDir
         if not userTagDir or not os.path.exists(userTagDir):
             return
 
+        # only products with user tags have directories in userTagDir
         db = Database(self.dbpath, userTagDir)
-        prodnames = db.findProductNames()
-        for pname in prodnames:
+        for pname in os.listdir(userTagDir):
+            if not os.path.isdir(os.path.join(userTagDir, pname)) or \
+               not self.hasProduct(pname):
+                continue
             for tag, version, flavor in db.getTagAssignments(pname, glob=False):
                 self.assignTag(tag, pname, version, flavor)
 
@@ -756,7 +1020,8 @@ class ProductStack(object):
 
     # @staticmethod   # requires python 2.4
     def fromCache(dbpath, flavors, persistDir=None, userTagDir=None,
-                  updateCache=True, autosave=True, verbose=0):
+                  updateCache=True, autosave=True, verify=False, cacheFormat=None,
+                  verbose=0):
         """
         return a ProductStack that has all products loaded in from the
         available caches.  If they are out of date (or non-existent), this
@@ -783,6 +1048,13 @@ class ProductStack(object):
                                appear out of date
         @param autosave     if true (default), all updates will be
                                saved to disk.
+        @param verify       if true, check the caches against the
+                               modification times of all of the database
+                               files rather than trusting the database's
+                               journal of changes
+        @param cacheFormat  the format of the caches to read and write (one
+                               of persistFormats).  If None, "pickle" will
+                               be used.
         """
         if not flavors:
             raise RuntimeError("ProductStack.fromCache(): at least one flavor needed as input" +
@@ -790,55 +1062,149 @@ class ProductStack(object):
         if not isinstance(flavors, list):
             flavors = [flavors]
 
-        out = ProductStack(dbpath, persistDir, False)
+        out = ProductStack(dbpath, persistDir, False, cacheFormat)
 
-        cacheOkay = out._tryCache(dbpath, persistDir, flavors, verbose=verbose)
+        cacheOkay = out._tryCache(dbpath, persistDir, flavors, userTagDir,
+                                  verify=verify, verbose=verbose)
         if not cacheOkay:
-            cacheOkay = out._tryCache(dbpath, dbpath, flavors)
+            cacheOkay = out._tryCache(dbpath, dbpath, flavors, verify=verify, verbose=verbose)
             if cacheOkay:
                 out._loadUserTags(userTagDir)
 
         if not cacheOkay:
-            out.refreshFromDatabase(userTagDir)
+            out.refreshFromDatabase(userTagDir, flavors)
             out._flavorsUpdated(flavors)
-            if updateCache:  out.save()
+
+        if updateCache and out.saveNeeded():
+            out.save()
 
         out.autosave = autosave
         return out
 
     fromCache = staticmethod(fromCache)    # works since python2.2
 
-    def _tryCache(self, dbpath, cacheDir, flavors, verbose=0):
+    # @staticmethod   # requires python 2.4
+    def fromCacheReadOnly(dbpath, flavors, persistDir=None, userTagDir=None, verify=False, verbose=0):
+        """
+        return a ProductStack loaded from the existing caches, or None if
+        there's no cache that can be brought up to date cheaply.  Unlike
+        fromCache(), this never writes to the caches, and never rereads the
+        whole database, so it's safe to use without holding a lock on the
+        caches.  Inventory caches are preferred, as only the products that
+        are actually used need be read; a pickle cache will be used if
+        there's no inventory.
+
+        Caches are verified using the database's journal of changes (or
+        the modification times of its files); the products that have changed
+        since a cache was written are reread from the database, but the
+        result is only held in memory.
+
+        @param dbpath       the full path to the database directory ("ups_db")
+        @param flavors      the desired flavors
+        @param persistDir   the directory to look for a cache in before
+                               looking in dbpath
+        @param userTagDir   the directory where user tag data is persisted
+        @param verify       if true, check the caches against the
+                               modification times of all of the database
+                               files rather than trusting the database's
+                               journal of changes
+        """
+        if not flavors:
+            raise RuntimeError("ProductStack.fromCacheReadOnly(): at least one flavor needed as input" +
+                               str(flavors));
+        if not isinstance(flavors, list):
+            flavors = [flavors]
+
+        for cacheFormat in ("inventory", "pickle"):
+            out = ProductStack(dbpath, persistDir, False, cacheFormat)
+
+            try:
+                if persistDir and out._tryCache(dbpath, persistDir, flavors, userTagDir,
+                                                verify=verify, verbose=verbose):
+                    return out
+                if out._tryCache(dbpath, dbpath, flavors, verify=verify, verbose=verbose):
+                    out._loadUserTags(userTagDir)
+                    return out
+            except Exception as e:      # e.g. a cache being replaced as we read it
+                if verbose > 1:
+                    print("Unable to read the product cache for %s: %s" % (dbpath, e), file=sys.stderr)
+
+        return None
+
+    fromCacheReadOnly = staticmethod(fromCacheReadOnly)    # works since python2.2
+
+    def _tryCache(self, dbpath, cacheDir, flavors, userTagDir=None, verify=False, verbose=0):
         if not cacheDir or not os.path.exists(cacheDir):
             return False
 
-        cacheOkay = True
         for flav in flavors:
-            if not self.cacheIsUpToDate(flav, cacheDir):
-                cacheOkay = False
+            cache = self._persistPath(flav, cacheDir)
+            if not os.path.exists(cache) or \
+               (cacheDir != self.dbpath and
+                Database(cacheDir).isNewerThan(os.stat(cache).st_mtime, verify=verify)):
                 if verbose > 1:
                     print("Regenerating missing or out-of-date cache for %s in %s" % (flav, dbpath), file=sys.stderr)
-                break
-
-        if cacheOkay:
-            self.reload(flavors, cacheDir, verbose=verbose)
+                return False
 
-            # do a final consistency check; do we have the same products
+        self.reload(flavors, cacheDir, verbose=verbose)
+        #
+        # Reread the products that have changed since the cache was written.  If we can't tell
+        # which products changed (an old cache), fall back to checking the whole database
+        #
+        dbState = self._getDbState(Database(dbpath))
+        changed = self.findChangedProducts(flavors, verify=verify)
+        if changed is None:
+            for flav in flavors:
+                if not self.cacheIsUpToDate(flav, cacheDir, verify=verify):
+                    self.lookup = {}   # forget loaded data
+                    if verbose > 1:
+                        print("Regenerating missing or out-of-date cache for %s in %s" % (flav, dbpath), file=sys.stderr)
+                    return False
+        elif changed:
+            if verbose > 1:
+                print("Updating %d changed product%s in cache for %s" %
+                      (len(changed), ("" if len(changed) == 1 else "s"), dbpath), file=sys.stderr)
+            if cacheDir == self.dbpath:
+                userTagDir = None       # user tags are added separately
+            self.refreshProducts(changed, flavors, userTagDir, dbState)
+        #
+        # Do a final consistency check; do we have the same products?  Products are only added
+        # or removed by creating or deleting their directories in the database, so if the
+        # database directory hasn't been modified since the product names were recorded we
+        # needn't look any further.  If it has, compare the names with those recorded when the
+        # cache was written, and only if they differ compare them with the names in the cache
+        #
+        recorded = [self.productTimes.get(flav) or {} for flav in flavors]
+        if [t for t in recorded if t.get("dbmtime") != dbState["dbmtime"]]:
             dbnames = Database(dbpath).findProductNames()
-            dbnames.sort()
-            dbnames = " ".join(dbnames)
+            digest = _namesDigest(dbnames)
+            if [t for t in recorded if t.get("digest") != digest]:
+                if not self._productNamesMatch(dbnames):
+                    if verbose:
+                        print("Regenerating out-of-date cache for %s in %s" % (flav, dbpath), file=sys.stderr)
+                    return False
+
+        return True
 
-            cachenames = self.getProductNames()
-            cachenames.sort()
-            cachenames = " ".join(cachenames)
+    def _productNamesMatch(self, dbnames):
+        # return True if the products in the stack are those named; if not, forget the loaded data
+        dbnames = sorted(dbnames)
+        dbnames = " ".join(dbnames)
 
-            if dbnames != cachenames:
-                cacheOkay = False
-                self.lookup = {}   # forget loaded data
-                if verbose:
-                  print("Regenerating out-of-date cache for %s in %s" % (flav, dbpath), file=sys.stderr)
+        cachenames = self.getProductNames()
+        cachenames.sort()
+        cachenames = " ".join(cachenames)
+
+        if dbnames != cachenames:
+            self.lookup = {}   # forget loaded data
+            self.updated = []
+            return False
+
+        return True
 
-        return cacheOkay
+def _namesDigest(names):
+    # return a digest of a set of product names
+    return hashlib.md5("\n".join(sorted(names)).encode("utf-8")).hexdigest()
 
 def _uniquify(lis):
     for i in xrange(len(lis)):
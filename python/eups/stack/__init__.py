@@ -8,6 +8,9 @@ The major classes are:
                        to speed up recreation of a stack instance later.
    ProductFamily   a collection of different versions of product (installed
                        for the same flavor).
+   Inventory       read-only access to product data persisted in a compact,
+                       binary format that is read via mmap.
 """
 from .ProductFamily import ProductFamily
+from .Inventory import Inventory
 from .ProductStack import ProductStack, persistVersionName, CacheOutOfSync
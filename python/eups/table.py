@@ -7,6 +7,11 @@
 from __future__ import absolute_import, print_function
 import os
 import re
+import hashlib
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 
 import eups
 from .exceptions import BadTableContent, TableError, TableFileNotFound, ProductNotFound
@@ -15,10 +20,72 @@ from .VersionParser import VersionParser
 from . import utils
 from . import hooks
 
+#
+# Regular expressions used to parse table files; see Table._tokenize()
+#
+_directiveRe = re.compile(r"^(?:file|product|action|qualifiers|flavor)\s*=|^(?:group|common|end):",
+                          re.IGNORECASE)
+_fileRe = re.compile(r"^File\s*=\s*(\w+)", re.IGNORECASE)
+_productRe = re.compile(r"^Product\s*=\s*(\w+)", re.IGNORECASE)
+_actionRe = re.compile(r"^Action\s*=\s*([\w+.]+)", re.IGNORECASE)
+_setupRe = re.compile(r"setup", re.IGNORECASE)
+_qualifiersRe = re.compile(r"^Qualifiers\s*=\s*\"([^\"]*)\"", re.IGNORECASE)
+_groupRe = re.compile(r"^Group:\s*$", re.IGNORECASE)
+_commonRe = re.compile(r"^Common:\s*$", re.IGNORECASE)
+_endRe = re.compile(r"^End:\s*$", re.IGNORECASE)
+_flavorRe = re.compile(r"^Flavor\s*=\s*([\w+.]+)", re.IGNORECASE)
+_conditionalRe = re.compile(r"^(?:if\s*\((.*)\)\s*{\s*|}\s*(?:(else(?:\s*if\s*\((.*)\))?)\s*{)?)$",
+                            re.IGNORECASE)
+_callRe = re.compile(r'^(\w+)\s*\((.*)\)\s*;?\s*$', re.IGNORECASE)
+_blankArgRe = re.compile(r',\s*"(\s)"')
+_quotedRe = re.compile(r"(\"[^\"]+\")")
+_argSepRe = re.compile("[, ]")
+
+_synonymRe = re.compile(r"\${(PROD_DIR|UPS_PROD_DIR|UPS_PROD_FLAVOR|UPS_PROD_NAME|UPS_PROD_VERSION|UPS_DB|UPS_UPS_DIR)}")
+_synonyms = {
+    "PROD_DIR" : "${PRODUCT_DIR}",
+    "UPS_PROD_DIR" : "${PRODUCT_DIR}",
+    "UPS_PROD_FLAVOR" : "${PRODUCT_FLAVOR}",
+    "UPS_PROD_NAME" : "${PRODUCT_NAME}",
+    "UPS_PROD_VERSION" : "${PRODUCT_VERSION}",
+    "UPS_DB" : "${PRODUCTS}",
+    "UPS_UPS_DIR" : "${UPS_DIR}",
+    }
+
+#
+# Regular expressions used to expand variables in table files; see Table.expandEupsVariables()
+#
+_productsRe = re.compile(r"\${PRODUCTS}")
+_productDirRe = re.compile(r"(\$(\?)?{PRODUCT_DIR(_EXTRA)?})")
+_productFlavorRe = re.compile(r"\${PRODUCT_FLAVOR}")
+_productNameRe = re.compile(r"\${PRODUCT_NAME}")
+_productVersionRe = re.compile(r"\${PRODUCT_VERSION}")
+_upsDirRe = re.compile(r"\${UPS_DIR}")
+_eupsPathRe = re.compile(r"\${EUPS_PATH\[(\d+)\]}")
+#
+# ${XXX}, $?{XXX} or ${XXX-default}; see Action.expandEnvironmentalVariable()
+#
+_envVarRe = re.compile(r"\$(\?)?{([^-}]*)(?:-([^}]+))?}")
+_versionExprRe = re.compile(r"(?:(\S*)\s+)?\[([^\]]+)\]\s*")
+
+def _unquote(s):
+    """Remove a pair of enclosing double quotes"""
+    if len(s) > 1 and s[0] == '"' and s[-1] == '"':
+        return s[1:-1]
+    return s
+
 class Table(object):
     """A class that represents a eups table file"""
 
-    def __init__(self, tableFile, topProduct=None, addDefaultProduct=None, verbose=0):
+    # static variable: the name of the directory (within a product cache
+    # directory) where compiled tables are kept
+    cacheDirName = "_tables_"
+
+    # static variable: the version of the compiled tables' format.  Change
+    # this if what's stored (or the parser's output) changes.
+    compiledFormatVersion = 1
+
+    def __init__(self, tableFile, topProduct=None, addDefaultProduct=None, verbose=0, cacheDir=None):
         """
         Parse a tablefile
         @param  tableFile          the tablefile we're reading
@@ -26,6 +93,10 @@ class Table(object):
         @param  addDefaultProduct  if True or None, automatically add a
                                      "setupOptional" action for the product
                                      specified in hooks.config.Eups.defaultProduct
+        @param  cacheDir           a directory where the parsed table may be
+                                     saved, and reused while the table file is
+                                     unchanged.  If None, the table is parsed
+                                     every time.
         @throws TableError       if an IOError occurs while reading the table file
         @throws BadTableContent  if the table file parser encounters unparseable
                                    content.  Note that BadTableContent is a subclass
@@ -38,132 +109,228 @@ class Table(object):
         self._actions = []
 
         if utils.isRealFilename(tableFile):
-            self._read(tableFile, addDefaultProduct, verbose, topProduct)
+            if not (cacheDir and self._readCompiled(cacheDir)):
+                self._read(tableFile, verbose, topProduct)
+                if cacheDir:
+                    self._writeCompiled(cacheDir)
+
+            self._addDefaultProduct(addDefaultProduct)
+
+    def _compiledFile(self, cacheDir):
+        # the file in cacheDir where this table is compiled to
+        key = "%s:%s" % (os.path.abspath(self.file), self.topProduct and self.topProduct.name)
+        return os.path.join(cacheDir, "%s.table%d" %
+                            (hashlib.md5(key.encode("utf-8")).hexdigest(), self.compiledFormatVersion))
+
+    def _fileState(self):
+        try:
+            st = os.stat(self.file)
+        except OSError:
+            return None
+        return (os.path.abspath(self.file), st.st_mtime, st.st_size)
+
+    def _readCompiled(self, cacheDir):
+        """
+        set _actions from the compiled table in cacheDir, returning False if
+        there isn't a compiled table for the current version of the file.
+        """
+        try:
+            fd = open(self._compiledFile(cacheDir), "rb")
+            try:
+                compiled = pickle.load(fd)
+            finally:
+                fd.close()
+        except Exception:
+            return False
+
+        if compiled["state"] != self._fileState():
+            return False
+
+        topProduct = self.topProduct
+        for LBB in compiled["actions"]:
+            self._actions.append([e if utils.is_string(e) else
+                                  [Action(self.file, cmd, args, extra, topProduct=topProduct)
+                                   for cmd, args, extra in e] for e in LBB])
+        self.old = compiled["old"]
+
+        return True
+
+    def _writeCompiled(self, cacheDir):
+        """
+        save the parsed table (i.e. _actions) to cacheDir.  Failures are ignored.
+        """
+        state = self._fileState()
+        if not state:
+            return
+
+        actions = []
+        for LBB in self._actions:
+            actions.append([e if utils.is_string(e) else [(a.cmd, a.args, a.extra) for a in e]
+                            for e in LBB])
 
-    def _rewrite(self, contents):
-        """Rewrite the contents of a tablefile to the canonical form; each
-line is returned as a tuple (lineNo, line)
+        try:
+            if not os.path.isdir(cacheDir):
+                os.makedirs(cacheDir)
+            fd = utils.AtomicFile(self._compiledFile(cacheDir), "wb")
+            pickle.dump(dict(state=state, old=self.old, actions=actions), fd, protocol=2)
+            fd.close()
+        except (IOError, OSError):
+            pass
 
-The rewritten table file has certain old lines removed, and both forms
-of conditional (old and new) rewritten as explicit if(...) { ... } blocks,
-but no other interpretation is applied
+    def _tokenize(self, contents):
+        """Split the lines of a table file into tokens, returned as tuples (lineNo, line, kind, value)
+
+Both forms of conditional (old and new) are returned as the tokens for explicit if(...) { ... }
+blocks, and certain old lines are skipped; line is the (uncommented) text of the line.  The kinds
+of token are:
+   "block"    the start or end of a block, i.e. "if (...) {", "} else if (...) {", "} else {"
+                or "}".  value is a tuple (logical, else, elseLogical) giving the
+                logical expression of an if, the else clause, and the logical expression of
+                the else clause; each is None if not present.
+   "action"   an action, e.g. envSet(...);  value is (cmd, args)
+   "unknown"  an action with an unknown name
+   "line"     anything else
 """
 
-        ncontents = []                  # new value of contents[]
         inGroup = False                 # in a Group...Common...End block
         inNewGroup = False              # in a Flavor=XXX ... Flavor=YYY block
         lineNo = 0                      # line number in input file, for diagnostics
         for line in contents:
             lineNo += 1
 
-            line = re.sub(r"\n", "", line)
-            line = re.sub(r"^\s*", "", line)
-            line = re.sub(r"#.*$", "", line)
+            line = line.replace("\n", "").lstrip()
+            i = line.find("#")
+            if i >= 0:
+                line = line[:i]
 
             if not line:
                 continue
-            #
-            # Check for certain archaic forms:
-            #
-            mat = re.search(r"^File\s*=\s*(\w+)", line, re.IGNORECASE)
-            if mat:
-                self.old = True
-
-                if mat.group(1).lower() != "table":
-                    msg = "Expected \"File = Table\"; saw \"%s\" at %s:%d" % (line, self.versionFile, lineNo)
-                    raise BadTableContent(self.file, msg=msg)
-                continue
-            elif self.old:
-                if re.search(r"^Product\s*=\s*(\w+)", line, re.IGNORECASE):
-                    continue
             # Older synonyms for eups variables in table files
-            line = re.sub(r"\${PROD_DIR}", "${PRODUCT_DIR}", line)
-            line = re.sub(r"\${UPS_PROD_DIR}", "${PRODUCT_DIR}", line)
-            line = re.sub(r"\${UPS_PROD_FLAVOR}", "${PRODUCT_FLAVOR}", line)
-            line = re.sub(r"\${UPS_PROD_NAME}", "${PRODUCT_NAME}", line)
-            line = re.sub(r"\${UPS_PROD_VERSION}", "${PRODUCT_VERSION}", line)
-            line = re.sub(r"\${UPS_DB}", "${PRODUCTS}", line)
-            line = re.sub(r"\${UPS_UPS_DIR}", "${UPS_DIR}", line)
-            #
-            # Check for lines that we think are always the same (and can thus be ignored)
-            #
-            mat = re.search(r"^Action\s*=\s*([\w+.]+)", line, re.IGNORECASE)
-            if mat:
-                if not re.search(r"setup", mat.group(1), re.IGNORECASE):
-                    msg = "Unsupported action \"%s\" at %s:%d" % (mat.group(1), self.file, lineNo)
-                    raise BadTableContent(self.file, msg=msg)
-                continue
+            if "${" in line:
+                line = _synonymRe.sub(lambda mat: _synonyms[mat.group(1)], line)
 
-            mat = re.search(r"^Qualifiers\s*=\s*\"([^\"]*)\"", line, re.IGNORECASE)
-            if mat:
-                if mat.group(1):
-                    if False:
-                        msg = "Unsupported qualifiers \"%s\" at %s:%d" % (mat.group(1), self.file, lineNo)
-                        raise BadTableContent(self.file, msg=msg)
-                    else:
-                        print("Ignoring qualifiers \"%s\" at %s:%d" % (mat.group(1), self.file, lineNo), file=utils.stdwarn)
-                continue
-            #
-            # Parse Group...Common...End, replacing by a proper If statement
-            #
-            if re.search(r"^Group:\s*$", line, re.IGNORECASE):
-                inGroup = True
-                conditional = ""
-                continue
+            flavor = None
+            if _directiveRe.match(line): # one of the lines that set up old and new style blocks
+                #
+                # Check for certain archaic forms:
+                #
+                mat = _fileRe.match(line)
+                if mat:
+                    self.old = True
 
-            if inGroup:
-                if re.search(r"^Common:\s*$", line, re.IGNORECASE):
-                    ncontents += [(lineNo, "if (" + conditional + ") {")]
+                    if mat.group(1).lower() != "table":
+                        msg = "Expected \"File = Table\"; saw \"%s\" at %s:%d" % (line, self.file, lineNo)
+                        raise BadTableContent(self.file, msg=msg)
                     continue
-
-                if re.search(r"^End:\s*$", line, re.IGNORECASE):
-                    inGroup = False
-                    ncontents += [(lineNo, "}")]
+                elif self.old:
+                    if _productRe.match(line):
+                        continue
+                #
+                # Check for lines that we think are always the same (and can thus be ignored)
+                #
+                mat = _actionRe.match(line)
+                if mat:
+                    if not _setupRe.search(mat.group(1)):
+                        msg = "Unsupported action \"%s\" at %s:%d" % (mat.group(1), self.file, lineNo)
+                        raise BadTableContent(self.file, msg=msg)
                     continue
 
-                mat = re.search(r"^Flavor\s*=\s*([\w+.]+)", line, re.IGNORECASE)
+                mat = _qualifiersRe.match(line)
                 if mat:
-                    if conditional:
-                        conditional += " || "
-
-                    flavor = mat.group(1)
-                    if flavor.lower() == "any":
-                        conditional += "FLAVOR =~ .*"
-                    else:
-                        conditional += "FLAVOR == %s" % flavor
+                    if mat.group(1):
+                        print("Ignoring qualifiers \"%s\" at %s:%d" % (mat.group(1), self.file, lineNo), file=utils.stdwarn)
                     continue
+                #
+                # Parse Group...Common...End, replacing by a proper If statement
+                #
+                if _groupRe.match(line):
+                    inGroup = True
+                    conditional = ""
+                    continue
+
+                if inGroup:
+                    if _commonRe.match(line):
+                        yield lineNo, line, "block", (conditional, None, None)
+                        continue
+
+                    if _endRe.match(line):
+                        inGroup = False
+                        yield lineNo, line, "block", (None, None, None)
+                        continue
+
+                    mat = _flavorRe.match(line)
+                    if mat:
+                        if conditional:
+                            conditional += " || "
+
+                        flavor = mat.group(1)
+                        if flavor.lower() == "any":
+                            conditional += "FLAVOR =~ .*"
+                        else:
+                            conditional += "FLAVOR == %s" % flavor
+                        continue
+
+                flavor = _flavorRe.match(line)
             #
             # New style blocks (a bad design by RHL) begin with one or more Flavor=XXX
             # lines, and continue to the next Flavor=YYY line
             #
             if inNewGroup == "inFlavors": # we're reading a set of FLAVOR=XXX lines
-                mat = re.search(r"^Flavor\s*=\s*([\w+.]+)", line, re.IGNORECASE)
-                if mat:                 # and we've found another
-                    conditional += " || FLAVOR == %s" % mat.group(1)
+                if flavor:              # and we've found another
+                    conditional += " || FLAVOR == %s" % flavor.group(1)
                     continue
                 else:                   # not FLAVOR=XXX; start of the block's body
-                    ncontents += [(lineNo, "if (" + conditional + ") {")]
+                    yield lineNo, line, "block", (conditional, None, None)
                     inNewGroup = True
-            else:                       # Not reading FLAVOR=XXX, so a FLAVOR=XXX starts a new block
-                mat = re.search(r"^Flavor\s*=\s*([\w+.]+)", line, re.IGNORECASE)
-                if mat:
-                    if inNewGroup:
-                        ncontents += [(lineNo, "}")]
+            elif flavor:                # Not reading FLAVOR=XXX, so a FLAVOR=XXX starts a new block
+                if inNewGroup:
+                    yield lineNo, line, "block", (None, None, None)
 
-                    inNewGroup = "inFlavors"
-                    conditional = "FLAVOR == %s" % mat.group(1)
+                inNewGroup = "inFlavors"
+                conditional = "FLAVOR == %s" % flavor.group(1)
+                continue
+            #
+            # Is this the start or end of a logical condition?
+            #
+            if line[0] in "iI}":
+                mat = _conditionalRe.match(line)
+                if mat:
+                    yield lineNo, line, "block", mat.groups()
                     continue
+            #
+            # Is line of the form action(...)?
+            #
+            mat = _callRe.match(line)
+            if not mat:
+                yield lineNo, line, "line", None
+                continue
+
+            try:
+                cmd = _commands[mat.group(1).lower()]
+            except KeyError:
+                yield lineNo, line, "unknown", None
+                continue
+            #
+            # Split the arguments.  Protect \" by replacing it with "\002", " " (and the special
+            # case cmd(..., " ")) by "\001", and , within quoted strings by "\003"
+            #
+            args = _unquote(mat.group(2)).replace(r'\"', "\002")
+            args = _blankArgRe.sub('\\1"\001"', args)
+            args = _quotedRe.sub(lambda mat: mat.group(0).replace(" ", "\001").replace(",", "\003"), args)
 
-            ncontents += [(lineNo, line)]
+            args = [_unquote(s).replace("\001", " ").replace("\002", '"').replace("\003", ",")
+                    for s in _argSepRe.split(args) if s]
 
-        if inNewGroup:
-            ncontents += [(lineNo, "}")]
+            yield lineNo, line, "action", (cmd, args)
 
-        return ncontents
+        if inNewGroup:
+            yield lineNo, "}", "block", (None, None, None)
 
     def expandEupsVariables(self, product, quiet=False):
         """Expand eups-related variables such as $PRODUCT_DIR"""
 
+        root = product.stackRoot()
+        dirEnvRe = re.compile(r"\${%s}" % utils.dirEnvNameFor(product.name))
         for actions in self._actions:
             for logicalOrBlock in actions:
                 if not isinstance(logicalOrBlock, list): # a logical expression as a string
@@ -172,15 +339,16 @@ but no other interpretation is applied
                 for a in logicalOrBlock:
                     for i in range(len(a.args)):
                         value = a.args[i]
+                        if "$" not in value: # nothing to expand
+                            continue
 
-                        root = product.stackRoot()
                         if root:
-                            value = re.sub(r"\${PRODUCTS}", root, value)
-                        elif re.search(r"\${PRODUCTS}", value):
+                            value = _productsRe.sub(root, value)
+                        elif _productsRe.search(value):
                             if not quiet:
                                 print("Unable to expand PRODUCTS in %s" % self.file, file=utils.stderr)
 
-                        mat = re.search(r"(\$(\?)?{PRODUCT_DIR(_EXTRA)?})", value)
+                        mat = _productDirRe.search(value)
                         if mat:
                             var = mat.group(1)
                             optional = mat.group(2)
@@ -195,42 +363,41 @@ but no other interpretation is applied
                                     newValue = None
 
                             if newValue:
-                                value = re.sub(re.sub(r"([$?.])", r"\\\1", var), newValue, value)
+                                value = re.sub(re.escape(var), newValue, value)
                             else:
                                 if not optional and not quiet:
                                     print("Unable to expand %s in %s" % (var, self.file), file=utils.stderr)
                         #
                         # Be nice; they should say PRODUCT_DIR but sometimes PRODUCT is spelled out, e.g. EUPS_DIR
                         #
-                        regexp = r"\${%s}" % utils.dirEnvNameFor(product.name)
-                        if re.search(regexp, value):
+                        if dirEnvRe.search(value):
                             if product.dir:
-                                value = re.sub(regexp, product.dir, value)
+                                value = dirEnvRe.sub(product.dir, value)
                             else:
                                 if not quiet:
                                     print("Unable to expand %s in %s" % \
                                           (self.file, utils.dirEnvNameFor(product.name)), file=utils.stdwarn)
 
                         if product.flavor:
-                            value = re.sub(r"\${PRODUCT_FLAVOR}", product.flavor, value)
-                        elif re.search(r"\${PRODUCT_FLAVOR}", value):
+                            value = _productFlavorRe.sub(product.flavor, value)
+                        elif _productFlavorRe.search(value):
                             if not quiet:
                                 print("Unable to expand PRODUCT_FLAVOR in %s" % self.file, file=utils.stdwarn)
 
-                        value = re.sub(r"\${PRODUCT_NAME}", product.name, value)
-                        if re.search(r"\${PRODUCT_VERSION}", value):
+                        value = _productNameRe.sub(product.name, value)
+                        if _productVersionRe.search(value):
                             if product.version:
-                                value = re.sub(r"\${PRODUCT_VERSION}", product.version, value)
+                                value = _productVersionRe.sub(product.version, value)
                             else:
                                 if not quiet:
                                     print("Unable to expand PRODUCT_VERSION in %s" % self.file, file=utils.stdwarn)
 
-                        value = re.sub(r"\${UPS_DIR}", os.path.dirname(self.file), value)
+                        value = _upsDirRe.sub(os.path.dirname(self.file), value)
                         #
                         # EUPS_PATH is really an environment variable, but handle it here
                         # if the user chose to subscript it, e.g. ${EUPS_PATH[0]}
                         #
-                        mat = re.search(r"\${EUPS_PATH\[(\d+)\]}", value)
+                        mat = _eupsPathRe.search(value)
                         if mat:
                             ind = int(mat.group(1))
                             value = re.sub(r"\[(\d+)\]}$", "", value) + "}"
@@ -251,7 +418,7 @@ but no other interpretation is applied
 
         return self
 
-    def _read(self, tableFile, addDefaultProduct, verbose=0, topProduct=None):
+    def _read(self, tableFile, verbose=0, topProduct=None):
         """Read and parse a table file, setting _actions"""
 
         if not tableFile:               # nothing to do
@@ -264,7 +431,6 @@ but no other interpretation is applied
 
         contents = fd.readlines()
         fd.close()
-        contents = self._rewrite(contents)
 
         logical = "True"                # logical condition required to execute block
         block = []
@@ -278,20 +444,19 @@ but no other interpretation is applied
                                         # } else {
                                         #    actionN
                                         # }
-        for lineNo, line in contents:
+        for lineNo, line, kind, value in self._tokenize(contents):
             #
             # Is this the start of a logical condition?
             #
-            mat = re.search(r"^(?:if\s*\((.*)\)\s*{\s*|}\s*(?:(else(?:\s*if\s*\((.*)\))?)\s*{)?)$", \
-                                line, re.IGNORECASE)
-            if mat:
+            if kind == "block":
+                ifLogical, elseClause, elseLogical = value
                 if block:
-                    if mat.group(2) == "else": # i.e. we saw an } else {
+                    if elseClause == "else": # i.e. we saw an } else {
                         ifBlock = block
-                    elif mat.group(3) != None: # i.e. we saw an } else if (...) {
+                    elif elseLogical != None: # i.e. we saw an } else if (...) {
                         logicalBlocks += [logical, block,]
                         block = False
-                        logical = mat.group(3)
+                        logical = elseLogical
                     else:               # we saw an }
                         if ifBlock:
                             elseBlock = block
@@ -301,17 +466,17 @@ but no other interpretation is applied
 
                         logicalBlocks += [logical, ifBlock, elseBlock,]
 
-                        if logicalBlocks and mat.group(1) != None:
+                        if logicalBlocks and ifLogical != None:
                             self._actions.append(logicalBlocks)
                             ifBlock = []
                             logicalBlocks = []
 
                     block = []
 
-                if mat.group(1) != None:
-                    logical = mat.group(1)
+                if ifLogical != None:
+                    logical = ifLogical
                 else:
-                    if mat.group(2) == None:   # we got to }
+                    if elseClause == None:   # we got to }
                         logical = "True"
                         if logicalBlocks:
                             self._actions.append(logicalBlocks)
@@ -319,65 +484,11 @@ but no other interpretation is applied
                             logicalBlocks = []
 
                 continue
-            #
-            # Is line of the form action(...)?
-            #
-            # N.b. the eups.table itself has a ; at the end of the line.  This
-            # was never advertised, but we might as well support it in case
-            # it was copied in the real world
-            mat = re.search(r'^(\w+)\s*\((.*)\)\s*;?\s*$', line, re.IGNORECASE)
-            if mat:
-                cmd = mat.group(1).lower()
-                args = re.sub(r'^"(.*)"$', r'\1', mat.group(2))
-                #
-                # Protect \" by replacing it with "\002"
-                #
-                args = args.replace(r'\"', r'%c' % 2)
-                #
-                # Special case cmd(..., " ") by protecting " " as "\001"
-                #
-                args = re.sub(r',\s*"(\s)"', r'\1"%c"' % 1, args)
-                #
-                # Replace " " within quoted strings with \1 too
-                #
-                args = re.sub(r"(\"[^\"]+\")", lambda s: re.sub(" ", "\1", s.group(0)), args)
-                #
-                # Replace , within quoted strings with "\003"
-                #
-                args = re.sub(r"(\"[^\"]+\")", lambda s: re.sub(",", "%c" % 3, s.group(0)), args)
-
-                args = [s for s in re.split("[, ]", args) if s]
-                args = [re.sub(r'^"(.*)"$', r'\1', s) for s in args] # remove quotes
-                args = [re.sub(r'%c' % 1, r' ', s) for s in args] # reinstate \001 as a space
-                args = [re.sub(r'%c' % 2, r'"', s) for s in args] # reinstate \002 as "
-                args = [re.sub(r'%c' % 3, r',', s) for s in args] # reinstate \003 as ,
-
-                try:
-                    cmd = {
-                        "addalias" : Action.addAlias,
-                        "declareoptions" : Action.declareOptions,
-                        "envappend" : Action.envAppend,
-                        "envprepend" : Action.envPrepend,
-                        "envset" : Action.envSet,
-                        "envunset" : Action.envUnset,
-                        "pathappend" : Action.envAppend,
-                        "pathprepend" : Action.envPrepend,
-                        "pathremove" : Action.envUnset,
-                        "pathset" : Action.envSet,
-                        "print" : Action.doPrint,
-                        "proddir" : Action.prodDir,
-                        "setupenv" : Action.setupEnv,
-                        "setenv" : Action.envSet,
-                        "unsetenv" : Action.envUnset,
-                        "setuprequired" : Action.setupRequired,
-                        "setupoptional" : Action.setupOptional,
-                        "sourcerequired" : Action.sourceRequired,
-                        "unsetuprequired" : Action.unsetupRequired,
-                        "unsetupoptional" : Action.unsetupOptional,
-                        }[cmd]
-                except KeyError:
-                    print("Unexpected line in %s:%d: %s" % (tableFile, lineNo, line), file=utils.stderr)
-                    continue
+            elif kind == "action":
+                cmd, args = value
+            elif kind == "unknown":
+                print("Unexpected line in %s:%d: %s" % (tableFile, lineNo, line), file=utils.stderr)
+                continue
             else:
                 cmd = line; args = []
 
@@ -455,9 +566,11 @@ but no other interpretation is applied
             self._actions.append(logicalBlocks)
         if block:
             self._actions += [(logical, block, [])]
-        #
-        # Setup the default product, usually "toolchain"
-        #
+
+    def _addDefaultProduct(self, addDefaultProduct):
+        """
+        Setup the default product, usually "toolchain"
+        """
         if addDefaultProduct is not False and hooks.config.Eups.defaultProduct["name"]:
             args = [hooks.config.Eups.defaultProduct["name"]]
             if hooks.config.Eups.defaultProduct["version"]:
@@ -572,6 +685,12 @@ but no other interpretation is applied
                self.topProduct and self.topProduct.name == hooks.config.Eups.defaultProduct["name"]:
             addDefaultProduct = False
 
+        if recursive and isinstance(recursive, bool):
+            nthread = hooks.config.Eups.dependencyThreads
+            if nthread and nthread > 1:
+                self._prefetchTables(Eups, setupType, nthread, addDefaultProduct, requiredVersions,
+                                     listExternalDependencies)
+
         deps = []
         for a in self.actions(Eups.flavor, setupType=setupType):
             if a.cmd == Action.unsetupRequired:
@@ -659,6 +778,78 @@ but no other interpretation is applied
 
         return deps
 
+    def _prefetchTables(self, Eups, setupType, nthread, addDefaultProduct, requiredVersions,
+                        listExternalDependencies):
+        """
+        Load the table files of all the products that this table depends on, recursively, so that
+        dependencies() finds them already parsed.  The tree is walked breadth first; the products
+        at each level are found one at a time, and then their table files are read by a pool of
+        nthread threads.
+
+        Any problems are ignored, as they will be reported when dependencies() walks the tree.
+        """
+        from multiprocessing.pool import ThreadPool
+
+        def loadTable(product):
+            try:
+                return product.getTable(addDefaultProduct=addDefaultProduct, quiet=True)
+            except Exception:
+                return None
+
+        seen = set()
+        pool = ThreadPool(nthread)
+        try:
+            frontier = [self]
+            while frontier:
+                products = []
+                for table in frontier:
+                    for product in table._findDependencies(Eups, setupType, requiredVersions,
+                                                           listExternalDependencies):
+                        key = (product.name, product.version)
+                        if key not in seen:
+                            seen.add(key)
+                            products.append(product)
+
+                frontier = [t for t in pool.map(loadTable, products) if t]
+        finally:
+            pool.close()
+            pool.join()
+
+    def _findDependencies(self, Eups, setupType, requiredVersions, listExternalDependencies):
+        """
+        Return the products that this table's setupRequired/setupOptional commands refer to and that
+        should be recursed into, as they'd be found by dependencies().  Products that can't be found
+        are omitted.
+        """
+        out = []
+        for a in self.actions(Eups.flavor, setupType=setupType):
+            if a.cmd != Action.setupRequired:
+                continue
+
+            requestedVRO, productName, productDir, vers, versExpr, extraArgs = a.processArgs(Eups)
+            if extraArgs["noAction"] or extraArgs["noRecursion"] or \
+                   extraArgs["isExternal"] != listExternalDependencies:
+                continue
+
+            Eups.pushStack("vro", requestedVRO)
+            q = utils.Quiet(Eups)
+            try:
+                try:
+                    if requiredVersions and productName in requiredVersions:
+                        product = Eups.findProduct(productName, requiredVersions[productName])
+                    else:
+                        product = Eups.findProductFromVRO(productName, vers, versExpr)[0]
+                except Exception:
+                    product = None
+            finally:
+                del q
+                Eups.popStack("vro")
+
+            if product:
+                out.append(product)
+
+        return out
+
     def getDeclareOptions(self, flavor, setupType):
         """Return a dictionary of any declareOptions commands in the table file
 
@@ -806,7 +997,7 @@ class Action(object):
         ignoredOpts = []
         while i < len(_args) - 1:
             i += 1
-            if re.search(r"^-", _args[i]):
+            if _args[i].startswith("-"):
                 if _args[i] in ("-f", "--flavor"): # a flavor specification
                     requestedFlavor = _args[i + 1]
                     i += 1              # skip the argument
@@ -843,7 +1034,7 @@ class Action(object):
             productName = None
 
         if productDir:
-            productDir = os.path.expanduser(self.expandEnvironmentalVariable(productDir, Eups.verbose))
+            productDir = os.path.expanduser(self.expandEnvironmentalVariable(productDir, Eups.verbose, Eups.environ))
             if not os.path.isabs(productDir):
                 if self.topProduct:
                     toplevelDir = self.topProduct.dir
@@ -880,7 +1071,7 @@ class Action(object):
         versExpr = None                 # relational expression for version
         if vers:
             # see if a version of the form "exact [logical]"
-            mat = re.search(r"(?:(\S*)\s+)?\[([^\]]+)\]\s*", vers)
+            mat = _versionExprRe.search(vers)
             if mat:
                 vers, versExpr = mat.groups()
 
@@ -959,21 +1150,23 @@ class Action(object):
         return requestedVRO, productName, productDir, vers, versExpr, \
             dict(noRecursion=noRecursion, noAction=noAction, isExternal=isExternal)
 
-    def expandEnvironmentalVariable(self, value, verbose=0):
+    def expandEnvironmentalVariable(self, value, verbose=0, environ=None):
         # look for values that are optional environment variables: ${XXX} or $?{XXX}
         # If desired, specify a default value as e.g. ${XXX-value}
         # if they don't exist, ignore the entire line if marked optional; raise an error otherwise
-        varRE = r"\$(\?)?{([^-}]*)(?:-([^}]+))?}"
-        mat = re.search(varRE, value)
+        # The variables are looked up in environ (default: os.environ)
+        mat = _envVarRe.search(value)
         if not mat:
             return value
 
         optional, key, default = mat.groups()
 
-        if key in os.environ:
-            return re.sub(varRE, os.environ[key], value)
+        if environ is None:
+            environ = os.environ
+        if key in environ:
+            return _envVarRe.sub(environ[key], value)
         elif default:
-            return re.sub(varRE, default, value)
+            return _envVarRe.sub(default, value)
 
         if optional:
             if verbose > 0:
@@ -997,7 +1190,7 @@ class Action(object):
             return
 
         if productDir:
-            productDir = self.expandEnvironmentalVariable(productDir, Eups.verbose)
+            productDir = self.expandEnvironmentalVariable(productDir, Eups.verbose, Eups.environ)
             if productDir is None:
                 return
 
@@ -1105,8 +1298,6 @@ class Action(object):
         else:
             delim = ":"
 
-        opath = os.environ.get(envVar, "") # old value of envVar, generally a path of some sort hence the name
-
         # should we prepend an extra :?
         pat = "^" + delim
         prepend_delim = re.search(pat, value)
@@ -1116,10 +1307,8 @@ class Action(object):
         append_delim = re.search(pat, value)
         value = re.sub(pat, "", value)
 
-        opath = [el for el in opath.split(delim) if el] # strip extra : at start or end
-
         if fwd:
-            value = self.expandEnvironmentalVariable(value, Eups.verbose)
+            value = self.expandEnvironmentalVariable(value, Eups.verbose, Eups.environ)
             if value is None:
                 return
 
@@ -1127,29 +1316,11 @@ class Action(object):
             if Eups.verbose > 1:
                 print("In %s value \"%s\" contains a delimiter '%s'" % (self.tableFile, value, delim), file=utils.stdwarn)
 
-        npath = opath
-        for value in value.split(delim):
-            if fwd:
-                if append:
-                    npath = npath + [value]
-                else:
-                    npath = [value] + npath
-            else:
-                npath = [d for d in npath if d != value]
-
-        npath = self.pathUnique(npath) # remove duplicates
-
-        npath = delim.join(npath)     # convert back to a string
-
-        if prepend_delim and not re.search(r"^%s" % delim, npath):
-            npath = delim + npath
-        if append_delim and not re.search(r"%s$" % delim, npath):
-            npath += delim
-
         if Eups.force and envVar in Eups.oldEnviron:
             del Eups.oldEnviron[envVar]
 
-        Eups.setEnv(envVar, npath, interpolateEnv=True)
+        Eups.editPath(envVar, value.split(delim), delim, append=append, remove=not fwd,
+                      prependDelim=bool(prepend_delim), appendDelim=bool(append_delim))
 
     def execute_addAlias(self, Eups, fwd=True):
         """Execute addAlias"""
@@ -1180,7 +1351,7 @@ class Action(object):
             del Eups.oldEnviron[key]
 
         if fwd:
-            value = self.expandEnvironmentalVariable(value, Eups.verbose)
+            value = self.expandEnvironmentalVariable(value, Eups.verbose, Eups.environ)
             if not value:
                 return
 
@@ -1188,16 +1359,6 @@ class Action(object):
         else:
             Eups.unsetEnv(key)
 
-    def pathUnique(self, path):
-        """Remove repeated copies of an element in a delim-delimited path; e.g. aa:bb:aa:cc -> aa:bb:cc"""
-
-        pp = []
-        for d in path:
-            if d not in pp:
-                pp += [d]
-
-        return pp
-
     def execute_print(self, Eups, fwd=True):
         """Execute print"""
 
@@ -1229,12 +1390,31 @@ class Action(object):
         if not fwd:
             return                      # we don't know how to reset a value. Sorry
 
-        key = self.args[0]
-
-        try:
-            del os.environ[key]
-        except KeyError:
-            pass
+        Eups.unsetEnv(self.args[0])
+
+# the commands recognised in table files, and the Actions that they map to
+_commands = {
+    "addalias" : Action.addAlias,
+    "declareoptions" : Action.declareOptions,
+    "envappend" : Action.envAppend,
+    "envprepend" : Action.envPrepend,
+    "envset" : Action.envSet,
+    "envunset" : Action.envUnset,
+    "pathappend" : Action.envAppend,
+    "pathprepend" : Action.envPrepend,
+    "pathremove" : Action.envUnset,
+    "pathset" : Action.envSet,
+    "print" : Action.doPrint,
+    "proddir" : Action.prodDir,
+    "setupenv" : Action.setupEnv,
+    "setenv" : Action.envSet,
+    "unsetenv" : Action.envUnset,
+    "setuprequired" : Action.setupRequired,
+    "setupoptional" : Action.setupOptional,
+    "sourcerequired" : Action.sourceRequired,
+    "unsetuprequired" : Action.unsetupRequired,
+    "unsetupoptional" : Action.unsetupOptional,
+    }
 
 #-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
 #
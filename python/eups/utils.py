@@ -2,10 +2,12 @@
 Utility functions used across EUPS classes.
 """
 from __future__ import print_function
+import collections
 import time
 import os
 import sys
 import glob
+import hashlib
 import re
 import shutil
 import tempfile
@@ -38,6 +40,8 @@ if sys.version_info[0] == 2:
 
     def is_string(string):
         return isinstance(string, basestring)
+
+    _intern = intern
 else:
     # Python 3.x versions
     import io as StringIO
@@ -72,6 +76,15 @@ else:
     def is_string(string):
         return isinstance(string, str)
 
+    _intern = sys.intern
+
+def internString(string):
+    """Return the canonical copy of a string, so that equal strings share storage.  Anything that
+    isn't a str (e.g. None) is returned unchanged"""
+    if type(string) is str:
+        return _intern(string)
+    return string
+
 #-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
 
 def getUserName(full=False):
@@ -622,6 +635,19 @@ def copyfile(file1, file2):
 
     shutil.copy2(file1, file2)
 
+def fileChecksum(filename, algorithm="sha256"):
+    """Return the hex digest of a file's contents, computed with a hashlib algorithm"""
+
+    digest = hashlib.new(algorithm)
+    with open(filename, "rb") as fd:
+        while True:
+            chunk = fd.read(1024*1024)
+            if not chunk:
+                break
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
 
 #-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
 
@@ -1002,6 +1028,56 @@ def uniq(seq):
 
     return list(_aux(seq))
 
+class LRUCache(object):
+    """
+    A dictionary of bounded size; when it is full, adding an entry discards
+    the least recently used one.  The number of lookups that found (hits) and
+    didn't find (misses) an entry are counted.
+    """
+
+    def __init__(self, maxsize=1000):
+        """
+        @param maxsize   the maximum number of entries to keep
+        """
+        self.maxsize = maxsize
+        self.clear()
+
+    def clear(self):
+        """Forget all entries, and reset the counters"""
+        self._data = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """Return the value for key (making it the most recently used), or default if it isn't present"""
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+
+        self._data[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """Set the value for key, discarding the least recently used entry if the cache is full"""
+        self._data.pop(key, None)
+        self._data[key] = value
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def remove(self, predicate):
+        """Remove the entries whose keys satisfy predicate(key)"""
+        for key in [k for k in self._data.keys() if predicate(k)]:
+            del self._data[key]
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
 if __name__ == "__main__":
     data = {
         'des_system_lib':   set('std synopsys std_cell_lib des_system_lib dw02 dw01 ramlib ieee'.split()),
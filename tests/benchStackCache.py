@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+"""
+A benchmark of the size of the product cache.  A synthetic stack of 50000
+versions (by default 5000 products with 10 versions each, installed under
+the stack root with table files in their ups directories and a couple of
+tags per product) is added to a ProductStack and persisted in the pickle
+format.  The size of the cache file is reported, as is the memory used to
+read it back in (measured in a separate process).  E.g.
+
+   python tests/benchStackCache.py
+
+This is not run as part of testAll.py.
+"""
+from __future__ import print_function
+import optparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+pythonDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "python")
+sys.path.insert(0, pythonDir)
+
+from eups.Product import Product
+from eups.stack import ProductStack
+
+flavor = "Linux64"
+
+def makeStack(root, nProduct, nVersion):
+    """Return a ProductStack for a synthetic stack rooted at root"""
+
+    dbpath = os.path.join(root, "ups_db")
+    os.makedirs(dbpath)
+
+    stack = ProductStack(dbpath, autosave=False)
+    for i in range(nProduct):
+        name = "product%05d" % i
+        for j in range(nVersion):
+            version = "%d.%d.%d+%d" % (j//100, (j//10)%10, j%10, i%7)
+            pdir = os.path.join(root, flavor, name, version)
+            tags = []
+            if j == nVersion - 1:
+                tags.append("current")
+            if j == nVersion - 2:
+                tags.append("stable")
+            stack.addProduct(Product(name, version, flavor, pdir,
+                                     os.path.join(pdir, "ups", name + ".table"), tags, dbpath))
+
+    return stack
+
+# The script run in a subprocess to measure the memory needed to read the cache
+loadScript = """
+import os, sys, resource
+sys.path.insert(0, %(pythonDir)r)
+import eups.stack
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+def rss():
+    try:
+        fd = open("/proc/self/statm")
+        try:
+            return int(fd.read().split()[1])*os.sysconf("SC_PAGE_SIZE")
+        finally:
+            fd.close()
+    except (IOError, OSError):
+        scale = 1 if sys.platform == "darwin" else 1024     # bytes on os/x, kB on linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*scale
+
+rss0 = rss()
+fd = open(%(file)r, "rb")
+lookup = pickle.load(fd)
+fd.close()
+print(rss() - rss0)
+"""
+
+def main():
+    parser = optparse.OptionParser(usage=__doc__)
+    parser.add_option("--products", type="int", default=5000, help="the number of products in the stack")
+    parser.add_option("--versions", type="int", default=10, help="the number of versions of each product")
+    parser.add_option("--root", default=None,
+                      help="the directory to create the stack in (default: a temporary directory)")
+    opts, args = parser.parse_args()
+
+    root = opts.root
+    if root is None:
+        root = tempfile.mkdtemp(prefix="benchStackCache-")
+    root = os.path.join(root, "stacks", "synthetic")
+    try:
+        t0 = time.time()
+        stack = makeStack(root, opts.products, opts.versions)
+        print("Made a stack of %d versions of %d products in %.1fs" %
+              (opts.products*opts.versions, opts.products, time.time() - t0))
+
+        file = os.path.join(stack.dbpath, ProductStack.persistFilename(flavor))
+        t0 = time.time()
+        stack.persist(flavor, file)
+        print("%-20s %8.1f MB  (%.2fs)" % ("cache file size", os.stat(file).st_size/1e6, time.time() - t0))
+
+        t0 = time.time()
+        rss = int(subprocess.check_output([sys.executable, "-c", loadScript % dict(pythonDir=pythonDir,
+                                                                                   file=file)]))
+        print("%-20s %8.1f MB  (%.2fs)" % ("RSS to read cache", rss/1e6, time.time() - t0))
+    finally:
+        if opts.root is None:
+            shutil.rmtree(os.path.dirname(os.path.dirname(root)))
+        else:
+            shutil.rmtree(root)
+
+if __name__ == "__main__":
+    main()
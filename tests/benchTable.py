@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+"""
+A benchmark of the table file parser.  A corpus of large table files (using
+all the supported syntaxes) is written to a temporary directory, and the
+time taken to parse it is reported.  E.g.
+
+   python tests/benchTable.py --baseline /path/to/old/eups/python
+
+where --baseline gives the python directory of another version of eups (e.g.
+a checkout of an earlier release) to compare with; the speedup over that
+version is reported, and the two parsers are checked to agree.
+
+This is not run as part of testAll.py.
+"""
+from __future__ import print_function
+import hashlib
+import optparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+def writeCorpus(corpusDir, nTable, nProduct):
+    """Write nTable table files, each setting up nProduct products, to corpusDir"""
+
+    for i in range(nTable):
+        fd = open(os.path.join(corpusDir, "prod%03d.table" % i), "w")
+        print("File = Table\nProduct = prod%03d\n" % i, file=fd)
+        print("Group:\n   Flavor = Linux\n   Flavor = Darwin\n   Qualifiers = \"\"\nCommon:", file=fd)
+        print("   Action = setup", file=fd)
+        for j in range(nProduct):
+            print("      setupRequired(\"dep%03d v%d_%d -f ${UPS_PROD_FLAVOR}\")  # a comment" % (j, i, j),
+                  file=fd)
+            print("      pathPrepend(PATH, ${UPS_PROD_DIR}/bin%d)" % j, file=fd)
+        print("End:\n", file=fd)
+
+        print("Flavor = DarwinX86\nFlavor = Linux64", file=fd)
+        for j in range(nProduct):
+            print("   envPrepend(LD_LIBRARY_PATH, \"${PRODUCT_DIR}/lib%d\", \" \")" % j, file=fd)
+        print("Flavor = ANY", file=fd)
+        print("   envSet(PROD%03d_HOME, \"${PRODUCT_DIR}/share, \\\"quoted\\\"\")" % i, file=fd)
+
+        print("\nif (type == exact) {", file=fd)
+        for j in range(nProduct):
+            print("   setupRequired(dep%03d -j v%d_%d)" % (j, i, j), file=fd)
+        print("} else if (FLAVOR == Linux) {", file=fd)
+        for j in range(nProduct):
+            print("   setupOptional(dep%03d [>= v%d])" % (j, i), file=fd)
+        print("} else {", file=fd)
+        for j in range(nProduct):
+            print("   setupRequired(dep%03d);" % j, file=fd)
+        print("}", file=fd)
+        print("addAlias(prod%03d, \"ls -l ${PRODUCT_DIR}\")" % i, file=fd)
+        fd.close()
+
+def timeParser(pythonDir, corpusDir, repeat):
+    """
+    Parse the tables in corpusDir repeat times with the eups in pythonDir,
+    returning the best time and a digest of the parsed tables
+    """
+    sys.path.insert(0, pythonDir)
+    from eups.table import Table
+
+    tables = sorted([os.path.join(corpusDir, f) for f in os.listdir(corpusDir)])
+    best = None
+    for i in range(repeat):
+        t0 = time.time()
+        parsed = [Table(t) for t in tables]
+        t = time.time() - t0
+        if best is None or t < best:
+            best = t
+
+    digest = hashlib.md5()
+    for t in parsed:
+        for flavor in ("Linux", "Linux64", "Darwin"):
+            for setupType in ([], ["exact"]):
+                for a in t.actions(flavor, setupType):
+                    digest.update(str(a).encode("utf-8"))
+
+    return best, digest.hexdigest()
+
+def run(pythonDir, corpusDir, repeat):
+    """Run the benchmark in a subprocess using the eups in pythonDir"""
+
+    out = subprocess.check_output([sys.executable, __file__, "--timeOnly", "--corpus", corpusDir,
+                                   "--repeat", str(repeat), "--python", pythonDir])
+    t, digest = out.decode().split()
+    return float(t), digest
+
+def main():
+    parser = optparse.OptionParser(usage=__doc__)
+    parser.add_option("--baseline", help="the python directory of a version of eups to compare with")
+    parser.add_option("--tables", type="int", default=200, help="the number of table files to parse")
+    parser.add_option("--products", type="int", default=50,
+                      help="the number of dependencies in each table file")
+    parser.add_option("--repeat", type="int", default=5, help="the number of times to parse the corpus")
+    parser.add_option("--corpus", help=optparse.SUPPRESS_HELP)
+    parser.add_option("--python", help=optparse.SUPPRESS_HELP)
+    parser.add_option("--timeOnly", action="store_true", help=optparse.SUPPRESS_HELP)
+    opts, args = parser.parse_args()
+
+    if opts.timeOnly:
+        print("%g %s" % timeParser(opts.python, opts.corpus, opts.repeat))
+        return
+
+    pythonDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "python")
+    corpusDir = tempfile.mkdtemp()
+    try:
+        writeCorpus(corpusDir, opts.tables, opts.products)
+
+        nbyte = sum([os.stat(os.path.join(corpusDir, f)).st_size for f in os.listdir(corpusDir)])
+        print("Parsing %d table files (%.1f MB), best of %d" % (opts.tables, nbyte/1e6, opts.repeat))
+
+        t, digest = run(pythonDir, corpusDir, opts.repeat)
+        print("%-10s %8.3fs" % ("current", t))
+
+        if opts.baseline:
+            t0, digest0 = run(opts.baseline, corpusDir, opts.repeat)
+            print("%-10s %8.3fs" % ("baseline", t0))
+            print("speedup    %8.2f" % (t0/t))
+            if digest != digest0:
+                print("The parsed tables differ from those of the baseline")
+                sys.exit(1)
+    finally:
+        shutil.rmtree(corpusDir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+"""
+A benchmark of sorting versions.  A corpus of 10000 version strings, using
+the schemes seen in real stacks (1.2.3, 1.2.3+4, 1.2-rc1, v1_2, w.2021.30,
+8.5a4, 1.2.3-4-g1234abc, ...) and grouped into products, is sorted with
+VersionCompare.sort() and with the old approach of calling stdCompare() for
+every pair, and the two orders are checked to be identical.  E.g.
+
+   python tests/benchVersionCompare.py
+
+This is not run as part of testAll.py.
+"""
+from __future__ import print_function
+import functools
+import optparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "python"))
+
+import eups.VersionCompare as VersionCompare
+
+# Schemes for generating versions; each product uses one of them
+schemes = [
+    lambda r: "%d.%d.%d" % (r.randint(0, 20), r.randint(0, 20), r.randint(0, 30)),
+    lambda r: "%d.%d.%d+%d" % (r.randint(0, 20), r.randint(0, 20), r.randint(0, 30), r.randint(1, 9)),
+    lambda r: "%d.%d-rc%d" % (r.randint(0, 10), r.randint(0, 20), r.randint(1, 5)),
+    lambda r: "%d.%d.%d-%d" % (r.randint(0, 10), r.randint(0, 20), r.randint(0, 30), r.randint(1, 9)),
+    lambda r: "v%d_%d_%d" % (r.randint(0, 20), r.randint(0, 20), r.randint(0, 30)),
+    lambda r: "w.%d.%d" % (r.randint(2015, 2025), r.randint(1, 52)),
+    lambda r: "%d.%d.%d.lsst%d" % (r.randint(0, 5), r.randint(0, 20), r.randint(0, 30), r.randint(1, 4)),
+    lambda r: "%d.%dp%d" % (r.randint(0, 5), r.randint(0, 20), r.randint(1, 30)),
+    lambda r: "%d.%d.%d+svn%d" % (r.randint(0, 5), r.randint(0, 9), r.randint(0, 9), r.randint(100, 9999)),
+    lambda r: "%d.%d%s%d" % (r.randint(0, 9), r.randint(0, 9), r.choice("ab"), r.randint(1, 9)),
+    lambda r: "%d.%d.%d-%d-g%07x" % (r.randint(0, 20), r.randint(0, 20), r.randint(0, 30), r.randint(1, 99),
+                                     r.randint(0, 0xfffffff)),
+    ]
+
+def makeCorpus(nVersion, nProduct, seed):
+    """Return a list of nProduct lists of versions, nVersion versions in all"""
+
+    r = random.Random(seed)
+    products = []
+    for i in range(nProduct):
+        scheme = schemes[i%len(schemes)]
+        products.append([scheme(r) for j in range(nVersion//nProduct)])
+
+    return products
+
+def timeSort(products, sort, repeat):
+    """Return the best time to sort the lists in products, and the sorted lists"""
+
+    best = None
+    for i in range(repeat):
+        lists = [list(p) for p in products]
+        VersionCompare._splitCache.clear()
+        VersionCompare._keyCache.clear()
+
+        t0 = time.time()
+        for vers in lists:
+            sort(vers)
+        t = time.time() - t0
+
+        if best is None or t < best:
+            best = t
+
+    return best, lists
+
+def main():
+    parser = optparse.OptionParser(usage=__doc__)
+    parser.add_option("--versions", type="int", default=10000, help="the number of versions to sort")
+    parser.add_option("--products", type="int", default=100, help="the number of products to divide them into")
+    parser.add_option("--repeat", type="int", default=5, help="the number of times to sort the corpus")
+    parser.add_option("--seed", type="int", default=12345, help="the seed for generating the versions")
+    opts, args = parser.parse_args()
+
+    products = makeCorpus(opts.versions, opts.products, opts.seed)
+    vc = VersionCompare.VersionCompare()
+
+    print("Sorting %d versions of %d products, best of %d" % (opts.versions, opts.products, opts.repeat))
+
+    maxsize = VersionCompare._splitCache.maxsize
+    VersionCompare._splitCache.maxsize = 0 # as stdCompare didn't used to cache anything
+    try:
+        t0, expected = timeSort(products, lambda vers: vers.sort(key=functools.cmp_to_key(vc.stdCompare)),
+                                opts.repeat)
+    finally:
+        VersionCompare._splitCache.maxsize = maxsize
+    print("%-10s %8.3fs" % ("stdCompare", t0))
+
+    t, got = timeSort(products, vc.sort, opts.repeat)
+    print("%-10s %8.3fs" % ("sort", t))
+    print("speedup    %8.2f" % (t0/t))
+
+    nKeyed = len([p for p in products if vc._sortKeys(p) is not None])
+    print("%d of %d products were sorted by key" % (nKeyed, len(products)))
+
+    if got != expected:
+        print("The orders differ from those given by stdCompare")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
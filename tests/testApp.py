@@ -52,6 +52,60 @@ class AppTestCase(unittest.TestCase):
         version = eups.getSetupVersion("python")
         self.assertEqual(version, "2.5.2")
 
+    def testSetupCache(self):
+        userDataDir = os.path.join(testEupsStack, "_userdata_")
+        os.environ["EUPS_USERDATA"] = userDataDir
+        eups.hooks.config.Eups.setupCache = True
+        environ = os.environ.copy()
+        setup = eups.Eups.setup
+        def noSetup(*args, **kwargs):
+            raise RuntimeError("setup was not replayed")
+        try:
+            cmds = eups.setup("python", "2.5.2")
+            self.assertIn("SETUP_TCLTK", os.environ)
+            setups = os.path.join(userDataDir, eups.SetupCache.persistDirName)
+            self.assertEqual(len(os.listdir(setups)), 1)
+
+            # the same request should be replayed without resolving it
+            os.environ = environ.copy()
+            eups.Eups.setup = noSetup
+            self.assertEqual(eups.setup("python", "2.5.2"), cmds)
+            self.assertEqual(os.environ["PYTHON_DIR"],
+                             os.path.join(testEupsStack, "Linux", "python", "2.5.2"))
+            self.assertIn("SETUP_TCLTK", os.environ)
+
+            # but not if something else is setup
+            os.environ = environ.copy()
+            os.environ["SETUP_GOODBYE"] = "goodbye 1.0"
+            self.assertRaises(RuntimeError, eups.setup, "python", "2.5.2")
+
+            # nor if a table file has changed
+            os.environ = environ.copy()
+            table = os.path.join(testEupsStack, "Linux", "python", "2.5.2", "ups", "python.table")
+            st = os.stat(table)
+            os.utime(table, (st.st_atime, st.st_mtime + 10))
+            try:
+                self.assertRaises(RuntimeError, eups.setup, "python", "2.5.2")
+            finally:
+                os.utime(table, (st.st_atime, st.st_mtime))
+
+            # nor if a tag has been assigned
+            myeups = eups.Eups()
+            myeups.assignTag("stable", "python", "2.5.2")
+            try:
+                self.assertRaises(RuntimeError, eups.setup, "python", "2.5.2")
+            finally:
+                myeups.unassignTag("stable", "python", "2.5.2")
+
+            eups.Eups.setup = setup
+            eups.clearCache(inUserDir=True)
+            self.assertEqual(os.listdir(setups), [])
+        finally:
+            eups.Eups.setup = setup
+            eups.hooks.config.Eups.setupCache = False
+            if os.path.exists(userDataDir):
+                shutil.rmtree(userDataDir)
+
 class TagSetupTestCase(unittest.TestCase):
     """
     Tests use cases for selecting tagged versions via app.setup()
@@ -5,6 +5,8 @@ Tests for eups.db
 
 import os
 import shutil
+import sys
+import time
 import unittest
 import testCommon
 from testCommon import testEupsStack
@@ -469,6 +471,7 @@ class ChainFileTestCase(unittest.TestCase):
 
 
 from eups.db import Database
+from eups.db.Database import parseCache
 
 class DatabaseTestCase(unittest.TestCase):
 
@@ -788,6 +791,104 @@ class DatabaseTestCase(unittest.TestCase):
                   os.removedirs(pdir)
             raise
 
+    def testParseCache(self):
+        parseCache.clear()
+
+        prods = self.db.findProducts("python")
+        self.assert_(parseCache.misses > 0)
+        self.assertEqual(parseCache.hits, 0)
+
+        misses = parseCache.misses
+        self.assertEqual(len(self.db.findProducts("python")), len(prods))
+        self.assertEqual(parseCache.misses, misses)
+        self.assert_(parseCache.hits > 0)
+
+        # changes made behind the database's back are seen, as are its own
+        if not os.path.exists(self.pycur+".bak"):
+            shutil.copyfile(self.pycur, self.pycur+".bak")
+        self.assertEqual(self.db.getTaggedVersion("current", "python", "Linux")[1], "2.5.2")
+        # getChainFile returns a ChainFile that the caller may modify
+        cf = self.db.getChainFile("current", "python")
+        cf.setVersion("9.9", "Linux")
+        self.assertEqual(self.db.getTaggedVersion("current", "python", "Linux")[1], "2.5.2")
+
+        cf = ChainFile(self.pycur)
+        cf.setVersion("2.6", "Linux")
+        cf.write()
+        self.assertEqual(self.db.getTaggedVersion("current", "python", "Linux")[1], "2.6")
+        self.db.assignTag("current", "python", "2.5.2")
+        self.assertEqual(self.db.getTaggedVersion("current", "python", "Linux")[1], "2.5.2")
+
+        os.rename(self.pycur+".bak", self.pycur)
+
+    def testListingCache(self):
+        dbmod = sys.modules["eups.db.Database"]
+
+        scanned = []
+        _scanDir = dbmod._scanDir
+        def scanDir(dir):
+            scanned.append(dir)
+            return _scanDir(dir)
+
+        pdir = self.db._productDir("python")
+        st = os.stat(pdir)
+        os.utime(pdir, (st.st_atime, time.time() - 60))
+        dbmod._scanDir = scanDir
+        try:
+            versions = self.db.findVersions("python")
+            self.assertEqual(scanned.count(pdir), 1)
+            self.assertEqual(self.db.findVersions("python"), versions)
+            self.assertEqual(len(self.db.findProducts("python")), len(versions))
+            self.assert_(self.db.isDeclared("python", "2.6"))
+            self.assertEqual(self.db.getTaggedVersion("current", "python", "Linux")[1], "2.5.2")
+            self.assertEqual(scanned.count(pdir), 1)
+
+            # a new file changes the directory's mtime, so the directory is listed again
+            # (and until its mtime is old enough to be trusted, every time it's needed)
+            tagfile = os.path.join(pdir, "beta.chain")
+            shutil.copyfile(self.pycur, tagfile)
+            try:
+                self.assert_("beta" in self.db.findTags("python", "2.5.2", "Linux"))
+                self.assert_(scanned.count(pdir) > 1)
+            finally:
+                os.remove(tagfile)
+            self.assert_("beta" not in self.db.findTags("python", "2.5.2", "Linux"))
+        finally:
+            dbmod._scanDir = _scanDir
+            os.utime(pdir, (st.st_atime, st.st_mtime))
+
+    def testJournal(self):
+        pdir = self.db._productDir("base")
+        baseidir = os.path.join(testEupsStack,"Linux/base/1.0")
+        base = Product("base", "1.0", "Linux", baseidir,
+                       os.path.join(baseidir, "ups/base.table"))
+
+        journal = self.db._journalFile()
+        if os.path.exists(journal):
+            os.remove(journal)
+        self.assertEqual(self.db.getJournalState(), None)
+
+        self.db.declare(base)
+        try:
+            state = self.db.getJournalState()
+            self.assertNotEqual(state, None)
+            self.assertEqual(self.db.findProductNames().count("base"), 1)
+            self.assertEqual(self.db.findChangedProductNames(state), [])
+            self.assert_(not self.db.isNewerThan(time.time() + 1))
+            self.assert_(self.db.isNewerThan(os.stat(pdir).st_mtime - 1))
+
+            self.db.assignTag("beta", "base", "1.0")
+            self.assertEqual(self.db.findChangedProductNames(state), ["base"])
+        finally:
+            self.db.undeclare(base)
+
+        self.assertEqual(self.db.findChangedProductNames(state), ["base"])
+
+        # a removed journal means that we can't tell what has changed
+        os.remove(journal)
+        self.assertEqual(self.db.findChangedProductNames(state), None)
+        self.assert_(not self.db.isNewerThan(time.time() + 1))
+
 #-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
 
 def suite(makeSuite=True):
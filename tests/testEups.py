@@ -13,6 +13,7 @@ import sys
 import shutil
 import unittest
 import tempfile
+import threading
 import time
 from eups.utils import StringIO
 from testCommon import testEupsStack
@@ -488,6 +489,13 @@ class EupsTestCase(unittest.TestCase):
         self.assertEqual(prods[1].name, "doxygen")
         self.assertEqual(prods[1].version, "1.5.9")
 
+        # the products are generated one name at a time, in order
+        prods = self.eups.iterProducts()
+        self.assert_(not isinstance(prods, list))
+        prods = [(p.name, p.version) for p in prods]
+        self.assertEqual(prods, [(p.name, p.version) for p in self.eups.findProducts()])
+        self.assertEqual([n for n, v in prods], sorted([n for n, v in prods]))
+
         # test deprecated function:
         q = Quiet(self.eups)
         prods = self.eups.listProducts("python", current=True)
@@ -514,6 +522,235 @@ class EupsTestCase(unittest.TestCase):
         self.assertNotIn("TCLTK_DIR", os.environ)
         self.assertNotIn("SETUP_TCLTK", os.environ)
 
+    def testSetupPaths(self):
+        # the paths are built up by the whole setup, and written to os.environ at the end
+        path0 = os.environ.get("PATH", "")
+        try:
+            self.eups.setup("python")
+            pythonBin = os.path.join(os.environ["PYTHON_DIR"], "bin")
+            path = os.environ["PATH"].split(":")
+            self.assertEqual(path[0], pythonBin)
+
+            self.eups.setup("python")
+            self.assertEqual(os.environ["PATH"].split(":"), path)
+
+            self.eups.unsetup("python")
+            self.assertNotIn(pythonBin, os.environ["PATH"].split(":"))
+        finally:
+            os.environ["PATH"] = path0
+
+    def testSetupIndex(self):
+        # the setup products are found without rescanning the environment or the databases
+        self.eups.setup("python")
+        try:
+            self.assertEqual(sorted([p.name for p in self.eups.getSetupProducts()]), ["python", "tcltk"])
+
+            calls = []
+            findProduct0 = self.eups.findProduct
+            def findProduct(*args, **kwargs):
+                calls.append(args[0])
+                return findProduct0(*args, **kwargs)
+
+            self.eups.findProduct = findProduct
+            prod = self.eups.findSetupProduct("python")
+            self.assertEqual(prod.version, "2.5.2")
+            self.assert_(self.eups.isSetup("python", "2.5.2"))
+            self.assertEqual(calls, [])
+
+            # changes made behind our back are noticed too
+            os.environ["SETUP_EUPSTESTX"] = "eupstestx 1.0 -f generic -Z (none)"
+            self.assertIn("SETUP_EUPSTESTX", self.eups.environ.setupVariables())
+            # ...even if os.environ stays the same size
+            del os.environ["SETUP_EUPSTESTX"]
+            os.environ["SETUP_EUPSTESTY"] = "eupstesty 1.0 -f generic -Z (none)"
+            setupVars = self.eups.environ.setupVariables()
+            self.assertNotIn("SETUP_EUPSTESTX", setupVars)
+            self.assertEqual(setupVars["SETUP_EUPSTESTY"], "eupstesty 1.0 -f generic -Z (none)")
+            os.environ["SETUP_EUPSTESTY"] = "eupstesty 2.0 -f generic -Z (none)"
+            self.assertEqual(self.eups.environ.setupVariables()["SETUP_EUPSTESTY"],
+                             "eupstesty 2.0 -f generic -Z (none)")
+            del os.environ["SETUP_EUPSTESTY"]
+
+            setupTcltk = os.environ.pop("SETUP_TCLTK")
+            os.environ["EUPSTEST_NOT_SETUP"] = "1"
+            try:
+                self.assertEqual([p.name for p in self.eups.getSetupProducts()], ["python"])
+            finally:
+                del os.environ["EUPSTEST_NOT_SETUP"]
+                os.environ["SETUP_TCLTK"] = setupTcltk
+
+            setupPython = os.environ["SETUP_PYTHON"]
+            os.environ["SETUP_PYTHON"] = setupPython.replace("2.5.2", "2.6")
+            self.assertEqual(self.eups.findSetupProduct("python").version, "2.6")
+            self.assertEqual(calls, ["python"])
+            os.environ["SETUP_PYTHON"] = setupPython
+        finally:
+            del self.eups.findProduct
+            self.eups.unsetup("python")
+
+        self.assertEqual(self.eups.getSetupProducts(), [])
+
+    def testVROCache(self):
+        # the VRO is compiled once, and the products found are remembered during a setup
+        vro = self.eups.getPreferredTags()
+        plan = self.eups._compileVRO(vro)
+        self.assert_(self.eups._compileVRO(vro) is plan)
+
+        calls = []
+        findTaggedProduct0 = self.eups._findTaggedProduct
+        def findTaggedProduct(name, tag, *args):
+            calls.append((name, str(tag)))
+            return findTaggedProduct0(name, tag, *args)
+        self.eups._findTaggedProduct = findTaggedProduct
+
+        try:
+            product, vroReason = self.eups.findProductFromVRO("python")
+            self.assertEqual((product.version, vroReason), ("2.5.2", ["current", None]))
+            ncall = len(calls)
+
+            self.eups._vroLookups = {} # as if we were in the middle of a setup
+            for i in range(2):
+                self.assertEqual(self.eups.findProductFromVRO("python"), [product, vroReason])
+            self.assertEqual(len(calls), 2*ncall)
+
+            self.eups._forgetProducts()
+            self.eups.findProductFromVRO("python")
+            self.assertEqual(len(calls), 3*ncall)
+
+            self.eups.setPreferredTags("latest")
+            self.assert_(self.eups._compileVRO(self.eups.getPreferredTags()) is not plan)
+            product, vroReason = self.eups.findProductFromVRO("python")
+            self.assertEqual((product.version, vroReason), ("2.6", ["latest", None]))
+        finally:
+            del self.eups._findTaggedProduct
+            self.eups._vroLookups = None
+
+    def testEnvBuilder(self):
+        from eups.EnvBuilder import EnvBuilder
+
+        env = EnvBuilder()
+        os.environ["EUPS_TEST_PATH"] = "a::b:a"
+        try:
+            env.begin()
+            env.editPath("EUPS_TEST_PATH", ["c"])
+            env.editPath("EUPS_TEST_PATH", ["b", "d"], append=True)
+            self.assertEqual(os.environ["EUPS_TEST_PATH"], "a::b:a") # not written yet
+            self.assertEqual(env.get("EUPS_TEST_PATH"), "c:a:b:d")
+
+            env.checkpoint()
+            env.editPath("EUPS_TEST_PATH", ["b"])
+            env.editPath("EUPS_TEST_PATH", ["a"], remove=True)
+            env.set("EUPS_TEST_VAR", "x")
+            self.assertEqual(env.get("EUPS_TEST_PATH"), "b:c:d")
+            env.rollback()
+            self.assertEqual(env.get("EUPS_TEST_PATH"), "c:a:b:d")
+            self.assertNotIn("EUPS_TEST_VAR", env)
+
+            env.editPath("EUPS_TEST_PATH", ["e"], prependDelim=True)
+            env.end()
+            self.assertEqual(os.environ["EUPS_TEST_PATH"], ":e:c:a:b:d")
+
+            env.editPath("EUPS_TEST_PATH", ["c"], remove=True) # written immediately
+            self.assertEqual(os.environ["EUPS_TEST_PATH"], "e:a:b:d")
+        finally:
+            del os.environ["EUPS_TEST_PATH"]
+
+    def testDependencies(self):
+        # the tables of the dependencies are read in parallel, but the
+        # answer should be the same as when they're read one at a time
+        threads0 = eups.hooks.config.Eups.dependencyThreads
+        getTable0 = eups.Product.getTable
+        loaded = []
+        def getTable(self, *args, **kwargs):
+            loaded.append((self.name, threading.current_thread().name))
+            return getTable0(self, *args, **kwargs)
+
+        deps = {}
+        try:
+            eups.Product.getTable = getTable
+            for nthread in (0, 4):
+                eups.hooks.config.Eups.dependencyThreads = nthread
+                myeups = Eups()
+                prod = myeups.findProduct("python", "2.5.2")
+                deps[nthread] = [(p.name, p.version, optional, depth) for p, optional, depth in
+                                 myeups.getDependentProducts(prod)]
+        finally:
+            eups.Product.getTable = getTable0
+            eups.hooks.config.Eups.dependencyThreads = threads0
+
+        self.assertEqual(deps[0], deps[4])
+        self.assertIn(("tcltk", "8.5a4", False, 1), deps[4])
+        self.assertIn("tcltk", [name for name, thread in loaded
+                                if thread != threading.current_thread().name])
+
+    def testUses(self):
+        usesDir = os.path.join(testEupsStack, "_userdata_", "_uses_")
+        getDependentProducts0 = Eups.getDependentProducts
+        analysed = []
+        def getDependentProducts(self, topProduct, *args, **kwargs):
+            analysed.append(topProduct.name)
+            return getDependentProducts0(self, topProduct, *args, **kwargs)
+
+        try:
+            Eups.getDependentProducts = getDependentProducts
+
+            users = self.eups.uses("tcltk")
+            self.assertEqual([(u[0], u[1], u[2].depth) for u in users], [("python", "2.5.2", 2)])
+            self.assertIn("python", analysed)
+            self.assert_(os.listdir(usesDir), "The dependencies were not saved")
+
+            # the saved dependencies are used while nothing changes
+            del analysed[:]
+            self.assertEqual(len(Eups().uses("tcltk")), 1)
+            self.assertEqual(analysed, [])
+
+            # only the changed product is reanalysed
+            pdir10 = os.path.join(testEupsStack, "Linux", "newprod", "1.0")
+            self.eups.declare("newprod", "1.0", pdir10, testEupsStack,
+                              tablefile=StringIO.StringIO("setupRequired(tcltk)\n"))
+            del analysed[:]
+            users = Eups().uses("tcltk")
+            self.assertEqual(sorted([u[0] for u in users]), ["newprod", "python"])
+            self.assertEqual(set(analysed), set(["newprod"]))
+
+            self.eups.undeclare("newprod", "1.0", testEupsStack)
+            self.assertEqual([u[0] for u in Eups().uses("tcltk")], ["python"])
+        finally:
+            Eups.getDependentProducts = getDependentProducts0
+            if os.path.exists(usesDir):
+                shutil.rmtree(usesDir)
+
+    def testReadOnlyCache(self):
+        # setUp()'s Eups wrote the caches; check that we use them without writing to them
+        cacheDir = self.eups._userStackCache(testEupsStack)
+        caches = [os.path.join(cacheDir, f) for f in os.listdir(cacheDir)
+                  if ProductStack.persistFileRe.match(f)]
+        self.assert_(caches, "No product caches were written")
+        mtimes = [os.stat(f).st_mtime for f in caches]
+        time.sleep(1)
+
+        myeups = Eups(readCache=False, readOnlyCache=True)
+        self.assertIn(testEupsStack, myeups.versions)
+        self.assertEqual(myeups.findProduct("python").version, "2.5.2")
+        prod = myeups.findProduct("python", "2.5.2")
+        self.assert_(prod._prodStack is not None, "Product wasn't found in the cache")
+
+        # changes are seen, but not written to the caches
+        pdir10 = os.path.join(testEupsStack, "Linux", "newprod", "1.0")
+        table = os.path.join(pdir10, "ups", "newprod.table")
+        Eups(readCache=False).declare("newprod", "1.0", pdir10, testEupsStack, table)
+        myeups = Eups(readCache=False, readOnlyCache=True)
+        self.assertIn(testEupsStack, myeups.versions)
+        self.assert_(myeups.findProduct("newprod", "1.0") is not None, "Failed to see declared product")
+        self.assertEqual([os.stat(f).st_mtime for f in caches], mtimes)
+
+        # without caches, the databases are used
+        for f in caches:
+            os.remove(f)
+        myeups = Eups(readCache=False, readOnlyCache=True)
+        self.assertNotIn(testEupsStack, myeups.versions)
+        self.assertEqual(myeups.findProduct("python").version, "2.5.2")
+
     def testRemove(self):
         os.environ = self.environ0
 
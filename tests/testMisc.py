@@ -9,10 +9,14 @@ import shutil
 import re
 import unittest
 import time
+import random
+import functools
 import testCommon
 from testCommon import testEupsStack
 
 import eups
+import eups.VersionCompare
+from eups.VersionParser import VersionParser, compileVersionExpr
 
 class MiscTestCase(unittest.TestCase):
 
@@ -25,6 +29,89 @@ class MiscTestCase(unittest.TestCase):
     def testNothing(self):
         pass
 
+class VersionCompareTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.vc = eups.VersionCompare.VersionCompare()
+
+    def testSort(self):
+        # sorting by key must give the same order as calling stdCompare
+        versions = ["1", "1-a", "1+a", "1-b", "1+b", "1-rc2", "1-rc2+a", "1-rc2+b", "1.1", "1.2", "1.2.1",
+                    "1.2.2", "1.3", "1_0_2", "1.0.0", "1.2-rc1", "1.2-rc2", "1.2-rc4", "1.2.3", "1.2+h1",
+                    "1.2-rc1+h1", "1.2.3+svn666", "1.2.3-svn666", "1.2.3+svn100", "1.2.3+svn1000",
+                    "1.2.3+rvn1000", "1.2.3+tvn666", "v1_0", "v2_0", "v1.2-0", "v1.2-4", "1.0p2", "1.0m2",
+                    "2.0p10", "w.2021.30", "w.2021.4", "rc", "rc1", "rc10", "ab", "ab1", ""]
+        self.assert_(self.vc._sortKeys(versions) is not None)
+
+        r = random.Random(666)
+        for irregular in ([], ["8.5a4"], ["1.01"], ["1.2.3-4-g1234abc"]):
+            for i in range(10):
+                vers = versions + irregular
+                r.shuffle(vers)
+                expected = sorted(vers, key=functools.cmp_to_key(self.vc.stdCompare))
+
+                self.vc.sort(vers)
+                self.assertEqual(vers, expected)
+
+        self.assertEqual(self.vc.sortKey("8.5a4"), None)
+        self.assertEqual(self.vc._sortKeys(["1.01", "1.1"]), None) # stdCompare ignores the rest of 1.01-2
+
+    def testSortVersions(self):
+        # a user-supplied comparison must be honoured
+        class Reversed(eups.VersionCompare.VersionCompare):
+            def compare(self, v1, v2, mustReturnInt=True):
+                return -self.stdCompare(v1, v2)
+
+        vers = [("b", "1.10"), ("a", "1.9"), ("c", "1.2")]
+        eups.VersionCompare.sortVersions(vers, self.vc, key=lambda v: v[1])
+        self.assertEqual([v[0] for v in vers], ["c", "a", "b"])
+
+        eups.VersionCompare.sortVersions(vers, Reversed(), key=lambda v: v[1])
+        self.assertEqual([v[0] for v in vers], ["b", "a", "c"])
+
+        vers = ["1.9", "1.10", "1.2"]
+        eups.VersionCompare.sortVersions(vers, lambda a, b: -self.vc.stdCompare(a, b))
+        self.assertEqual(vers, ["1.10", "1.9", "1.2"])
+
+    def testSubclassCache(self):
+        # a subclass that splits versions differently doesn't share the base class's cached splits
+        class Dashless(eups.VersionCompare.VersionCompare):
+            def _doSplitVersion(self, version):
+                return eups.VersionCompare.VersionCompare._doSplitVersion(self, version.replace("-", "."))
+
+        self.assertEqual(self.vc.compare("1.0-2", "1.0"), -1)
+        self.assertEqual(Dashless().compare("1.0-2", "1.0"), 1)
+        self.assertEqual(self.vc.compare("1.0-2", "1.0"), -1)
+
+        self.assertNotEqual(self.vc.sortKey("1.0-2"), Dashless().sortKey("1.0-2"))
+
+class VersionParserTestCase(unittest.TestCase):
+
+    def matchPrim(self, op, v1, v2):
+        c = eups.VersionCompare.VersionCompare().stdCompare(v1, v2)
+        return {"<" : c < 0, "<=" : c <= 0, "==" : c == 0, ">" : c > 0, ">=" : c >= 0}[op]
+
+    def testVersionExpr(self):
+        expr = compileVersionExpr(">= 3.2 || == 2.7")
+        self.assert_(compileVersionExpr(">= 3.2 || == 2.7") is expr)
+
+        versions = ["2.6", "2.7", "3.1", "3.2", "3.10"]
+        self.assertEqual([v for v in versions if expr.match(v, self.matchPrim)], ["2.7", "3.2", "3.10"])
+
+        expr = compileVersionExpr(">= 2.7 && < 3.2")
+        self.assertEqual([v for v in versions if expr.match(v, self.matchPrim)], ["2.7", "3.1"])
+        self.assertEqual(expr.match("2.6", self.matchPrim), False) # short circuited
+
+        expr = compileVersionExpr("3.1")
+        self.assertEqual([v for v in versions if expr.match(v, self.matchPrim)], ["3.1"])
+
+    def testTokenCache(self):
+        # the tokens are shared between parsers, but each parser consumes its own copy
+        for flavor, expected in [("Linux", True), ("Darwin", False), ("Linux", True)]:
+            parser = VersionParser("FLAVOR == Linux || (FLAVOR == Linux64)")
+            parser.define("flavor", flavor)
+            self.assertEqual(parser.eval(), expected)
+
 #-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
 
 def suite(makeSuite=True):
@@ -32,6 +119,8 @@ def suite(makeSuite=True):
 
     return testCommon.makeSuite([
         MiscTestCase,
+        VersionCompareTestCase,
+        VersionParserTestCase,
         ], makeSuite)
 
 def run(shouldExit=False):
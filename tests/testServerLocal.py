@@ -4,9 +4,16 @@ Tests for eups.server, focussing on local (cp) tranport mechanisms
 """
 
 import os
+import shutil
+import tarfile
+import tempfile
+import threading
+import time
 import unittest
 from testCommon import testEupsStack
 
+import eups.hooks as hooks
+
 from eups.distrib.server import Transporter, LocalTransporter
 from eups.distrib.server import ConfigurableDistribServer
 
@@ -220,7 +227,7 @@ class LocalRepositoryTestCase(unittest.TestCase):
         self.assertEqual(pkg[1], "1.5.8")
         self.assertEqual(pkg[2], "generic")
 
-from eups.distrib.Repositories import Repositories
+from eups.distrib.Repositories import Repositories, _runInParallel, _Prefetcher
 
 class LocalRepositoriesTestCase(unittest.TestCase):
     def setUp(self):
@@ -315,8 +322,365 @@ class LocalRepositoriesTestCase(unittest.TestCase):
         self.assertEqual(pkg[3], self.pkgroot)
 
 
+class ParallelInstallTestCase(unittest.TestCase):
+
+    def testRunInParallel(self):
+        # b and c need a; d needs b and c; e needs nothing
+        tasks = "abcde"
+        predecessors = dict(b=set("a"), c=set("a"), d=set("bc"))
+
+        lock = threading.Lock()
+        log = []
+        running = set()
+        overlapped = []
+
+        def start(t):
+            log.append(("start", t))
+
+        def run(t):
+            with lock:
+                running.add(t)
+                if len(running) > 1:
+                    overlapped.append(t)
+            time.sleep(0.05)
+            with lock:
+                running.discard(t)
+            if t == failTask[0]:
+                raise RuntimeError("failed to build %s" % t)
+
+        def finish(t):
+            log.append(("finish", t))
+
+        failTask = [None]
+        _runInParallel(tasks, predecessors, 3, start, run, finish)
+        self.assertEqual(sorted([t for what, t in log if what == "finish"]), list(tasks))
+        for t, preds in predecessors.items():
+            for p in preds:
+                self.assertTrue(log.index(("finish", p)) < log.index(("start", t)))
+        self.assertTrue(overlapped)
+
+        # a failure stops any more tasks being started, and is raised
+        del log[:]
+        failTask[0] = "a"
+        self.assertRaises(RuntimeError, _runInParallel, tasks, predecessors, 3, start, run, finish)
+        self.assertTrue(("start", "d") not in log)
+        self.assertTrue(("finish", "a") not in log)
+
+class PrefetchTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="testPrefetch-")
+        self.downloadCache = hooks.config.Eups.downloadCache
+        hooks.config.Eups.downloadCache = False
+
+    def tearDown(self):
+        hooks.config.Eups.downloadCache = self.downloadCache
+        shutil.rmtree(self.tmpdir)
+
+    def testBudget(self):
+        fetched = []
+
+        def fetch(name, size):
+            fetched.append(name)
+            filename = os.path.join(self.tmpdir, name)
+            with open(filename, "w") as fd:
+                fd.write("x"*size)
+            return filename
+
+        prefetcher = _Prefetcher(1, 150)
+        try:
+            for name in "abc":
+                prefetcher.prefetchPackage(name, None, fetch, name, 100)
+
+            def waitUntil(nbytes):
+                for i in range(50):
+                    if prefetcher.nbytes == nbytes:
+                        break
+                    time.sleep(0.1)
+                time.sleep(0.1)
+
+            waitUntil(200)
+            self.assertEqual(fetched, ["a", "b"]) # c has to wait until there's room
+
+            prefetcher.release("a")
+            waitUntil(200)
+            self.assertEqual(fetched, ["a", "b", "c"])
+
+            # A file that's needed before its download starts isn't downloaded
+            prefetcher.prefetchPackage("d", None, fetch, "d", 100)
+            prefetcher.waitForPackage("d")
+            time.sleep(0.1)
+            self.assertTrue("d" not in fetched)
+        finally:
+            prefetcher.close()
+
+    def testCachedFile(self):
+        serverDir = os.path.join(self.tmpdir, "server")
+        os.makedirs(serverDir)
+        with open(os.path.join(serverDir, "foo.tar.gz"), "w") as fd:
+            fd.write("foo")
+
+        buildDir = os.path.join(self.tmpdir, "build")
+        filename = os.path.join(buildDir, "foo.tar.gz")
+
+        ds = DistribServer(serverDir)
+        ds._fileCache = {}
+        self.assertEqual(ds.getFile("foo.tar.gz", filename=filename), filename)
+
+        # a prefetched file may be requested under the same name...
+        os.remove(os.path.join(serverDir, "foo.tar.gz"))
+        self.assertEqual(ds.getFile("foo.tar.gz", filename=filename), filename)
+        # ...or be copied elsewhere
+        other = os.path.join(self.tmpdir, "other", "foo.tar.gz")
+        self.assertEqual(ds.getFile("foo.tar.gz", filename=other), other)
+        with open(other) as fd:
+            self.assertEqual(fd.read(), "foo")
+
+        # if the build directory has been cleaned up, the file is retrieved again
+        shutil.rmtree(buildDir)
+        self.assertRaises(Exception, ds.getFile, "foo.tar.gz", filename=filename)
+
+class DistribInstallTestCase(unittest.TestCase):
+    """Install products from a local tarball server: a; b and c need a; d needs b and c"""
+
+    deps = dict(a=[], b=["a"], c=["a"], d=["a", "b", "c"])
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="testDistribInstall-")
+        self.serverDir = os.path.join(self.tmpdir, "server")
+        self.stack = os.path.join(self.tmpdir, "stack")
+        os.makedirs(os.path.join(self.serverDir, "manifests"))
+        os.makedirs(os.path.join(self.stack, "ups_db"))
+
+        for p in self.deps:
+            srcDir = os.path.join(self.tmpdir, "src")
+            os.makedirs(os.path.join(srcDir, p, "1.0", "ups"))
+            with open(os.path.join(srcDir, p, "1.0", "ups", "%s.table" % p), "w") as fd:
+                for q in self.deps[p]:
+                    fd.write("setupRequired(%s 1.0)\n" % q)
+            with tarfile.open(os.path.join(self.serverDir, "%s-1.0.tar.gz" % p), "w:gz") as tar:
+                tar.add(os.path.join(srcDir, p), p)
+            shutil.rmtree(srcDir)
+
+            self.writeManifest(p, self.deps[p])
+        #
+        # The products are unpacked by bash scripts that source $EUPS_DIR/bin/setups.sh
+        #
+        eupsDir = os.path.join(self.tmpdir, "eups")
+        os.makedirs(os.path.join(eupsDir, "bin"))
+        open(os.path.join(eupsDir, "bin", "setups.sh"), "w").close()
+        os.makedirs(os.path.join(self.tmpdir, "userdata", "ups_db"))
+
+        self.environ = os.environ.copy()
+        os.environ["EUPS_DIR"] = eupsDir
+        os.environ["EUPS_PATH"] = self.stack
+        os.environ["EUPS_USERDATA"] = os.path.join(self.tmpdir, "userdata")
+        self.downloadCache = hooks.config.Eups.downloadCache
+        hooks.config.Eups.downloadCache = False
+
+        self.eups = Eups()
+        self.options = {"installCurrent": False}
+
+    def tearDown(self):
+        hooks.config.Eups.downloadCache = self.downloadCache
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.tmpdir)
+
+    def writeManifest(self, product, deps, shouldRecurse=None):
+        with open(os.path.join(self.serverDir, "manifests", "%s-1.0.manifest" % product), "w") as fd:
+            fd.write("EUPS distribution manifest for %s (1.0). Version 1.0\n" % product)
+            for q in deps + [product]:
+                fd.write("%s generic 1.0 %s.table %s/1.0 %s-1.0.tar.gz" % (q, q, q, q))
+                if q == shouldRecurse:
+                    fd.write(" REQUIRED TRUE")
+                fd.write("\n")
+
+    def corrupt(self, product):
+        with open(os.path.join(self.serverDir, "%s-1.0.tar.gz" % product), "w") as fd:
+            fd.write("not a tarball")
+
+    def makeRepositories(self):
+        return Repositories(self.serverDir, eupsenv=self.eups, verbosity=-1)
+
+    def buildDirs(self):
+        buildDir = os.path.join(self.stack, "EupsBuildDir", self.eups.flavor)
+        return sorted(os.listdir(buildDir)) if os.path.isdir(buildDir) else []
+
+    def instrument(self, repos):
+        """Record when the products' builds start and finish, and when they're declared"""
+        events = []
+        setups = {}
+        lock = threading.Lock()
+
+        buildPackage = repos._buildPackage
+        def _buildPackage(distrib, prod, productRoot, setupCmds, builddir):
+            with lock:
+                events.append(("start", prod.product))
+                setups[prod.product] = list(setupCmds)
+            time.sleep(0.2)             # give the other builds a chance to start
+            buildPackage(distrib, prod, productRoot, setupCmds, builddir)
+            with lock:
+                events.append(("built", prod.product))
+        repos._buildPackage = _buildPackage
+
+        finishInstall = repos._finishInstall
+        def _finishInstall(pkgroot, prod, *args):
+            finishInstall(pkgroot, prod, *args)
+            events.append(("declared", prod.product))
+        repos._finishInstall = _finishInstall
+
+        return events, setups
+
+    def testParallelInstall(self):
+        self.makeRepositories().install("a", "1.0", options=self.options)
+
+        repos = self.makeRepositories()
+        events, setups = self.instrument(repos)
+        repos.install("d", "1.0", options=self.options, jobs=3, alsoTag="stable")
+
+        # b and c are built at the same time...
+        self.assertTrue(events.index(("start", "b")) < events.index(("built", "c")))
+        self.assertTrue(events.index(("start", "c")) < events.index(("built", "b")))
+        # ...and d once they're both declared
+        for p in "bc":
+            self.assertTrue(events.index(("declared", p)) < events.index(("start", "d")))
+        self.assertTrue(("start", "a") not in events) # it was already installed
+
+        self.assertEqual(setups["b"], ["setup --just --type=build a 1.0"])
+        self.assertEqual(sorted(setups["d"]), ["setup --just --type=build %s 1.0" % p for p in "abc"])
+
+        for p in "abcd":                # including a, which was already installed
+            self.assertTrue("stable" in self.eups.findProduct(p, "1.0").tags)
+
+    def testParallelInstallFailure(self):
+        self.corrupt("b")
+
+        repos = self.makeRepositories()
+        events, setups = self.instrument(repos)
+        self.assertRaises(RuntimeError, repos.install, "d", "1.0", options=self.options, jobs=3)
+
+        # c is declared although b failed, but d isn't started
+        self.assertTrue(("declared", "c") in events)
+        self.assertTrue(self.eups.findProduct("c", "1.0") is not None)
+        self.assertTrue(self.eups.findProduct("b", "1.0") is None)
+        self.assertTrue(("start", "d") not in events)
+
+    def testRecursiveInstallFallback(self):
+        # If a manifest's dependencies must be searched for, products are installed one at a time
+        self.writeManifest("d", self.deps["d"], shouldRecurse="b")
+
+        repos = self.makeRepositories()
+        events, setups = self.instrument(repos)
+        recursiveInstall = repos._recursiveInstall
+        calls = []
+        def _recursiveInstall(*args, **kwargs):
+            calls.append(args[0])
+            return recursiveInstall(*args, **kwargs)
+        repos._recursiveInstall = _recursiveInstall
+
+        repos.install("d", "1.0", options=self.options, jobs=3)
+        self.assertTrue(0 in calls)
+        for p in "abcd":
+            self.assertTrue(self.eups.findProduct(p, "1.0") is not None)
+
+    def testPrefetchCleanup(self):
+        # The distribution files of products that aren't built because an install fails are deleted
+        self.makeRepositories().install("a", "1.0", options=self.options)
+        self.corrupt("b")
+
+        for jobs in (1, 3):
+            self.assertRaises(RuntimeError, self.makeRepositories().install, "d", "1.0",
+                              options=self.options, jobs=jobs)
+            self.assertEqual(self.buildDirs(), ["b-1.0"])
+            shutil.rmtree(os.path.join(self.stack, "EupsBuildDir"))
+
+from eups.distrib.DownloadCache import DownloadCache
+
+class CountingTransporter(LocalTransporter):
+    """A LocalTransporter that counts the files it copies"""
+    ncopy = 0
+
+    def cacheToFile(self, filename, noaction=False):
+        CountingTransporter.ncopy += 1
+        LocalTransporter.cacheToFile(self, filename, noaction)
+
+class DownloadCacheTestCase(unittest.TestCase):
 
-__all__ = "LocalTransporterTestCase LocalConfigFileTestCase LocalServerConfTestCase LocalDistribServerTestCase LocalRepositoryTestCase LocalRepositoriesTestCase".split()
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="testDownloadCache-")
+        self.serverDir = os.path.join(self.tmpdir, "server")
+        os.makedirs(self.serverDir)
+        self.cache = DownloadCache(os.path.join(self.tmpdir, "cache"))
+        CountingTransporter.ncopy = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def writeServerFile(self, name, contents, mtime=None):
+        filename = os.path.join(self.serverDir, name)
+        with open(filename, "w") as fd:
+            fd.write(contents)
+        if mtime is not None:
+            os.utime(filename, (mtime, mtime))
+
+        return filename
+
+    def retrieve(self, name):
+        filename = os.path.join(self.tmpdir, "out", name)
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+
+        self.cache.retrieve(CountingTransporter(os.path.join(self.serverDir, name)), filename)
+        with open(filename) as fd:
+            return fd.read()
+
+    def testRetrieve(self):
+        self.writeServerFile("a.manifest", "aaa", 1000000)
+        self.assertEqual(self.retrieve("a.manifest"), "aaa")
+        self.assertEqual(CountingTransporter.ncopy, 1)
+        self.assertTrue(self.cache.lookup(os.path.join(self.serverDir, "a.manifest")) is not None)
+
+        # unchanged, so it comes from the cache (even in a new process)
+        self.cache = DownloadCache(self.cache.dir)
+        self.assertEqual(self.retrieve("a.manifest"), "aaa")
+        self.assertEqual(CountingTransporter.ncopy, 1)
+
+        # a changed file is retrieved again
+        self.writeServerFile("a.manifest", "aaaa", 1000000)
+        self.assertEqual(self.retrieve("a.manifest"), "aaaa")
+        self.assertEqual(CountingTransporter.ncopy, 2)
+        self.writeServerFile("a.manifest", "bbbb", 2000000)
+        self.assertEqual(self.retrieve("a.manifest"), "bbbb")
+        self.assertEqual(CountingTransporter.ncopy, 3)
+
+        # files are stored by their contents
+        self.writeServerFile("b.manifest", "bbbb")
+        self.assertEqual(self.retrieve("b.manifest"), "bbbb")
+        self.assertEqual(self.cache.size(), len("aaa") + len("aaaa") + len("bbbb"))
+
+    def testEvict(self):
+        self.cache.maxBytes = 250
+        for i, name in enumerate("abc"):
+            self.writeServerFile(name, name*100)
+            self.retrieve(name)
+            objectFile = self.cache.lookup(os.path.join(self.serverDir, name))[1]
+            os.utime(objectFile, (1000000 + i, 1000000 + i))
+
+        self.retrieve("a")              # refreshes a
+        self.writeServerFile("d", "d"*100)
+        self.retrieve("d")              # evicts b and c
+
+        self.assertEqual(self.cache.size(), 200)
+        for name, cached in [("a", True), ("b", False), ("c", False), ("d", True)]:
+            self.assertEqual(self.cache.lookup(os.path.join(self.serverDir, name)) is not None, cached)
+        self.assertEqual(len(os.listdir(os.path.join(self.cache.dir, "sources"))), 2)
+
+        ncopy = CountingTransporter.ncopy
+        self.assertEqual(self.retrieve("b"), "b"*100)
+        self.assertEqual(CountingTransporter.ncopy, ncopy + 1)
+
+__all__ = "LocalTransporterTestCase LocalConfigFileTestCase LocalServerConfTestCase LocalDistribServerTestCase LocalRepositoryTestCase LocalRepositoriesTestCase ParallelInstallTestCase PrefetchTestCase DistribInstallTestCase DownloadCacheTestCase".split()
 
 if __name__ == "__main__":
     unittest.main()
@@ -101,8 +101,284 @@ class WebDistribServerTestCase(unittest.TestCase):
         self.assertEqual(len(tags), 1)
         self.assertIn("current", tags)
 
+import hashlib
+import re
+import shutil
+import tempfile
+import threading
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
 
-__all__ = "WebTransporterTestCase WebConfigFileTestCase WebServerConfTestCase WebDistribServerTestCase".split()
+import eups.hooks as hooks
+from eups.distrib.DownloadCache import DownloadCache
+from eups.distrib.server import connectionPool, RemoteFileInvalid, ServerNotResponding
+
+class FileServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class FileRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serve the files in the server's root directory, with ETags and Range requests, keeping
+    connections open.  A response is cut short after server.truncate[0] bytes (which is then
+    removed from the list), if there are any.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        self.server.ranges.append(self.headers.get("Range"))
+
+        filename = os.path.join(self.server.root, self.path.lstrip("/"))
+        if not os.path.isfile(filename):
+            self.send_error(404)
+            return
+
+        with open(filename, "rb") as fd:
+            data = fd.read()
+
+        etag = '"%s"' % hashlib.md5(data).hexdigest()
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+
+        start = 0
+        mat = re.search(r"^bytes=(\d+)-$", self.headers.get("Range", ""))
+        if mat and self.headers.get("If-Range", etag) == etag:
+            start = int(mat.group(1))
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */%d" % len(data))
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+
+        if start > 0:
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (start, len(data) - 1, len(data)))
+        else:
+            self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(data) - start))
+        self.end_headers()
+
+        if self.server.truncate:
+            self.wfile.write(data[start:start + self.server.truncate.pop(0)])
+            self.close_connection = True
+        else:
+            self.wfile.write(data[start:])
+
+    def log_message(self, *args):
+        pass
+
+class LocalWebServerTestCase(unittest.TestCase):
+    """Tests that use a web server running in this process"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="testServerWeb-")
+        self.root = os.path.join(self.tmpdir, "server")
+        os.makedirs(self.root)
+
+        self.server = FileServer(("127.0.0.1", 0), FileRequestHandler)
+        self.server.root = self.root
+        self.server.requests = []
+        self.server.ranges = []
+        self.server.truncate = []
+        self.server.connections = 0
+        self.server.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.base = "http://127.0.0.1:%d" % self.server.server_address[1]
+
+        self.downloadRetries = hooks.config.Eups.downloadRetries
+
+    def tearDown(self):
+        hooks.config.Eups.downloadRetries = self.downloadRetries
+        connectionPool.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def writeServerFile(self, name, contents):
+        with open(os.path.join(self.root, name), "w") as fd:
+            fd.write(contents)
+
+    def testCacheToFileIfChanged(self):
+        self.writeServerFile("a.manifest", "aaa")
+        localfile = os.path.join(self.tmpdir, "a.manifest")
+
+        trx = WebTransporter(self.base + "/a.manifest")
+        changed, validator = trx.cacheToFileIfChanged(localfile)
+        self.assertTrue(changed)
+        self.assertTrue(validator.startswith("etag:"))
+        with open(localfile) as fd:
+            self.assertEqual(fd.read(), "aaa")
+
+        os.remove(localfile)
+        self.assertEqual(trx.cacheToFileIfChanged(localfile, validator), (False, validator))
+        self.assertTrue(not os.path.exists(localfile))
+
+        self.writeServerFile("a.manifest", "bbb")
+        changed, validator2 = trx.cacheToFileIfChanged(localfile, validator)
+        self.assertTrue(changed)
+        self.assertNotEqual(validator, validator2)
+
+        self.assertRaises(RemoteFileNotFound, WebTransporter(self.base + "/b.manifest").cacheToFile, localfile)
+
+    def testDownloadCache(self):
+        self.writeServerFile("a.manifest", "aaa")
+        cache = DownloadCache(os.path.join(self.tmpdir, "cache"))
+
+        for i in range(2):
+            localfile = os.path.join(self.tmpdir, "a%d.manifest" % i)
+            cache.retrieve(WebTransporter(self.base + "/a.manifest"), localfile)
+            with open(localfile) as fd:
+                self.assertEqual(fd.read(), "aaa")
+        self.assertEqual(len(self.server.requests), 2) # the second was answered "Not Modified"
+        self.assertEqual(cache.size(), 3)
+
+    def writeLargeServerFile(self, name):
+        data = os.urandom(WebTransporter.checksumMinBytes + 12345)
+        with open(os.path.join(self.root, name), "wb") as fd:
+            fd.write(data)
+        return data
+
+    def assertRetrieved(self, localfile, data):
+        with open(localfile, "rb") as fd:
+            self.assertEqual(fd.read(), data)
+        self.assertTrue(not os.path.exists(localfile + ".partial"))
+        self.assertTrue(not os.path.exists(localfile + ".partial.validator"))
+
+    def testResume(self):
+        data = self.writeLargeServerFile("a.tar.gz")
+        localfile = os.path.join(self.tmpdir, "a.tar.gz")
+        trx = WebTransporter(self.base + "/a.tar.gz", verbosity=-1)
+
+        self.server.truncate = [100000, 200000]
+        trx.cacheToFile(localfile)
+        self.assertRetrieved(localfile, data)
+        self.assertEqual(self.server.requests, ["/a.tar.gz"]*3 + ["/a.tar.gz.sha256"])
+        self.assertEqual(self.server.ranges[:3], [None, "bytes=100000-", "bytes=300000-"])
+
+        # Check against the published checksum
+        with open(os.path.join(self.root, "a.tar.gz.sha256"), "w") as fd:
+            fd.write("%s  a.tar.gz\n" % hashlib.sha256(data).hexdigest())
+        self.server.truncate = [100000]
+        trx.cacheToFile(localfile)
+        self.assertRetrieved(localfile, data)
+
+        self.writeServerFile("a.tar.gz.sha256", "%s  a.tar.gz\n" % hashlib.sha256(b"").hexdigest())
+        os.remove(localfile)
+        self.assertRaises(RemoteFileInvalid, trx.cacheToFile, localfile)
+        self.assertTrue(not os.path.exists(localfile))
+        self.assertTrue(not os.path.exists(localfile + ".partial"))
+
+        # Give up if the transfer keeps being interrupted, keeping what we have for next time
+        os.remove(os.path.join(self.root, "a.tar.gz.sha256"))
+        hooks.config.Eups.downloadRetries = 1
+        self.server.truncate = [1000, 1000]
+        self.assertRaises(ServerNotResponding, trx.cacheToFile, localfile)
+        self.assertEqual(os.stat(localfile + ".partial").st_size, 2000)
+
+        del self.server.ranges[:]
+        trx.cacheToFile(localfile)
+        self.assertRetrieved(localfile, data)
+        self.assertEqual(self.server.ranges[0], "bytes=2000-")
+
+    @unittest.skipUnless(os.path.exists("/dev/full"), "needs /dev/full")
+    def testWriteError(self):
+        # Failing to write the file isn't mistaken for an interrupted transfer
+        self.writeLargeServerFile("a.tar.gz")
+        localfile = os.path.join(self.tmpdir, "a.tar.gz")
+        os.symlink("/dev/full", localfile + ".partial")
+
+        trx = WebTransporter(self.base + "/a.tar.gz", verbosity=-1)
+        self.assertRaises(EnvironmentError, trx.cacheToFile, localfile)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def testResumeChangedFile(self):
+        data = self.writeLargeServerFile("a.tar.gz")
+        localfile = os.path.join(self.tmpdir, "a.tar.gz")
+        trx = WebTransporter(self.base + "/a.tar.gz", verbosity=-1)
+
+        # A partial file from an earlier version of the file is discarded
+        hooks.config.Eups.downloadRetries = 0
+        self.server.truncate = [1000]
+        self.assertRaises(ServerNotResponding, trx.cacheToFile, localfile)
+        data = self.writeLargeServerFile("a.tar.gz")
+
+        trx.cacheToFile(localfile)
+        self.assertRetrieved(localfile, data)
+        self.assertEqual(self.server.ranges, [None, "bytes=1000-", None])
+
+        # A complete partial file (e.g. if we were interrupted before renaming it) is retrieved again
+        with open(localfile + ".partial", "wb") as fd:
+            fd.write(data)
+        with open(localfile + ".partial.validator", "w") as fd:
+            fd.write('"%s"\n' % hashlib.md5(data).hexdigest())
+        trx.cacheToFile(localfile)
+        self.assertRetrieved(localfile, data)
+
+    def testKeepAlive(self):
+        for i in range(10):
+            self.writeServerFile("f%d.table" % i, "table %d" % i)
+        self.writeServerFile("index.html", "<html></html>")
+
+        for i in range(10):
+            localfile = os.path.join(self.tmpdir, "f%d.table" % i)
+            WebTransporter(self.base + "/f%d.table" % i).cacheToFile(localfile)
+            with open(localfile) as fd:
+                self.assertEqual(fd.read(), "table %d" % i)
+        WebTransporter(self.base + "/index.html", verbosity=-1).listDir()
+
+        self.assertEqual(len(self.server.requests), 11)
+        self.assertEqual(self.server.connections, 1)
+
+        # The server closing an idle connection isn't an error
+        connectionPool._idle[("http", self.base.split("/")[-1])][0].sock.close()
+        WebTransporter(self.base + "/f0.table").cacheToFile(localfile)
+        self.assertEqual(self.server.connections, 2)
+
+        # (our server closes the connection after an error)
+        self.assertRaises(RemoteFileNotFound, WebTransporter(self.base + "/missing").cacheToFile, localfile)
+        WebTransporter(self.base + "/f0.table").cacheToFile(localfile)
+        self.assertEqual(self.server.connections, 3)
+
+    def testConcurrentRequests(self):
+        for i in range(40):
+            self.writeServerFile("f%d.table" % i, "table %d" % i)
+
+        def fetch(i):
+            localfile = os.path.join(self.tmpdir, "f%d.table" % i)
+            WebTransporter(self.base + "/f%d.table" % i).cacheToFile(localfile)
+            with open(localfile) as fd:
+                return fd.read()
+
+        nthread = connectionPool.maxPerHost
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(nthread)
+        try:
+            contents = pool.map(fetch, range(40))
+        finally:
+            pool.close()
+            pool.join()
+
+        self.assertEqual(contents, ["table %d" % i for i in range(40)])
+        self.assertTrue(self.server.connections <= nthread)
+
+__all__ = "WebTransporterTestCase WebConfigFileTestCase WebServerConfTestCase WebDistribServerTestCase LocalWebServerTestCase".split()
 
 if __name__ == "__main__":
     if len(sys.argv) > 1:
@@ -4,6 +4,11 @@ Tests for eups.stack
 """
 
 import os
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+import shutil
 import unittest
 import time
 import testCommon
@@ -119,6 +124,32 @@ class ProductFamilyTestCase(unittest.TestCase):
         prod = self.fam.getProduct("3.1")
         self.assert_(prod._table is not None)
 
+    def testCompactRecords(self):
+        fam = ProductFamily("magnum", "/opt")
+        fam.addVersion("3.1", "/opt/Linux/magnum/3.1", "/opt/Linux/magnum/3.1/ups/magnum.table")
+        fam.addVersion("3.2", "/elsewhere/magnum/3.2", "none")
+        fam.assignTag("current", "3.1")
+
+        # paths are stored relative to the stack root and product directory...
+        rec = fam.versions["3.1"]
+        self.assertEqual(rec.dir, os.path.join("Linux", "magnum", "3.1"))
+        self.assertEqual(rec.tablefile, os.path.join("ups", "magnum.table"))
+        self.assert_(not hasattr(rec, "__dict__"))
+        self.assertEqual(fam.versions["3.2"].dir, "/elsewhere/magnum/3.2")
+
+        # ...but a Product has the full paths
+        p = fam.getProduct("3.1")
+        self.assertEqual(p.dir, "/opt/Linux/magnum/3.1")
+        self.assertEqual(p.tablefile, "/opt/Linux/magnum/3.1/ups/magnum.table")
+        self.assertEqual(p.tags, ["current"])
+        self.assertEqual(fam.getProduct("3.2").tablefile, "none")
+
+        fam2 = pickle.loads(pickle.dumps(fam, protocol=2))
+        self.assertEqual(fam2.getVersionData("3.1")[:2], fam.getVersionData("3.1")[:2])
+        self.assertEqual(fam2.getVersionData("3.2")[:2], fam.getVersionData("3.2")[:2])
+        self.assertEqual(fam2.tags, fam.tags)
+        self.assert_(fam2.versions["3.1"].tablefile is fam.versions["3.1"].tablefile) # interned
+
 
 
 from eups.stack import ProductStack
@@ -134,7 +165,11 @@ class ProductStackTestCase(unittest.TestCase):
 
     def testMisc(self):
         self.assertEqual(ProductStack.persistFilename("Linux"),
-                          "Linux.pickleDB1_3_0")
+                          "Linux.pickleDB2_2_0")
+        self.assertEqual(ProductStack.persistFilename("Linux", "inventory"),
+                          "Linux.inventory2")
+        self.assertRaises(RuntimeError, ProductStack, self.dbpath,
+                          cacheFormat="gurn")
         self.assertEqual(self.stack.getDbPath(),
                           os.path.join(testEupsStack, "ups_db"))
 
@@ -424,6 +459,8 @@ class ProductStackTestCase(unittest.TestCase):
 
 
 from eups.stack import CacheOutOfSync
+from eups.stack.Inventory import InventoryLookup
+from eups.db import Database
 
 class CacheTestCase(unittest.TestCase):
 
@@ -431,12 +468,19 @@ class CacheTestCase(unittest.TestCase):
         self.dbpath = os.path.join(testEupsStack, "ups_db")
         self.cache = os.path.join(self.dbpath,
                                   ProductStack.persistFilename("Linux"))
-        if os.path.exists(self.cache):
-            os.remove(self.cache)
+        self.inventory = os.path.join(self.dbpath,
+                                      ProductStack.persistFilename("Linux", "inventory"))
+        for cache in [self.cache, self.inventory]:
+            if os.path.exists(cache):
+                os.remove(cache)
 
     def tearDown(self):
-        if os.path.exists(self.cache):
-            os.remove(self.cache)
+        for cache in [self.cache, self.inventory]:
+            if os.path.exists(cache):
+                os.remove(cache)
+        for flavor in ProductStack.findCachedFlavors(self.dbpath, "inventory"):
+            os.remove(os.path.join(self.dbpath,
+                                   ProductStack.persistFilename(flavor, "inventory")))
 
     def testRegen(self):
         ps = ProductStack.fromCache(self.dbpath, "Linux", autosave=True,
@@ -468,6 +512,115 @@ class CacheTestCase(unittest.TestCase):
                                "/opt/sw/Darwin/fw/1.2", "none"))
         self.assertRaises(CacheOutOfSync, ps2.save)
 
+    def testIncrementalUpdate(self):
+        ps = ProductStack.fromCache(self.dbpath, "Linux", autosave=False,
+                                    updateCache=True, verbose=False)
+        self.assert_(os.path.exists(self.cache))
+        self.assertEqual(ps.findChangedProducts("Linux"), [])
+        self.assert_(not ps.hasProduct("newprod"))
+
+        db = Database(self.dbpath)
+        pdir = os.path.join(testEupsStack, "Linux", "newprod", "1.0")
+        newprod = Product("newprod", "1.0", "Linux", pdir,
+                          os.path.join(pdir, "ups", "newprod.table"))
+        db.declare(newprod)
+        try:
+            self.assertEqual(ps.findChangedProducts("Linux"), ["newprod"])
+
+            ps = ProductStack.fromCache(self.dbpath, "Linux", autosave=False,
+                                        updateCache=True, verbose=False)
+            self.assert_(ps.hasProduct("newprod", "Linux", "1.0"))
+            self.assert_(ps.hasProduct("python", "Linux", "2.6"))
+            self.assertEqual(ps.findChangedProducts("Linux"), [])
+        finally:
+            db.undeclare(newprod)
+
+        ps = ProductStack.fromCache(self.dbpath, "Linux", autosave=False,
+                                    updateCache=True, verbose=False)
+        self.assert_(not ps.hasProduct("newprod"))
+        self.assert_(ps.hasProduct("python", "Linux", "2.6"))
+
+    def testProductNamesCheck(self):
+        cacheDir = os.path.join(testEupsStack, "_userdata_", "stackCache")
+        if os.path.exists(cacheDir):
+            shutil.rmtree(cacheDir)
+        os.makedirs(cacheDir)
+        try:
+            ps = ProductStack.fromCache(self.dbpath, "Linux", persistDir=cacheDir,
+                                        autosave=False, updateCache=True)
+            times = ps.productTimes["Linux"]
+            self.assertEqual(times["dbmtime"], os.stat(self.dbpath).st_mtime)
+            self.assert_(times["digest"])
+
+            # the cache is used (rather than reloading all flavors from the
+            # database) if the database directory is unchanged...
+            ps = ProductStack.fromCache(self.dbpath, "Linux", persistDir=cacheDir,
+                                        autosave=False, updateCache=True)
+            self.assertEqual(ps.getFlavors(), ["Linux"])
+
+            # ...or if it has changed but the product names haven't
+            mtime = os.stat(self.dbpath).st_mtime
+            os.utime(self.dbpath, (mtime + 10, mtime + 10))
+            try:
+                ps = ProductStack.fromCache(self.dbpath, "Linux", persistDir=cacheDir,
+                                            autosave=False, updateCache=True)
+                self.assertEqual(ps.getFlavors(), ["Linux"])
+            finally:
+                os.utime(self.dbpath, (mtime, mtime))
+
+            # a product that isn't in the database is noticed
+            ps.addProduct(Product("afw", "1.2", "Linux", "/opt/sw/Linux/afw/1.2", "none"))
+            ps.save()
+            self.assertEqual(ps.productTimes["Linux"]["dbmtime"], None)
+            ps = ProductStack.fromCache(self.dbpath, "Linux", persistDir=cacheDir,
+                                        autosave=False, updateCache=True)
+            self.assert_(not ps.hasProduct("afw"))
+        finally:
+            shutil.rmtree(cacheDir)
+
+    def testInventory(self):
+        expected = ProductStack.fromDatabase(self.dbpath, autosave=False)
+        ps = ProductStack.fromCache(self.dbpath, "Linux", autosave=False,
+                                    updateCache=True, cacheFormat="inventory")
+        self.assert_(os.path.exists(self.inventory))
+        self.assert_(not os.path.exists(self.cache))
+        self.assertIn("Linux", ProductStack.findCachedFlavors(self.dbpath, "inventory"))
+
+        ps = ProductStack.fromCache(self.dbpath, "Linux", autosave=False,
+                                    updateCache=True, cacheFormat="inventory")
+        self.assert_(isinstance(ps.lookup["Linux"], InventoryLookup))
+
+        # products are only read from the inventory as they're needed
+        self.assertEqual(ps.productTimes["Linux"]["products"], None)
+        self.assert_(ps.hasProduct("python", "Linux"))
+        self.assertEqual(list(ps.lookup["Linux"]._loaded.keys()), ["python"])
+        self.assertEqual(ps._recordedTimes("Linux")["products"],
+                         Database(self.dbpath).getProductTimes())
+        self.assertEqual(sorted(ps.getProductNames("Linux")),
+                         sorted(expected.getProductNames("Linux")))
+        self.assertEqual(sorted(ps.getVersions("python", "Linux")),
+                         sorted(expected.getVersions("python", "Linux")))
+        self.assert_(not ps.hasProduct("goober"))
+
+        prod = ps.getTaggedProduct("python", "Linux", "current")
+        exp = expected.getTaggedProduct("python", "Linux", "current")
+        self.assertEqual(prod.version, exp.version)
+        self.assertEqual(prod.dir, exp.dir)
+        self.assertEqual(prod.tablefile, exp.tablefile)
+        self.assertEqual(prod.tags, exp.tags)
+
+        ps.removeProduct("python", "Linux", "2.6")
+        self.assert_(not ps.hasProduct("python", "Linux", "2.6"))
+        ps.addProduct(Product("afw", "1.2", "Linux", "/opt/sw/Linux/afw/1.2", "none"))
+        self.assert_(ps.hasProduct("afw", "Linux", "1.2"))
+
+        # the pickled format can be written from an inventory
+        ps.save("Linux", format="pickle")
+        ps = ProductStack(self.dbpath, autosave=False)
+        ps.reload("Linux")
+        self.assert_(ps.hasProduct("afw", "Linux", "1.2"))
+        self.assert_(not ps.hasProduct("python", "Linux", "2.6"))
+
 #-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
 
 def suite(makeSuite=True):
@@ -4,6 +4,7 @@ Tests for eups.product
 """
 
 import os
+import shutil
 import unittest
 import testCommon
 from testCommon import testEupsStack
@@ -27,6 +28,41 @@ class TableTestCase1(unittest.TestCase):
         self.assertEqual(len(self.table.actions("Linux+2.1.2")), 14)
         self.assertEqual(len(self.table.actions("DarwinX86")), 14)
 
+    def testCompiled(self):
+        testDir = os.path.join(testEupsStack, "_userdata_", "testCompiled")
+        cacheDir = os.path.join(testDir, Table.cacheDirName)
+        tablefile = os.path.join(testDir, "mwi.table")
+        os.makedirs(testDir)
+        read = Table._read
+        def noRead(*args, **kwargs):
+            raise RuntimeError("table was parsed")
+        try:
+            shutil.copy(self.tablefile, tablefile)
+            table = Table(tablefile, cacheDir=cacheDir)
+            self.assertEqual(len(os.listdir(cacheDir)), 1)
+            self.assertEqual(str(table), str(self.table))
+
+            # the compiled table should be used while the file is unchanged
+            Table._read = noRead
+            table = Table(tablefile, cacheDir=cacheDir)
+            self.assertEqual(str(table), str(self.table))
+            self.assertEqual(len(table.actions("Linux")), 13)
+            self.assertEqual(len(table.actions("DarwinX86")), 14)
+
+            fd = open(tablefile, "a")
+            fd.write("envSet(GOODBYE, cruel world)\n")
+            fd.close()
+            self.assertRaises(RuntimeError, Table, tablefile, cacheDir=cacheDir)
+
+            Table._read = read
+            table = Table(tablefile, cacheDir=cacheDir)
+            self.assertIn("GOODBYE", str(table))
+            Table._read = noRead
+            self.assertEqual(str(Table(tablefile, cacheDir=cacheDir)), str(table))
+        finally:
+            Table._read = read
+            shutil.rmtree(testDir)
+
 class TableTestCase2(unittest.TestCase):
     """test the Table class"""
 